@@ -28,8 +28,45 @@ try:
 except ImportError:
     import simplejson as json
 import sys
+import os
+import re
+import mmap
+import socket
+import stat
+import threading
+import marshal
+import struct
+import tempfile
+import time
 import logging
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from fractions import Fraction
+from functools import wraps
+from heapq import heappush, heappushpop, merge
+from itertools import chain, compress, imap, izip
+from operator import ne
+from fnmatch import fnmatch, translate
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
 from optparse import OptionParser
+from StringIO import StringIO
+from urllib import unquote
+from urlparse import urlsplit, parse_qs
+import BaseHTTPServer
+import SocketServer
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 __author__ = "Matěj Cepl"
 __version__ = "1.2.9"
@@ -40,12 +77,99 @@ logging.basicConfig(format='%(levelname)s:%(funcName)s:%(message)s',
 STYLE_MAP = {
     u"_append": u"append_class",
     u"_remove": u"remove_class",
-    u"_update": u"update_class"
+    u"_update": u"update_class",
+    u"_move": u"move_class"
 }
 INTERNAL_KEYS = set(STYLE_MAP.keys())
 
 LEVEL_INDENT = u"&nbsp;"
 
+ARRAY_ALIGNMENTS = ("position", "lcs")
+# Maximal edit distance for which the lcs alignment is searched for
+ALIGN_CUTOFF = 1000
+
+# Output formats of the command line tool
+FORMATS = ("json", "html", "patch")
+
+# "xdiff" compares arrays as unordered collections (X-Diff, see xdiff/)
+BACKENDS = ("default", "xdiff")
+# Largest number of unmatched elements of one type in an array
+# for which the optimal matching is computed ...
+XDIFF_OPTIMAL_LIMIT = 40
+# ... and for which the distances of all pairs are computed at all
+XDIFF_PAIRS_LIMIT = 10000
+
+# Serialized size of a group of top-level sections diffed by one
+# parallel task, and number of elements of a top-level array per task
+PARALLEL_CHUNK_SIZE = 1024 * 1024
+PARALLEL_ARRAY_CHUNK = 10000
+
+# Files compared when comparing directories, and number of pairs of
+# them handed to a worker process at once
+TREE_PATTERN = "*.json"
+TREE_CHUNK = 16
+
+# How the -i/-x filters treat a value (see Comparator._filter_key):
+# ignore it, compare it, compare it but report only changes nested deeper
+# (it may contain included values), compare it as an included subtree
+_SKIP, _COMPARE, _DESCEND, _INCLUDE = range(4)
+
+# Placeholder for the missing side of appended and removed values
+_MISSING = object()
+# Result of comparing equal values (None is a new value like any other)
+_SAME = object()
+
+# Kinds of values by their types, to dispatch on without isinstance
+# chains (see kind_of)
+_SCALAR, _OBJECT, _ARRAY = range(3)
+_KINDS = {
+    dict: _OBJECT,
+    list: _ARRAY,
+    tuple: _ARRAY,
+    unicode: _SCALAR,
+    str: _SCALAR,
+    int: _SCALAR,
+    long: _SCALAR,
+    float: _SCALAR,
+    bool: _SCALAR,
+    type(None): _SCALAR,
+}
+# Types compared within the tolerance (bool is not a number in JSON)
+_NUMBERS = frozenset([int, long, float])
+# Shortest arrays of numbers compared with numpy (when available)
+NUMPY_MIN_SIZE = 64
+# Magnitude below which all integers are exact floats; numbers from it
+# on are compared exactly in Python rather than with numpy
+_EXACT_FLOAT = 2.0 ** 53
+
+# How much of the input is read at once by the streaming parser
+CHUNK_SIZE = 64 * 1024
+
+# Number of the longest arrays remembered by ComparatorStats
+STATS_LARGEST_ARRAYS = 10
+
+# Size of the lines of JSON Lines records sorted in memory at once by
+# Comparator.compare_records; more are sorted in temporary files
+RECORDS_RUN_SIZE = 32 * 1024 * 1024
+
+# Default limit of the total size of the entries of ResultCache
+CACHE_MAX_SIZE = 256 * 1024 * 1024
+# Age in seconds of temporary files in the cache directory which are
+# removed as left over
+CACHE_TMP_AGE = 3600
+
+# Default limit of the total size of the JSON texts of the baselines
+# kept by DiffServer
+SERVER_MAX_SIZE = 512 * 1024 * 1024
+# Default limit of the size of the body of a request to DiffServer
+SERVER_MAX_BODY = 128 * 1024 * 1024
+# Content types of the output formats of DiffServer
+SERVER_CONTENT_TYPES = {
+    "json": "application/json",
+    "html": "text/html; charset=utf-8",
+    "patch": "application/json-patch+json",
+}
+
 out_str_template = u"""<!DOCTYPE html>
 <html lang='en'>
 <meta charset="utf-8" />
@@ -63,6 +187,9 @@ td {
 .update_class {
   color: navy;
 }
+.move_class {
+  color: purple;
+}
 </style>
 <body>
   <h1>%s</h1>
@@ -79,61 +206,455 @@ def is_scalar(value):
     return not isinstance(value, (list, tuple, dict))
 
 
+_encode_string = json.encoder.encode_basestring_ascii
+# json.dumps of scalars by their types (floats are special, see
+# scalar_json)
+_SCALAR_JSON = {
+    unicode: _encode_string,
+    str: _encode_string,
+    int: str,
+    long: str,
+    bool: lambda value: value and "true" or "false",
+    type(None): lambda value: "null",
+}
+
+
+def scalar_json(value):
+    """json.dumps of a scalar value, without the overhead of the
+    encoder."""
+    encode = _SCALAR_JSON.get(type(value))
+    if encode is not None:
+        return encode(value)
+    # NaN and Infinity are not repr'ed as in JSON
+    if type(value) is float and value - value == 0:
+        return repr(value)
+    return json.dumps(value)
+
+
+def same_values(first, second):
+    """Are the values equal, including the types of all the values nested
+    in them (1, 1.0 and True differ, as they do for Comparator)?
+
+    The values are walked without recursion (!= of deeply nested dicts
+    may even find equal ones different, hitting the recursion limit
+    while looking up their keys)."""
+    stack = [(first, second)]
+    while stack:
+        first, second = stack.pop()
+        if first is second:
+            continue
+        if type(first) is not type(second):
+            return False
+        if isinstance(first, dict):
+            if len(first) != len(second):
+                return False
+            for key, value in first.iteritems():
+                if key not in second:
+                    return False
+                stack.append((value, second[key]))
+        elif isinstance(first, list):
+            if len(first) != len(second):
+                return False
+            stack.extend(zip(first, second))
+        elif first != second:
+            return False
+    return True
+
+
+def kind_of(value):
+    """_SCALAR, _OBJECT or _ARRAY."""
+    kind = _KINDS.get(type(value))
+    if kind is None:
+        if isinstance(value, dict):
+            return _OBJECT
+        elif isinstance(value, (list, tuple)):
+            return _ARRAY
+        return _SCALAR
+    return kind
+
+
 class HTMLFormatter(object):
     """Special formatter to generate HTML page from diff dict.
+
+    The page is generated piece by piece (see iter_html), so that write
+    can send it out without ever holding the whole page in memory.
+    With max_rows only that many entries of each object or array are
+    shown, the rest is collapsed to one row.
     """
 
-    def __init__(self, diff_object):
+    def __init__(self, diff_object, max_rows=None):
         self.diff = diff_object
+        self.max_rows = max_rows
 
-    def _generate_page(self, in_dict, title="json_diff result"):
-        """A shell function to start recursive self._format_dict.
-        """
-        out_str = out_str_template % (title, title,
-            self._format_dict(in_dict))
-        out_str += u"""</table>
+    def iter_html(self, title="json_diff result"):
+        """Generate the page as a sequence of unicode strings."""
+        yield (out_str_template % (title, title, u""))[:-1]
+        if is_replacement(self.diff):
+            # the new document, shown as an updated value without a name
+            pieces = self._iter_dict({u"": self.diff[u"_replace"]},
+                u"_update")
+        else:
+            pieces = self._iter_dict(self.diff)
+        for piece in pieces:
+            yield piece
+        yield u"""
+</table>
   </body>
 </html>"""
-        return out_str
 
     def _format_item(self, item, index, typch, level=0):
         """Function to unify formatting on the leaf node level."""
         level_str = (u"<td>" + LEVEL_INDENT + u"</td>") * level
+        return (u"<tr>\n  %s<td class='%s'>%s = %s</td>\n  </tr>" %
+            (level_str, STYLE_MAP[typch], index, unicode(item)))
+
+    def _entries(self, value, typch, level):
+        """(item, index, change type, level) of what is shown for the
+        object or array value."""
+        if isinstance(value, (list, tuple)):
+            for index in xrange(len(value)):
+                yield value[index], index, typch, level
+        else:
+            keys = set(value.keys())
+            # For all STYLE_MAP keys which are present in diff_dict
+            for typechange in keys & INTERNAL_KEYS:
+                # change types are shown on the level of their parent
+                yield value[typechange], None, typechange, level - 1
+            # For all other non-internal keys
+            for variable in keys - INTERNAL_KEYS:
+                yield value[variable], variable, typch, level
+
+    def _iter_dict(self, diff_dict, typch="unknown_change", level=0):
+        """Generate HTML rows for the (nested) diff dict."""
+        # the nested objects and arrays being formatted, walked without
+        # recursion, so that the depth of the diff is not limited
+        stack = [(self._entries(diff_dict, typch, level), 0)]
+        while stack:
+            entries, shown = stack[-1]
+            try:
+                item, index, item_typch, item_level = next(entries)
+            except StopIteration:
+                stack.pop()
+                continue
+            if index is None:
+                stack.append((self._entries(item, item_typch,
+                    item_level + 1), 0))
+                continue
+            if self.max_rows is not None and shown >= self.max_rows:
+                rest = sum(1 for entry in entries) + 1
+                stack.pop()
+                yield self._format_item(u"%d more" % rest, u"...",
+                    item_typch, item_level)
+                continue
+            stack[-1] = (entries, shown + 1)
+            if _KINDS.get(type(item)) == _SCALAR or is_scalar(item):
+                yield self._format_item(item, index, item_typch, item_level)
+            else:
+                stack.append((self._entries(item, item_typch,
+                    item_level + 1), 0))
 
-        if is_scalar(item):
-            out_str = (u"<tr>\n  %s<td class='%s'>%s = %s</td>\n  </tr>\n" %
-                (level_str, STYLE_MAP[typch], index, unicode(item)))
-        elif isinstance(item, (list, tuple)):
-            out_str = self._format_array(item, typch, level + 1)
-        else:
-            out_str = self._format_dict(item, typch, level + 1)
-        return out_str.strip()
-
-    def _format_array(self, diff_array, typch, level=0):
-        """Recursively generate HTML for two different arrays."""
-        out_str = []
-        for index in range(len(diff_array)):
-            out_str.append(self._format_item(diff_array[index], index, typch,
-                level))
-        return ("".join(out_str)).strip()
-
-    def _format_dict(self, diff_dict, typch="unknown_change", level=0):
-        """Recursively generate HTML for two different dicts."""
-        out_str = []
-        # For all STYLE_MAP keys which are present in diff_dict
-        for typechange in set(diff_dict.keys()) & INTERNAL_KEYS:
-            out_str.append(self._format_dict(diff_dict[typechange],
-                 typechange, level))
-
-        # For all other non-internal keys
-        for variable in set(diff_dict.keys()) - INTERNAL_KEYS:
-            out_str.append(self._format_item(diff_dict[variable],
-                 variable, typch, level))
-
-        return ("".join(out_str)).strip()
+    def write(self, out, encoding="utf-8"):
+        """Write the page encoded to the file object out."""
+        write_pieces(self.iter_html(), out, encoding)
 
     def __unicode__(self):
-        return self._generate_page(self.diff)
+        return u"".join(self.iter_html())
+
+
+def json_pointer(path):
+    """JSON pointer (RFC 6901) of the path given as a tuple of keys and
+    indices."""
+    return u"".join(u"/" + unicode(key).replace(u"~", u"~0").
+        replace(u"/", u"~1") for key in path)
+
+
+def patch_operations(changes):
+    """Operations of JSON Patch (RFC 6902) from Comparator.iter_changes."""
+    for op, path, old, new in changes:
+        if op == "remove":
+            yield {u"op": u"remove", u"path": path}
+        else:
+            yield {u"op": unicode(op), u"path": path, u"value": new}
+
+
+def parse_pointer(pointer):
+    """Keys of the JSON pointer (RFC 6901), as unicode strings."""
+    if pointer == u"":
+        return []
+    if not pointer.startswith(u"/"):
+        raise PatchError("Invalid JSON pointer %s" % pointer)
+    return [part.replace(u"~1", u"/").replace(u"~0", u"~")
+        for part in pointer[1:].split(u"/")]
+
+
+def is_replacement(diff):
+    """Does diff (a result of Comparator.compare_dicts) replace the whole
+    document (of another type, or a scalar) with the one under _replace?"""
+    return isinstance(diff, dict) and len(diff) == 1 and u"_replace" in diff
+
+
+def is_nested_diff(target, change):
+    """Is change (from _update of a diff) the diff of target, rather
+    than its new value?"""
+    if not isinstance(target, (dict, list)) or \
+            not isinstance(change, dict) or len(change) == 0:
+        return False
+    for key in change:
+        if key not in INTERNAL_KEYS:
+            return False
+    return True
+
+
+def _array_index(arr, key, size=None):
+    """Index in arr given by key of a diff or of a JSON pointer; size is
+    the largest index allowed, the length of arr by default."""
+    if size is None:
+        size = len(arr) - 1
+    try:
+        idx = int(key)
+    except (TypeError, ValueError):
+        raise PatchError("Invalid array index %s" % key)
+    if idx < 0 or idx > size:
+        raise PatchError("Array index %s out of range" % key)
+    return idx
+
+
+def apply_diff(doc, diff):
+    """
+    Apply the result of Comparator.compare_dicts to doc, in place.
+
+    Returns the patched document (a new one only when the whole document
+    is replaced). Raises PatchError when the diff does not fit doc.
+    In arrays the changes are applied in the order given by the indices
+    of the result: updates of the old elements, then removals, then the
+    new and moved elements are put at their places in the new array.
+    """
+    if diff == {}:
+        return doc
+    if is_replacement(diff):
+        return diff[u"_replace"]
+    if not is_nested_diff(doc, diff):
+        return diff
+    stack = [(doc, diff)]
+    while stack:
+        target, change = stack.pop()
+        updates = change.get(u"_update", {})
+        if isinstance(target, dict):
+            for key in change.get(u"_remove", {}):
+                if key not in target:
+                    raise PatchError("Removed key %s is missing" % key)
+                del target[key]
+            target.update(change.get(u"_append", {}))
+            for key, value in updates.iteritems():
+                if key not in target:
+                    raise PatchError("Updated key %s is missing" % key)
+                if is_nested_diff(target[key], value):
+                    stack.append((target[key], value))
+                else:
+                    target[key] = value
+            continue
+
+        for key, value in updates.iteritems():
+            idx = _array_index(target, key)
+            if is_nested_diff(target[idx], value):
+                stack.append((target[idx], value))
+            else:
+                target[idx] = value
+        removed = set(_array_index(target, key)
+            for key in change.get(u"_remove", {}))
+        added = [(int(key), value)
+            for key, value in change.get(u"_append", {}).iteritems()]
+        for key, old_key in change.get(u"_move", {}).iteritems():
+            old_idx = _array_index(target, old_key)
+            removed.add(old_idx)
+            added.append((int(key), target[old_idx]))
+        for idx in sorted(removed, reverse=True):
+            del target[idx]
+        added.sort(key=lambda pair: pair[0])
+        for idx, value in added:
+            target.insert(_array_index(target, idx, len(target)), value)
+    return doc
+
+
+def _pointer_parent(doc, parts):
+    """Container holding the value on the path given by parts of a JSON
+    pointer, and the key of the value in it."""
+    parent = doc
+    for part in parts[:-1]:
+        if isinstance(parent, list):
+            parent = parent[_array_index(parent, part)]
+        elif isinstance(parent, dict) and part in parent:
+            parent = parent[part]
+        else:
+            raise PatchError("Path %s does not exist" % u"/".join(parts))
+    key = parts[-1]
+    if isinstance(parent, list):
+        if key != u"-":
+            key = _array_index(parent, key, len(parent))
+    elif not isinstance(parent, dict):
+        raise PatchError("Path %s does not exist" % u"/".join(parts))
+    return parent, key
+
+
+def _pointer_get(doc, parts):
+    if not parts:
+        return doc
+    parent, key = _pointer_parent(doc, parts)
+    if isinstance(parent, dict):
+        missing = key not in parent
+    else:
+        missing = key == u"-" or key == len(parent)
+    if missing:
+        raise PatchError("Path %s does not exist" % u"/".join(parts))
+    return parent[key]
+
+
+def _pointer_add(doc, parts, value):
+    if not parts:
+        return value
+    parent, key = _pointer_parent(doc, parts)
+    if isinstance(parent, dict):
+        parent[key] = value
+    elif key == u"-":
+        parent.append(value)
+    else:
+        parent.insert(key, value)
+    return doc
+
+
+def _pointer_remove(doc, parts):
+    _pointer_get(doc, parts)
+    if not parts:
+        return None
+    parent, key = _pointer_parent(doc, parts)
+    del parent[key]
+    return doc
+
+
+def apply_patch(doc, operations):
+    """
+    Apply JSON Patch (RFC 6902) operations to doc, in place.
+
+    Returns the patched document (a new one only when the whole document
+    is replaced). Raises PatchError when an operation cannot be applied
+    or a test operation fails.
+    """
+    for operation in operations:
+        try:
+            op = operation[u"op"]
+            parts = parse_pointer(operation[u"path"])
+            if op in (u"add", u"replace", u"test"):
+                value = operation[u"value"]
+            elif op in (u"move", u"copy"):
+                value = _pointer_get(doc, parse_pointer(operation[u"from"]))
+        except (KeyError, TypeError, AttributeError):
+            raise PatchError("Invalid operation %s" % operation)
+        if op == u"add":
+            doc = _pointer_add(doc, parts, value)
+        elif op == u"remove":
+            doc = _pointer_remove(doc, parts)
+        elif op == u"replace":
+            doc = _pointer_add(_pointer_remove(doc, parts), parts, value)
+        elif op == u"move":
+            doc = _pointer_add(_pointer_remove(doc,
+                parse_pointer(operation[u"from"])), parts, value)
+        elif op == u"copy":
+            # copied without recursion, however deeply it is nested
+            doc = _pointer_add(doc, parts, _unflatten(_flatten(value)))
+        elif op == u"test":
+            if _pointer_get(doc, parts) != value:
+                raise PatchError("Test of %s failed" % operation[u"path"])
+        else:
+            raise PatchError("Unknown operation %s" % op)
+    return doc
+
+
+def iter_json(value, compact=False, level=0):
+    """Generate JSON of value as a sequence of strings.
+
+    The output is the same as of json.dumps(value, indent=4) (or with
+    compact, json.dumps(value, separators=(",", ":"))), but it is never
+    built in memory whole. Besides dicts and lists value may contain
+    iterators of (key, value) pairs, encoded as objects while they are
+    being consumed. level is the initial level of indentation.
+    """
+    if compact:
+        item_sep, key_sep, indent = u",", u":", None
+    else:
+        item_sep, key_sep, indent = u", ", u": ", u"    "
+    # iterators of (key, value) pairs or of values of objects and arrays
+    # being encoded, with the closing bracket and count of items done
+    stack = []
+    while True:
+        if stack:
+            items, closing, count = stack[-1]
+            try:
+                item = next(items)
+            except StopIteration:
+                stack.pop()
+                if count and indent is not None:
+                    yield u"\n" + indent * (level + len(stack))
+                yield closing
+                if not stack:
+                    return
+                continue
+            stack[-1] = (items, closing, count + 1)
+            if count:
+                yield item_sep
+            if indent is not None:
+                yield u"\n" + indent * (level + len(stack))
+            if closing == u"}":
+                key, value = item
+                if not isinstance(key, basestring):
+                    key = json.dumps(key)
+                yield json.dumps(key, ensure_ascii=False) + key_sep
+            else:
+                value = item
+        if isinstance(value, dict):
+            stack.append((value.iteritems(), u"}", 0))
+            yield u"{"
+        elif isinstance(value, (list, tuple)):
+            stack.append((iter(value), u"]", 0))
+            yield u"["
+        elif hasattr(value, "next"):
+            stack.append((value, u"}", 0))
+            yield u"{"
+        else:
+            yield json.dumps(value, ensure_ascii=False)
+            if not stack:
+                return
+
+
+def iter_json_array(values, compact=False):
+    """iter_json of an array given as an iterable of its values."""
+    yield u"["
+    count = 0
+    for value in values:
+        if count:
+            yield compact and u"," or u", "
+        if not compact:
+            yield u"\n    "
+        for piece in iter_json(value, compact, 1):
+            yield piece
+        count += 1
+    if count and not compact:
+        yield u"\n"
+    yield u"]"
+
+
+def write_pieces(pieces, out, encoding="utf-8"):
+    """Write the strings encoded to the file object out, in batches of
+    about CHUNK_SIZE characters."""
+    buf = []
+    size = 0
+    for piece in pieces:
+        buf.append(piece)
+        size += len(piece)
+        if size >= CHUNK_SIZE:
+            out.write(u"".join(buf).encode(encoding))
+            buf = []
+            size = 0
+    out.write(u"".join(buf).encode(encoding))
 
 
 class BadJSONError(ValueError):
@@ -141,226 +662,4056 @@ class BadJSONError(ValueError):
     pass
 
 
-class Comparator(object):
-    """
-    Main workhorse, the object itself
+class PatchError(ValueError):
+    """The diff or JSON Patch does not fit the patched document."""
+    pass
+
+
+_WS_RE = re.compile(r'[ \t\n\r]*')
+_STRING_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_NUMBER_RE = re.compile(r'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?')
+_LITERAL_RE = re.compile(r'true|false|null')
+_LITERALS = {"true": True, "false": False, "null": None}
+
+# states of the JSONEventParser
+_VALUE, _VALUE_OR_END, _KEY, _KEY_OR_END, _COMMA_OR_END, _DONE = range(6)
+
+
+class JSONEventParser(object):
+    """Incremental JSON tokenizer.
+
+    Reads the file object in chunks and generates events
+    ("start_map", None), ("map_key", key), ("end_map", None),
+    ("start_array", None), ("end_array", None) and ("value", scalar),
+    so that the whole document never has to be in memory.
     """
-    def __init__(self, fn1=None, fn2=None, opts=None):
-        self.obj1 = None
-        self.obj2 = None
-        if fn1:
-            try:
-                self.obj1 = json.load(fn1)
-            except (TypeError, OverflowError, ValueError), exc:
-                raise BadJSONError("Cannot decode object from JSON.\n%s" %
-                    unicode(exc))
-        if fn2:
-            try:
-                self.obj2 = json.load(fn2)
-            except (TypeError, OverflowError, ValueError), exc:
-                raise BadJSONError("Cannot decode object from JSON\n%s" %
-                    unicode(exc))
 
-        self.excluded_attributes = []
-        self.included_attributes = []
-        self.ignore_appended = False
-        if opts:
-            self.excluded_attributes = opts.exclude or []
-            self.included_attributes = opts.include or []
-            self.ignore_appended = opts.ignore_append or False
+    def __init__(self, fileobj, chunk_size=CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.offset = 0
+        self.eof = False
 
-    def _is_incex_key(self, key, value):
-        """Is this key excluded or not among included ones? If yes, it should
-        be ignored."""
-        key_out = ((self.included_attributes and
-                   (key not in self.included_attributes)) or
-                   (key in self.excluded_attributes))
-        value_out = True
-        if isinstance(value, dict):
-            for change_key in value:
-                if isinstance(value[change_key], dict):
-                    for key in value[change_key]:
-                        if ((self.included_attributes and
-                             (key in self.included_attributes)) or
-                             (key not in self.excluded_attributes)):
-                            value_out = False
-        return key_out and value_out
+    def _fill(self):
+        """Read next chunk of the input, dropping what was consumed."""
+        if self.eof:
+            return False
+        chunk = self.fileobj.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.offset += self.pos
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
 
-    def _filter_results(self, result):
-        """Whole -i or -x functionality. Rather than complicate logic while
-        going through the object’s tree we filter the result of plain
-        comparison.
+    def _error(self, msg):
+        raise BadJSONError("Cannot decode object from JSON.\n%s (char %d)" %
+            (msg, self.offset + self.pos))
 
-        Also clear out unused keys in result"""
-        out_result = {}
-        for change_type in result:
-            temp_dict = {}
-            for key in result[change_type]:
-                logging.debug("change_type = %s", change_type)
-                if self.ignore_appended and (change_type == "_append"):
+    def _next_char(self):
+        """Skip whitespace and return the next character (None on EOF)."""
+        while True:
+            self.pos = _WS_RE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return None
+
+    def _token(self, regex, what):
+        """Match the whole token, even when it is split between chunks.
+
+        A number may continue with up to two characters ("e+") which do
+        not match on their own, so we want to see that far past the match.
+        """
+        while True:
+            match = regex.match(self.buf, self.pos)
+            if match is not None and match.end() + 2 < len(self.buf):
+                break
+            if not self._fill():
+                break
+        if match is None:
+            self._error("Expecting %s" % what)
+        self.pos = match.end()
+        return match.group()
+
+    def _scalar(self, char):
+        if char == '"':
+            return json.loads(self._token(_STRING_RE, "string"))
+        elif char in "-0123456789":
+            return json.loads(self._token(_NUMBER_RE, "number"))
+        elif char in "tfn":
+            return _LITERALS[self._token(_LITERAL_RE, "literal")]
+        self._error("Expecting value")
+
+    def __iter__(self):
+        stack = []
+        state = _VALUE
+        while True:
+            char = self._next_char()
+            if state == _DONE:
+                if char is not None:
+                    self._error("Extra data")
+                return
+            if char is None:
+                self._error("Unexpected end of input")
+
+            if state in (_VALUE, _VALUE_OR_END):
+                if char == "]" and state == _VALUE_OR_END:
+                    self.pos += 1
+                    stack.pop()
+                    yield ("end_array", None)
+                elif char == "{":
+                    self.pos += 1
+                    stack.append("{")
+                    yield ("start_map", None)
+                    state = _KEY_OR_END
+                    continue
+                elif char == "[":
+                    self.pos += 1
+                    stack.append("[")
+                    yield ("start_array", None)
+                    state = _VALUE_OR_END
+                    continue
+                else:
+                    yield ("value", self._scalar(char))
+            elif state in (_KEY, _KEY_OR_END):
+                if char == "}" and state == _KEY_OR_END:
+                    self.pos += 1
+                    stack.pop()
+                    yield ("end_map", None)
+                elif char == '"':
+                    key = json.loads(self._token(_STRING_RE, "key"))
+                    if self._next_char() != ":":
+                        self._error("Expecting : delimiter")
+                    self.pos += 1
+                    yield ("map_key", key)
+                    state = _VALUE
                     continue
-                logging.debug("result[change_type] = %s, key = %s",
-                    unicode(result[change_type]), key)
-                logging.debug("self._is_incex_key = %s",
-                    self._is_incex_key(key, result[change_type][key]))
-                if not self._is_incex_key(key, result[change_type][key]):
-                    temp_dict[key] = result[change_type][key]
-            if len(temp_dict) > 0:
-                out_result[change_type] = temp_dict
+                else:
+                    self._error("Expecting property name")
+            else:
+                if char == ",":
+                    self.pos += 1
+                    if stack[-1] == "{":
+                        state = _KEY
+                    else:
+                        state = _VALUE
+                    continue
+                elif (char == "}" and stack[-1] == "{") or \
+                        (char == "]" and stack[-1] == "["):
+                    self.pos += 1
+                    stack.pop()
+                    if char == "}":
+                        yield ("end_map", None)
+                    else:
+                        yield ("end_array", None)
+                else:
+                    self._error("Expecting , delimiter")
 
-        return out_result
+            # a complete value has been generated
+            if stack:
+                state = _COMMA_OR_END
+            else:
+                state = _DONE
 
-    def _compare_elements(self, old, new):
-        """Unify decision making on the leaf node level."""
-        res = None
-        # We want to go through the tree post-order
-        if isinstance(old, dict):
-            res_dict = self.compare_dicts(old, new)
-            if (len(res_dict) > 0):
-                res = res_dict
-        # Now we are on the same level
-        # different types, new value is new
-        elif (type(old) != type(new)):
-            res = new
-        # recursive arrays
-        # we can be sure now, that both new and old are
-        # of the same type
-        elif (isinstance(old, list)):
-            res_arr = self._compare_arrays(old, new)
-            if (len(res_arr) > 0):
-                res = res_arr
-        # the only thing remaining are scalars
-        else:
-            scalar_diff = self._compare_scalars(old, new)
-            if scalar_diff is not None:
-                res = scalar_diff
 
-        return res
+def skip_value(events, event):
+    """Consume the value which starts with event from the iterator
+    of JSONEventParser events, without building it."""
+    if event == "value":
+        return
+    depth = 1
+    for event, _ in events:
+        if event in ("start_map", "start_array"):
+            depth += 1
+        elif event in ("end_map", "end_array"):
+            depth -= 1
+            if depth == 0:
+                return
 
-    def _compare_scalars(self, old, new, name=None):
-        """
-        Be careful with the result of this function. Negative answer from this
-        function is really None, not False, so deciding based on the return
-        value like in
 
-        if self._compare_scalars(...):
+def build_value(events, event, value):
+    """Materialize the value which starts with (event, value) from
+    the iterator of JSONEventParser events."""
+    if event == "value":
+        return value
+    if event == "start_map":
+        root = {}
+    else:
+        root = []
+    stack = [root]
+    keys = [None]
+    for event, value in events:
+        if event == "map_key":
+            keys[-1] = value
+            continue
+        if event in ("end_map", "end_array"):
+            stack.pop()
+            keys.pop()
+            if not stack:
+                return root
+            continue
+        if event == "start_map":
+            item = {}
+        elif event == "start_array":
+            item = []
+        else:
+            item = value
+        if isinstance(stack[-1], dict):
+            stack[-1][keys[-1]] = item
+        else:
+            stack[-1].append(item)
+        if event != "value":
+            stack.append(item)
+            keys.append(None)
+    raise BadJSONError("Cannot decode object from JSON.\n" +
+        "Unexpected end of input")
+
 
-        leads to wrong answer (it should be
-        if self._compare_scalars(...) is not None:)
-        """
-        # Explicitly excluded arguments
-        if old != new:
-            return new
+def pass_value(events, first):
+    """Events of the value which starts with the event first."""
+    yield first
+    if first[0] != "value":
+        depth = 1
+        for event, value in events:
+            yield event, value
+            if event in ("start_map", "start_array"):
+                depth += 1
+            elif event in ("end_map", "end_array"):
+                depth -= 1
+                if depth == 0:
+                    return
+
+
+def value_events(value):
+    """JSONEventParser events of the parsed value."""
+    # iterators of the items of the open objects and arrays
+    stack = []
+    while True:
+        if isinstance(value, LazyNode):
+            value = value.expand()
+        if isinstance(value, dict):
+            yield "start_map", None
+            stack.append(("end_map", value.iteritems()))
+        elif isinstance(value, (list, tuple)):
+            yield "start_array", None
+            stack.append(("end_array", iter(value)))
         else:
-            return None
+            yield "value", value
+        while stack:
+            end, items = stack[-1]
+            try:
+                value = next(items)
+            except StopIteration:
+                stack.pop()
+                yield end, None
+                continue
+            if end == "end_map":
+                yield "map_key", value[0]
+                value = value[1]
+            break
+        else:
+            return
 
-    def _compare_arrays(self, old_arr, new_arr):
-        """
-        simpler version of compare_dicts; just an internal method, because
-        it could never be called from outside.
 
-        We have it guaranteed that both new_arr and old_arr are of type list.
-        """
-        inters = min(len(old_arr), len(new_arr))  # this is the smaller length
+def iter_events_json(events):
+    """Generate compact JSON of the value given by JSONEventParser
+    events as a sequence of strings."""
+    # [is it an object, count of items] of the open objects and arrays
+    stack = []
+    for event, value in events:
+        if event == "map_key":
+            if stack[-1][1]:
+                yield u","
+            stack[-1][1] += 1
+            yield json.dumps(value, ensure_ascii=False) + u":"
+            continue
+        if event in ("end_map", "end_array"):
+            stack.pop()
+            yield event == "end_map" and u"}" or u"]"
+            if not stack:
+                return
+            continue
+        if stack and not stack[-1][0]:
+            if stack[-1][1]:
+                yield u","
+            stack[-1][1] += 1
+        if event == "value":
+            yield json.dumps(value, ensure_ascii=False)
+            if not stack:
+                return
+        else:
+            stack.append([event == "start_map", 0])
+            yield event == "start_map" and u"{" or u"["
 
-        result = {
-            u"_append": {},
-            u"_remove": {},
-            u"_update": {}
-        }
-        for idx in range(inters):
-            res = self._compare_elements(old_arr[idx], new_arr[idx])
-            if res is not None:
-                result[u'_update'][idx] = res
 
-        # the rest of the larger array
-        if (inters == len(old_arr)):
-            for idx in range(inters, len(new_arr)):
-                result[u'_append'][idx] = new_arr[idx]
+def patch_events(events, diff):
+    """
+    JSONEventParser events of the document given by events with the
+    result of Comparator.compare_dicts applied (as by apply_diff).
+
+    Objects with changes are patched while their events pass through,
+    only the changed arrays and the new values are built, so the memory
+    use does not grow with the size of the document.
+    """
+    if diff == {}:
+        return pass_value(events, next(events))
+    if is_replacement(diff):
+        skip_value(events, next(events)[0])
+        return value_events(diff[u"_replace"])
+    return _patch_events(events, next(events), diff)
+
+
+def _patch_events(events, first, change):
+    if first[0] == "start_array" and is_nested_diff([], change):
+        target = build_value(events, *first)
+        for event in value_events(apply_diff(target, change)):
+            yield event
+        return
+    if first[0] != "start_map" or not is_nested_diff({}, change):
+        skip_value(events, first[0])
+        for event in value_events(change):
+            yield event
+        return
+
+    yield first
+    removed = change.get(u"_remove", {})
+    updated = change.get(u"_update", {})
+    found = 0
+    for event, key in events:
+        if event == "end_map":
+            break
+        item_first = next(events)
+        if key in removed:
+            skip_value(events, item_first[0])
+            found += 1
+            continue
+        yield event, key
+        if key in updated:
+            found += 1
+            for item_event in _patch_events(events, item_first,
+                    updated[key]):
+                yield item_event
         else:
-            for idx in range(inters, len(old_arr)):
-                result[u'_remove'][idx] = old_arr[idx]
+            for item_event in pass_value(events, item_first):
+                yield item_event
+    if found != len(removed) + len(updated):
+        raise PatchError("Removed or updated keys are missing")
+    for key, value in change.get(u"_append", {}).iteritems():
+        yield "map_key", key
+        for item_event in value_events(value):
+            yield item_event
+    yield "end_map", None
 
-        # Clear out unused keys in result
-        out_result = {}
-        for key in result:
-            if len(result[key]) > 0:
-                out_result[key] = result[key]
 
-        return self._filter_results(result)
+def _middle_snake(a, b, a_lo, a_hi, b_lo, b_hi, max_d):
+    """Find the middle snake of the shortest edit script of
+    a[a_lo:a_hi] and b[b_lo:b_hi] (E. W. Myers, An O(ND) Difference
+    Algorithm and Its Variations, 1986, section 4b).
 
-    def compare_dicts(self, old_obj=None, new_obj=None):
-        """
-        The real workhorse
-        """
-        if not old_obj and hasattr(self, "obj1"):
-            old_obj = self.obj1
-        if not new_obj and hasattr(self, "obj2"):
-            new_obj = self.obj2
+    Returns (d, x, y, u, v), d being the edit distance and
+    (a_lo + x, b_lo + y) -> (a_lo + u, b_lo + v) the snake, or None when
+    the distance is larger than max_d.
+    """
+    n = a_hi - a_lo
+    m = b_hi - b_lo
+    delta = n - m
+    odd = delta % 2 != 0
+    offset = n + m + 1
+    v_fwd = [0] * (2 * offset + 1)
+    v_bwd = [0] * (2 * offset + 1)
+    for d in range(min((n + m + 1) // 2, max_d // 2 + 1) + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and
+                    v_fwd[offset + k - 1] < v_fwd[offset + k + 1]):
+                x = v_fwd[offset + k + 1]
+            else:
+                x = v_fwd[offset + k - 1] + 1
+            y = x - k
+            start_x, start_y = x, y
+            while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                x += 1
+                y += 1
+            v_fwd[offset + k] = x
+            if odd and delta - (d - 1) <= k <= delta + (d - 1) and \
+                    x + v_bwd[offset + delta - k] >= n:
+                return (2 * d - 1, start_x, start_y, x, y)
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and
+                    v_bwd[offset + k - 1] < v_bwd[offset + k + 1]):
+                x = v_bwd[offset + k + 1]
+            else:
+                x = v_bwd[offset + k - 1] + 1
+            y = x - k
+            start_x, start_y = x, y
+            while x < n and y < m and \
+                    a[a_hi - 1 - x] == b[b_hi - 1 - y]:
+                x += 1
+                y += 1
+            v_bwd[offset + k] = x
+            if not odd and -d <= delta - k <= d and \
+                    x + v_fwd[offset + delta - k] >= n:
+                return (2 * d, n - x, m - y, n - start_x, m - start_y)
+    return None
 
-        old_keys = set()
-        new_keys = set()
-        if old_obj and len(old_obj) > 0:
-            old_keys = set(old_obj.keys())
-        if new_obj and len(new_obj) > 0:
-            new_keys = set(new_obj.keys())
 
-        keys = old_keys | new_keys
+def lcs_matches(a, b, max_d=None):
+    """List of index pairs (i, j) with a[i] == b[j] forming the longest
+    common subsequence of a and b, found in linear space and O(ND) time.
 
-        result = {
-            "_append": {},
-            "_remove": {},
-            "_update": {}
-        }
-        for name in keys:
-            # old_obj is missing
-            if name not in old_obj:
-                result[u'_append'][name] = new_obj[name]
-            # new_obj is missing
-            elif name not in new_obj:
-                result[u'_remove'][name] = old_obj[name]
+    None is returned when the sequences differ in more than max_d
+    insertions and deletions (and the difference is not just a block
+    inserted or deleted between their common prefix and suffix).
+    """
+    if max_d is None:
+        max_d = len(a) + len(b)
+    matches = []
+    # (a_lo, a_hi, b_lo, b_hi) ranges still to be aligned
+    work = [(0, len(a), 0, len(b))]
+    top_level = True
+    while work:
+        a_lo, a_hi, b_lo, b_hi = work.pop()
+        # common prefix and suffix
+        while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+            matches.append((a_lo, b_lo))
+            a_lo += 1
+            b_lo += 1
+        while a_lo < a_hi and b_lo < b_hi and a[a_hi - 1] == b[b_hi - 1]:
+            a_hi -= 1
+            b_hi -= 1
+            matches.append((a_hi, b_hi))
+        if a_lo == a_hi or b_lo == b_hi:
+            top_level = False
+            continue
+        if top_level:
+            snake = _middle_snake(a, b, a_lo, a_hi, b_lo, b_hi, max_d)
+            if snake is None or snake[0] > max_d:
+                return None
+            top_level = False
+        else:
+            snake = _middle_snake(a, b, a_lo, a_hi, b_lo, b_hi,
+                a_hi - a_lo + b_hi - b_lo)
+        dist, x, y, u, v = snake
+        for i in range(u - x):
+            matches.append((a_lo + x + i, b_lo + y + i))
+        work.append((a_lo, a_lo + x, b_lo, b_lo + y))
+        work.append((a_lo + u, a_hi, b_lo + v, b_hi))
+    matches.sort()
+    return matches
+
+
+def longest_increasing(seq):
+    """Indices of a longest strictly increasing subsequence of seq."""
+    tails = []      # last values of the increasing runs of each length
+    tail_idx = []   # ... and their indices
+    previous = [None] * len(seq)
+    for idx, value in enumerate(seq):
+        pos = bisect_left(tails, value)
+        if pos > 0:
+            previous[idx] = tail_idx[pos - 1]
+        if pos == len(tails):
+            tails.append(value)
+            tail_idx.append(idx)
+        else:
+            tails[pos] = value
+            tail_idx[pos] = idx
+    out = []
+    if tail_idx:
+        idx = tail_idx[-1]
+        while idx is not None:
+            out.append(idx)
+            idx = previous[idx]
+    out.reverse()
+    return out
+
+
+def min_cost_matching(cost):
+    """Assignment of rows to columns of the square cost matrix with the
+    minimal total cost (Hungarian method, O(n^3)).
+
+    Returns list of column indices, one for each row.
+    """
+    size = len(cost)
+    big = 1
+    for row in cost:
+        big += sum(row)
+    u = [0] * (size + 1)
+    v = [0] * (size + 1)
+    p = [0] * (size + 1)    # row assigned to a column, 1-based
+    way = [0] * (size + 1)
+    for row in range(1, size + 1):
+        p[0] = row
+        col0 = 0
+        minv = [big] * (size + 1)
+        used = [False] * (size + 1)
+        while True:
+            used[col0] = True
+            row0 = p[col0]
+            delta = big
+            col1 = 0
+            for col in range(1, size + 1):
+                if not used[col]:
+                    cur = cost[row0 - 1][col - 1] - u[row0] - v[col]
+                    if cur < minv[col]:
+                        minv[col] = cur
+                        way[col] = col0
+                    if minv[col] < delta:
+                        delta = minv[col]
+                        col1 = col
+            for col in range(size + 1):
+                if used[col]:
+                    u[p[col]] += delta
+                    v[col] -= delta
+                else:
+                    minv[col] -= delta
+            col0 = col1
+            if p[col0] == 0:
+                break
+        while col0:
+            col1 = way[col0]
+            p[col0] = p[col1]
+            col0 = col1
+    assignment = [0] * size
+    for col in range(1, size + 1):
+        assignment[p[col] - 1] = col - 1
+    return assignment
+
+
+def tree_size(value):
+    """Number of nodes of the JSON value."""
+    count = 0
+    stack = [value]
+    while stack:
+        node = stack.pop()
+        count += 1
+        if isinstance(node, dict):
+            stack.extend(node.values())
+        elif isinstance(node, list):
+            stack.extend(node)
+    return count
+
+
+_JSONPATH_RE = re.compile(r"""
+    \.\.(?P<deep>[^.[]*)                  # ..name (any depth)
+    | \.(?P<name>[^.[]+)                  # .name
+    | \[\s*(?:'(?P<squoted>[^']*)'        # ['name']
+            | "(?P<dquoted>[^"]*)"        # ["name"]
+            | (?P<index>[^]'"]*?))\s*\]   # [0] or [*]
+    """, re.VERBOSE)
+
+
+def _jsonpath_parts(pattern):
+    """Split JSONPath-like pattern ($.a..b[*]) into components of a
+    PathPattern."""
+    parts = []
+    pos = 1
+    while pos < len(pattern):
+        match = _JSONPATH_RE.match(pattern, pos)
+        if match is None:
+            raise ValueError("Cannot parse path %r at %d" % (pattern, pos))
+        if match.group("deep") is not None:
+            parts.append("**")
+            if match.group("deep"):
+                parts.append(match.group("deep"))
+        else:
+            for group in ("name", "squoted", "dquoted", "index"):
+                if match.group(group) is not None:
+                    parts.append(match.group(group))
+                    break
+        pos = match.end()
+    return parts
+
+
+class PathPattern(object):
+    """
+    Glob-like pattern matching paths (tuples of keys and indices) of values
+    in a document.
+
+    Components of the pattern are separated by "/" and matched like
+    shell globs, "**" matches any number of components. Patterns not
+    starting with "/" match at any depth, e.g. "items" is "/**/items".
+    Slash and tilde in keys are escaped as "~1" and "~0" (as in JSON
+    pointers). Patterns starting with "$" are JSONPath-like: "$.a[*].b",
+    "$..b" are "/a/*/b" and "/**/b".
+    """
+    def __init__(self, pattern):
+        self.pattern = pattern
+        if pattern.startswith("$"):
+            parts = _jsonpath_parts(pattern)
+        elif pattern.startswith("/"):
+            parts = [part.replace("~1", "/").replace("~0", "~")
+                for part in pattern[1:].split("/") if part != ""]
+        else:
+            parts = ["**"] + [part.replace("~1", "/").replace("~0", "~")
+                for part in pattern.split("/") if part != ""]
+        self.parts = []
+        for part in parts:
+            if part == "**":
+                self.parts.append(part)
+            elif re.search(r"[*?[]", part):
+                self.parts.append(re.compile(translate(part)))
             else:
-                res = self._compare_elements(old_obj[name], new_obj[name])
-                if res is not None:
-                    result[u'_update'][name] = res
+                self.parts.append(part)
+        # "**/a/b" patterns (like plain key names) just match path suffixes
+        self._suffix = None
+        if self.parts and self.parts[0] == "**" and \
+                "**" not in self.parts[1:]:
+            self._suffix = self.parts[1:]
 
-        return self._filter_results(result)
+    def __repr__(self):
+        return "PathPattern(%r)" % self.pattern
 
+    def _part_matches(self, part, component):
+        if not isinstance(component, basestring):
+            component = unicode(component)
+        if isinstance(part, basestring):
+            return part == component
+        return part.match(component) is not None
 
-def main(sys_args):
-    """Main function, to process command line arguments etc."""
-    usage = "usage: %prog [options] old.json new.json"
-    parser = OptionParser(usage=usage)
-    parser.add_option("-x", "--exclude",
-      action="append", dest="exclude", metavar="ATTR", default=[],
-      help="attributes which should be ignored when comparing")
-    parser.add_option("-i", "--include",
-      action="append", dest="include", metavar="ATTR", default=[],
-      help="attributes which should be exclusively used when comparing")
-    parser.add_option("-a", "--ignore-append",
-      action="store_true", dest="ignore_append", metavar="BOOL", default=False,
-      help="ignore appended keys")
-    parser.add_option("-H", "--HTML",
-      action="store_true", dest="HTMLoutput", metavar="BOOL", default=False,
-      help="program should output to HTML report")
-    (options, args) = parser.parse_args(sys_args[1:])
+    def _closure(self, states):
+        """Add states reachable by skipping "**" parts."""
+        out = set(states)
+        for state in states:
+            while state < len(self.parts) and self.parts[state] == "**":
+                state += 1
+                out.add(state)
+        return out
 
-    if len(args) != 2:
-        parser.error("Script requires two positional arguments, " + \
-            "names for old and new JSON file.")
-    diff = Comparator(open(args[0]), open(args[1]), options)
-    diff_res = diff.compare_dicts()
-    if options.HTMLoutput:
-        # we want to hardcode UTF-8 here, because that's what's
-        # in <meta> element of the generated HTML
-        print(unicode(HTMLFormatter(diff_res)).encode("utf-8"))
-    else:
-        outs = json.dumps(diff_res, indent=4, ensure_ascii=False)
-        print(outs.encode("utf-8"))
+    def _states(self, path):
+        """Indices of the parts which may follow the path."""
+        parts = self.parts
+        states = self._closure([0])
+        for component in path:
+            next_states = []
+            for state in states:
+                if state == len(parts):
+                    continue
+                if parts[state] == "**":
+                    next_states.append(state)
+                elif self._part_matches(parts[state], component):
+                    next_states.append(state + 1)
+            if not next_states:
+                return set()
+            states = self._closure(next_states)
+        return states
 
-    if len(diff_res) > 0:
-        return 1
+    def matches(self, path):
+        """Does the whole path match the pattern?"""
+        if self._suffix is not None:
+            suffix = self._suffix
+            if len(path) < len(suffix):
+                return False
+            offset = len(path) - len(suffix)
+            for idx in range(len(suffix)):
+                if not self._part_matches(suffix[idx], path[offset + idx]):
+                    return False
+            return True
+        return len(self.parts) in self._states(path)
+
+    def may_match_below(self, path):
+        """May a path continuing the path match the pattern?"""
+        if self._suffix is not None:
+            return True
+        for state in self._states(path):
+            if state < len(self.parts):
+                return True
+        return False
+
+
+def parse_array_keys(specs):
+    """Parse PATH=FIELD[,FIELD...] declarations of identity keys of
+    array elements into a list of (PathPattern, fields) pairs."""
+    out = []
+    for spec in specs or []:
+        if "=" not in spec:
+            raise ValueError("Array key %r is not in PATH=FIELD form" % spec)
+        path, fields = spec.rsplit("=", 1)
+        fields = tuple([field for field in fields.split(",") if field])
+        if not fields:
+            raise ValueError("Array key %r names no field" % spec)
+        out.append((PathPattern(path), fields))
+    return out
+
+
+class SubtreeDigests(object):
+    """
+    Canonical content hashes of the subtrees of parsed JSON documents.
+
+    Digests are computed bottom-up, once per node, and remembered by the
+    identity of the node; the digested roots are kept referenced, so the
+    identities stay valid as long as the trees are not modified.
+    Equal digests mean equal subtrees, including the types of scalars
+    (1 and 1.0 differ, as they do for Comparator).
+    """
+    def __init__(self):
+        self._memo = {}
+        self._roots = []
+
+    def digest(self, node):
+        """Binary digest of a container, canonical JSON of a scalar."""
+        if not isinstance(node, (dict, list)):
+            return scalar_json(node)
+        node_id = id(node)
+        if node_id not in self._memo:
+            self._roots.append(node)
+            self._digest_tree(node)
+        return self._memo[node_id]
+
+    def hexdigest(self, node):
+        """Printable digest of any JSON value."""
+        if not isinstance(node, (dict, list)):
+            return sha1(self.digest(node)).hexdigest()
+        return self.digest(node).encode("hex")
+
+    def _digest_tree(self, node):
+        memo = self._memo
+        # post-order walk: a node is digested when its children are
+        stack = [node]
+        while stack:
+            node = stack[-1]
+            if id(node) in memo:
+                stack.pop()
+                continue
+            if isinstance(node, dict):
+                children = node.itervalues()
+            else:
+                children = node
+            pending = [value for value in children
+                if isinstance(value, (dict, list)) and id(value) not in memo]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+
+            if isinstance(node, dict):
+                hsh = sha1("{")
+                items = sorted(node.items())
+            else:
+                hsh = sha1("[")
+                items = enumerate(node)
+            for key, value in items:
+                if isinstance(key, basestring):
+                    hsh.update(_encode_string(key))
+                    hsh.update(":")
+                if isinstance(value, (dict, list)):
+                    hsh.update("#")
+                    hsh.update(memo[id(value)])
+                else:
+                    hsh.update(scalar_json(value))
+                hsh.update(",")
+            memo[id(node)] = hsh.digest()
+
+
+class EventDigest(object):
+    """
+    SubtreeDigests.hexdigest of a value computed from its JSONEventParser
+    events, without building the value (only the digests of the members
+    of the open objects are kept, as they have to be sorted).
+    """
+    def __init__(self):
+        # [object members or array hash, last key] of the open values
+        self._stack = []
+        self.hexdigest = None
+
+    def feed(self, event, value):
+        """Digest the next event of the value."""
+        stack = self._stack
+        if event == "map_key":
+            stack[-1][1] = value
+            return
+        if event == "start_map":
+            stack.append([[], None])
+            return
+        if event == "start_array":
+            stack.append([sha1("["), None])
+            return
+        if event == "end_map":
+            hsh = sha1("{")
+            for key, entry in sorted(stack.pop()[0]):
+                hsh.update(_encode_string(key))
+                hsh.update(":")
+                hsh.update(entry)
+                hsh.update(",")
+            entry = "#" + hsh.digest()
+        elif event == "end_array":
+            entry = "#" + stack.pop()[0].digest()
+        else:
+            entry = scalar_json(value)
+        if not stack:
+            if entry.startswith("#"):
+                self.hexdigest = entry[1:].encode("hex")
+            else:
+                self.hexdigest = sha1(entry).hexdigest()
+        elif isinstance(stack[-1][0], list):
+            stack[-1][0].append((stack[-1][1], entry))
+        else:
+            stack[-1][0].update(entry)
+            stack[-1][0].update(",")
+
+    def tee(self, events):
+        """Pass the events through, digesting them."""
+        for event, value in events:
+            self.feed(event, value)
+            yield event, value
+
+
+_STRUCTURE_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[][{}]')
+_CLOSING = {"{": "}", "[": "]"}
+# how much of two texts is compared at once by LazyNode.same_text
+COMPARE_BLOCK = 1024 * 1024
+
+
+class LazyDocument(object):
+    """
+    JSON document in a memory-mapped file, parsed only when needed.
 
+    On loading only the structural index is built: offsets of the starts
+    and ends of all objects and arrays. The values are parsed when the
+    objects and arrays containing them are expanded (see LazyNode).
+    Beware that the document is not validated beyond its structure.
+    """
+    def __init__(self, fileobj):
+        try:
+            self.data = mmap.mmap(fileobj.fileno(), 0,
+                access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError), exc:
+            raise BadJSONError("Cannot map JSON file.\n%s" % exc)
+        self.starts = array("l")
+        self.ends = array("l")
+        data = self.data
+        stack = []
+        for match in _STRUCTURE_RE.finditer(data):
+            pos = match.start()
+            char = data[pos]
+            if char in "{[":
+                stack.append(len(self.starts))
+                self.starts.append(pos)
+                self.ends.append(-1)
+            elif char in "}]":
+                if not stack or \
+                        _CLOSING[data[self.starts[stack[-1]]]] != char:
+                    self._error("Unexpected %s" % char, pos)
+                self.ends[stack.pop()] = pos + 1
+        if stack:
+            self._error("Unexpected end of input", len(data))
+
+        pos = _WS_RE.match(data, 0).end()
+        if self.starts and self.starts[0] == pos:
+            if _WS_RE.match(data, self.ends[0]).end() != len(data):
+                self._error("Extra data", self.ends[0])
+            self.root = LazyNode(self, pos, self.ends[0])
+        else:
+            self.root = load_json_text(data[:])
+
+    def _error(self, msg, pos):
+        raise BadJSONError("Cannot decode object from JSON.\n%s (char %d)" %
+            (msg, pos))
+
+    def close(self):
+        """Unmap the file; the nodes cannot be expanded afterwards."""
+        self.data.close()
+
+    def end_of(self, start):
+        """End offset of the object or array starting at start."""
+        return self.ends[bisect_left(self.starts, start)]
+
+    def value_at(self, pos):
+        """Value starting at pos and the offset after it; objects and
+        arrays are returned as LazyNodes."""
+        data = self.data
+        char = data[pos:pos + 1]
+        if char in ("{", "["):
+            end = self.end_of(pos)
+            return LazyNode(self, pos, end), end
+        if char == '"':
+            regex = _STRING_RE
+        elif char in ("t", "f", "n"):
+            regex = _LITERAL_RE
+        else:
+            regex = _NUMBER_RE
+        match = regex.match(data, pos)
+        if match is None:
+            self._error("Expecting value", pos)
+        return load_json_text(data[pos:match.end()]), match.end()
+
+
+class LazyNode(object):
+    """Object or array of a LazyDocument, not parsed yet."""
+    __slots__ = ("doc", "start", "end")
+
+    def __init__(self, doc, start, end):
+        self.doc = doc
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return "<LazyNode %d-%d>" % (self.start, self.end)
+
+    def is_array(self):
+        return self.doc.data[self.start] == "["
+
+    def load(self):
+        """Parse the whole subtree."""
+        return load_json_text(self.doc.data[self.start:self.end])
+
+    def same_text(self, other):
+        """Are the texts of both nodes identical?"""
+        if not isinstance(other.doc, LazyDocument) or \
+                self.end - self.start != other.end - other.start:
+            return False
+        if self.doc is other.doc and self.start == other.start:
+            return True
+        offset = 0
+        while offset < self.end - self.start:
+            size = min(COMPARE_BLOCK, self.end - self.start - offset)
+            if self.doc.data[self.start + offset:
+                    self.start + offset + size] != \
+                    other.doc.data[other.start + offset:
+                    other.start + offset + size]:
+                return False
+            offset += size
+        return True
+
+    def expand(self):
+        """The dict or list of the node; nested objects and arrays
+        stay LazyNodes."""
+        doc = self.doc
+        data = doc.data
+        is_array = data[self.start] == "["
+        if is_array:
+            out = []
+        else:
+            out = {}
+        pos = _WS_RE.match(data, self.start + 1).end()
+        if pos == self.end - 1:
+            return out
+        while True:
+            if not is_array:
+                match = _STRING_RE.match(data, pos)
+                if match is None:
+                    doc._error("Expecting property name", pos)
+                key = load_json_text(data[pos:match.end()])
+                pos = _WS_RE.match(data, match.end()).end()
+                if data[pos:pos + 1] != ":":
+                    doc._error("Expecting : delimiter", pos)
+                pos = _WS_RE.match(data, pos + 1).end()
+            value, pos = doc.value_at(pos)
+            if is_array:
+                out.append(value)
+            else:
+                out[key] = value
+            pos = _WS_RE.match(data, pos).end()
+            if pos == self.end - 1:
+                return out
+            if data[pos:pos + 1] != ",":
+                doc._error("Expecting , delimiter", pos)
+            pos = _WS_RE.match(data, pos + 1).end()
+
+    def text(self):
+        """JSON text of the node."""
+        return self.doc.data[self.start:self.end]
+
+
+def plain(value):
+    """Value with LazyNodes parsed."""
+    if isinstance(value, LazyNode):
+        return value.load()
+    return value
+
+
+def json_text(value):
+    """Serialize the value to compact JSON (without recursion), texts of
+    LazyNodes are used as such."""
+    if isinstance(value, LazyNode):
+        return value.text()
+    return u"".join(iter_json(value, compact=True))
+
+
+def load_json_text(text):
+    """json.loads raising BadJSONError; documents nested too deeply for
+    json are parsed by JSONEventParser."""
+    try:
+        return json.loads(text)
+    except (TypeError, OverflowError, ValueError), exc:
+        raise BadJSONError("Cannot decode object from JSON.\n%s" %
+            unicode(exc))
+    except RuntimeError:
+        # maximum recursion depth exceeded
+        events = iter(JSONEventParser(StringIO(text)))
+        value = build_value(events, *next(events))
+        for _ in events:
+            pass
+        return value
+
+
+def load_json(fileobj):
+    """json.load raising BadJSONError (snapshots are loaded as well)."""
+    if is_snapshot(fileobj):
+        return plain(SnapshotDocument(fileobj).root)
+    return load_json_text(fileobj.read())
+
+
+def file_events(fileobj, chunk_size=CHUNK_SIZE):
+    """JSONEventParser events of the document in fileobj (which may be
+    a snapshot)."""
+    if is_snapshot(fileobj):
+        return value_events(SnapshotDocument(fileobj).root)
+    return iter(JSONEventParser(fileobj, chunk_size))
+
+
+def load_json_file(name):
+    """Load JSON document from the file called name."""
+    fileobj = open(name)
+    try:
+        try:
+            return load_json(fileobj)
+        except BadJSONError, exc:
+            raise BadJSONError("%s: %s" % (name, exc))
+    finally:
+        fileobj.close()
+
+
+SNAPSHOT_MAGIC = "JDSNAP1\n"
+# magic, root item, offset and count of the interned keys
+_SNAPSHOT_HEADER = struct.Struct("<8s9sQI")
+# type, number of members and digest of an object or array
+_RECORD = struct.Struct("<cI20s")
+# items of values are their type and 8 bytes of content (or offset)
+_ITEM_FORMAT = "c8s"
+_INT64 = struct.Struct("<q")
+_FLOAT64 = struct.Struct("<d")
+_OFFSET = struct.Struct("<Q")
+_LENGTH = struct.Struct("<I")
+_ITEM_CONSTANTS = {"n": None, "t": True, "f": False}
+_INT64_MIN = -2 ** 63
+_INT64_MAX = 2 ** 63 - 1
+
+
+def is_snapshot(fileobj):
+    """Does the file start with SNAPSHOT_MAGIC? (The position in the
+    file is kept.)"""
+    try:
+        pos = fileobj.tell()
+        head = fileobj.read(len(SNAPSHOT_MAGIC))
+        fileobj.seek(pos)
+    except (AttributeError, EnvironmentError):
+        return False
+    return head == SNAPSHOT_MAGIC
+
+
+class SnapshotWriter(object):
+    """
+    Compile parsed JSON values into snapshots (see SnapshotDocument).
+
+    Objects and arrays are written after their members, as records of
+    their type, number of members and SubtreeDigests digest, followed by
+    fixed-size items of the members (so members can be read without
+    reading their predecessors). Keys of objects are written once and
+    referenced by their numbers; arrays of integers or of floats are
+    written packed as 64-bit numbers.
+    """
+    def __init__(self, out):
+        self.out = out
+        self.pos = 0
+        self.keys = {}
+        self.key_offsets = []
+
+    def _write(self, data):
+        offset = self.pos
+        self.out.write(data)
+        self.pos += len(data)
+        return offset
+
+    def _string(self, text):
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
+        return self._write(_LENGTH.pack(len(text)) + text)
+
+    def _key(self, key):
+        number = self.keys.get(key)
+        if number is None:
+            number = self.keys[key] = len(self.key_offsets)
+            self.key_offsets.append(self._string(key))
+        return number
+
+    def _item(self, value):
+        """Item of a scalar value."""
+        if value is None:
+            return "n" + "\0" * 8
+        elif value is True:
+            return "t" + "\0" * 8
+        elif value is False:
+            return "f" + "\0" * 8
+        elif isinstance(value, (int, long)):
+            if _INT64_MIN <= value <= _INT64_MAX:
+                return "i" + _INT64.pack(value)
+            return "L" + _OFFSET.pack(self._string(str(value)))
+        elif isinstance(value, float):
+            return "d" + _FLOAT64.pack(value)
+        return "s" + _OFFSET.pack(self._string(value))
+
+    def _record(self, node, items, entries):
+        """Write the object or array node with the items of its members,
+        return its item and digest."""
+        if isinstance(node, dict):
+            hsh = sha1("{")
+            for key, entry in entries:
+                hsh.update(_encode_string(key))
+                hsh.update(":")
+                hsh.update(entry)
+                hsh.update(",")
+            numbers = [self._key(key) for key, entry in entries]
+            body = struct.pack("<%dI" % len(numbers), *numbers) + \
+                "".join(items)
+            tag = "o"
+        else:
+            hsh = sha1("[")
+            for entry in entries:
+                hsh.update(entry)
+                hsh.update(",")
+            tag = "a"
+            types = set(imap(type, node))
+            if node and types <= _NUMBERS:
+                if types == set([float]):
+                    tag = "D"
+                elif float not in types and \
+                        _INT64_MIN <= min(node) and max(node) <= _INT64_MAX:
+                    tag = "I"
+            if tag == "a":
+                body = "".join(items)
+            else:
+                body = struct.pack("<%d%s" % (len(node),
+                    tag == "D" and "d" or "q"), *node)
+        digest = hsh.digest()
+        offset = self._write(_RECORD.pack(tag, len(node), digest) + body)
+        return "c" + _OFFSET.pack(offset), digest
+
+    def write(self, value):
+        """Write the whole snapshot of value."""
+        self._write(_SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, "\0" * 9, 0, 0))
+        if isinstance(value, (dict, list)):
+            root = None
+            # [node, iterator of members, items, digest entries, key]
+            # of the open objects and arrays
+            stack = [self._frame(value)]
+            while stack:
+                frame = stack[-1]
+                node, members, items, entries = frame[:4]
+                is_dict = isinstance(node, dict)
+                for key, member in members:
+                    if isinstance(member, (dict, list)):
+                        frame[4] = key
+                        stack.append(self._frame(member))
+                        break
+                    items.append(self._item(member))
+                    if is_dict:
+                        entries.append((key, scalar_json(member)))
+                    else:
+                        entries.append(scalar_json(member))
+                else:
+                    stack.pop()
+                    item, digest = self._record(node, items, entries)
+                    if not stack:
+                        root = item
+                        continue
+                    parent = stack[-1]
+                    parent[2].append(item)
+                    if isinstance(parent[0], dict):
+                        parent[3].append((parent[4], "#" + digest))
+                    else:
+                        parent[3].append("#" + digest)
+        else:
+            root = self._item(value)
+
+        keys_offset = self._write(struct.pack("<%dQ" %
+            len(self.key_offsets), *self.key_offsets))
+        self.out.seek(0)
+        self.out.write(_SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, root,
+            keys_offset, len(self.key_offsets)))
+        self.out.seek(self.pos)
+
+    @staticmethod
+    def _frame(node):
+        if isinstance(node, dict):
+            members = iter(sorted(node.iteritems()))
+        else:
+            members = enumerate(node)
+        return [node, members, [], [], None]
+
+
+def write_snapshot(value, out):
+    """Write snapshot of the parsed JSON value to the (seekable, binary)
+    file object out."""
+    SnapshotWriter(out).write(value)
+
+
+class SnapshotDocument(object):
+    """
+    Snapshot of a JSON document written by write_snapshot, read lazily.
+
+    The file is memory-mapped and only the interned keys are read on
+    opening, objects and arrays are read when expanded (SnapshotNode);
+    comparing the digests of subtrees replaces comparing their content.
+    """
+    def __init__(self, fileobj):
+        try:
+            self.data = mmap.mmap(fileobj.fileno(), 0,
+                access=mmap.ACCESS_READ)
+        except (AttributeError, EnvironmentError, ValueError):
+            # not a real file
+            self.data = fileobj.read()
+        data = self.data
+        if len(data) < _SNAPSHOT_HEADER.size or \
+                data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise BadJSONError("Not a json_diff snapshot.")
+        try:
+            magic, root, keys_offset, key_count = \
+                _SNAPSHOT_HEADER.unpack_from(data, 0)
+            self.keys = [self.string_at(offset) for offset in
+                struct.unpack_from("<%dQ" % key_count, data, keys_offset)]
+            self.root = self.value(root[0], root[1:])
+        except struct.error, exc:
+            raise BadJSONError("Broken json_diff snapshot.\n%s" % exc)
+
+    def close(self):
+        """Unmap the file; the nodes cannot be read afterwards."""
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def string_at(self, offset):
+        size = _LENGTH.unpack_from(self.data, offset)[0]
+        offset += _LENGTH.size
+        return self.data[offset:offset + size].decode("utf-8")
+
+    def value(self, tag, content):
+        """Value of the item; objects and arrays are SnapshotNodes."""
+        if tag == "s":
+            offset = _OFFSET.unpack(content)[0]
+            size = _LENGTH.unpack_from(self.data, offset)[0]
+            offset += _LENGTH.size
+            return self.data[offset:offset + size].decode("utf-8")
+        elif tag == "i":
+            return _INT64.unpack(content)[0]
+        elif tag == "c":
+            return SnapshotNode(self, _OFFSET.unpack(content)[0])
+        elif tag == "d":
+            return _FLOAT64.unpack(content)[0]
+        elif tag == "L":
+            return long(self.string_at(_OFFSET.unpack(content)[0]))
+        return _ITEM_CONSTANTS[tag]
+
+
+class SnapshotNode(LazyNode):
+    """Object or array of a SnapshotDocument, not read yet (start is the
+    offset of its record)."""
+    __slots__ = ()
+
+    def __init__(self, doc, start):
+        LazyNode.__init__(self, doc, start, None)
+
+    def __repr__(self):
+        return "<SnapshotNode %d>" % self.start
+
+    def is_array(self):
+        return self.doc.data[self.start] != "o"
+
+    def digest(self):
+        """SubtreeDigests digest of the node."""
+        return _RECORD.unpack_from(self.doc.data, self.start)[2]
+
+    def same_text(self, other):
+        """Are the digests of both nodes identical?"""
+        return isinstance(other, SnapshotNode) and \
+            self.digest() == other.digest()
+
+    def expand(self):
+        """The dict or list of the node; nested objects and arrays
+        stay SnapshotNodes."""
+        doc = self.doc
+        data = doc.data
+        tag, count, digest = _RECORD.unpack_from(data, self.start)
+        pos = self.start + _RECORD.size
+        if tag == "I":
+            return list(struct.unpack_from("<%dq" % count, data, pos))
+        elif tag == "D":
+            return list(struct.unpack_from("<%dd" % count, data, pos))
+        if tag == "o":
+            keys = doc.keys
+            numbers = struct.unpack_from("<%dI" % count, data, pos)
+            pos += count * _LENGTH.size
+        items = struct.unpack_from("<" + _ITEM_FORMAT * count, data, pos)
+        value = doc.value
+        values = [value(items[idx], items[idx + 1])
+            for idx in xrange(0, 2 * count, 2)]
+        if tag == "o":
+            return dict(zip([keys[number] for number in numbers], values))
+        return values
+
+    def load(self):
+        """Read the whole subtree."""
+        root = self.expand()
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, dict):
+                members = node.items()
+            else:
+                members = enumerate(node)
+            for key, value in members:
+                if isinstance(value, SnapshotNode):
+                    node[key] = value.expand()
+                    stack.append(node[key])
+        return root
+
+    def text(self):
+        return u"".join(iter_json(self.load(), compact=True))
+
+
+_KIND_NAMES = {_SCALAR: "scalar", _OBJECT: "object", _ARRAY: "array"}
+
+
+class ComparatorStats(object):
+    """
+    Where the comparison spends its time, collected by Comparator with the
+    stats option (Comparator.stats is None without it).
+
+    timings are the seconds spent in the phases: parse, compare_dicts
+    (which includes compare_arrays, the alignment of arrays),
+    filter_results and format. nodes counts the compared pairs of values
+    by their type, max_depth is the deepest of them, largest_arrays are
+    (length, path) of the longest compared arrays and pruned counts the
+    subtrees skipped as identical by their digests or texts.
+    """
+    def __init__(self):
+        self.timings = {}
+        self.nodes = {"object": 0, "array": 0, "scalar": 0}
+        self.max_depth = 0
+        self.pruned = 0
+        # heap of (length, path) of the largest arrays
+        self._largest = []
+        self._running = set()
+
+    @contextmanager
+    def timer(self, phase):
+        """Add the time spent in the with block to phase (nested blocks of
+        the same phase are counted once)."""
+        if phase in self._running:
+            yield
+            return
+        self._running.add(phase)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._running.discard(phase)
+            self.timings[phase] = self.timings.get(phase, 0.0) + \
+                time.time() - start
+
+    def node(self, old, new, path):
+        """Count the pair of values compared on path."""
+        kind = kind_of(old)
+        if kind == _ARRAY and kind_of(new) == _ARRAY:
+            self.count(kind, path, max(len(old), len(new)))
+        else:
+            self.count(kind, path)
+
+    def count(self, kind, path, length=None):
+        """Count a pair of values compared on path, the old one of kind;
+        length is the longer one of two compared arrays."""
+        self.nodes[_KIND_NAMES[kind]] += 1
+        self.max_depth = max(self.max_depth, len(path))
+        if length is not None:
+            self._add_array((length, path))
+
+    def _add_array(self, entry):
+        if len(self._largest) < STATS_LARGEST_ARRAYS:
+            heappush(self._largest, entry)
+        else:
+            heappushpop(self._largest, entry)
+
+    def add(self, other):
+        """Add the counts of other (collected by a worker process) to
+        these; its timings are left out, as they overlap with those of
+        the process waiting for it."""
+        for kind in other.nodes:
+            self.nodes[kind] += other.nodes[kind]
+        self.max_depth = max(self.max_depth, other.max_depth)
+        for entry in other._largest:
+            self._add_array(entry)
+        self.pruned += other.pruned
+
+    @property
+    def largest_arrays(self):
+        return sorted(self._largest, reverse=True)
+
+    def as_dict(self):
+        """The statistics as a JSON-serializable dict."""
+        return {
+            "timings": self.timings,
+            "nodes": self.nodes,
+            "max_depth": self.max_depth,
+            "largest_arrays": [{"length": length, "path": json_pointer(path)}
+                for length, path in self.largest_arrays],
+            "pruned": self.pruned,
+        }
+
+
+@contextmanager
+def stats_timer(stats, phase):
+    """ComparatorStats.timer of stats, doing nothing when stats is None."""
+    if stats is None:
+        yield
+    else:
+        with stats.timer(phase):
+            yield
+
+
+def timed(phase):
+    """Decorator of Comparator methods adding their time to phase of
+    self.stats (when there are stats)."""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.stats is None:
+                return method(self, *args, **kwargs)
+            with self.stats.timer(phase):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Comparator(object):
+    """
+    Main workhorse, the object itself
+    """
+    def __init__(self, fn1=None, fn2=None, opts=None):
+        self.excluded_attributes = []
+        self.included_attributes = []
+        self.ignore_appended = False
+        self.prune_identical = False
+        self.array_align = "position"
+        self.align_cutoff = ALIGN_CUTOFF
+        self.array_keys = []
+        self.backend = "default"
+        self.jobs = 1
+        self.lazy = False
+        self.abs_tol = 0.0
+        self.rel_tol = 0.0
+        self.stats = None
+        if opts:
+            self.excluded_attributes = opts.exclude or []
+            self.included_attributes = opts.include or []
+            self.ignore_appended = opts.ignore_append or False
+            self.prune_identical = getattr(opts, "prune_identical", False)
+            self.array_align = getattr(opts, "array_align", None) or \
+                self.array_align
+            if getattr(opts, "align_cutoff", None) is not None:
+                self.align_cutoff = opts.align_cutoff
+            self.array_keys = parse_array_keys(getattr(opts, "array_keys",
+                None))
+            self.backend = getattr(opts, "backend", None) or self.backend
+            self.jobs = getattr(opts, "jobs", None) or self.jobs
+            self.lazy = getattr(opts, "lazy", False)
+            self.abs_tol = getattr(opts, "abs_tol", None) or self.abs_tol
+            self.rel_tol = getattr(opts, "rel_tol", None) or self.rel_tol
+            if getattr(opts, "stats", False):
+                self.stats = ComparatorStats()
+        self.opts = opts
+        if self.abs_tol < 0 or self.rel_tol < 0:
+            raise ValueError("Tolerance cannot be negative")
+        # numbers are compared by value within the tolerance
+        self._tolerant = bool(self.abs_tol or self.rel_tol)
+        if self.lazy:
+            # comparing texts of lazily loaded subtrees replaces hashing
+            self.prune_identical = False
+        if self.array_align not in ARRAY_ALIGNMENTS:
+            raise ValueError("Unknown array alignment %s" % self.array_align)
+        if self.backend not in BACKENDS:
+            raise ValueError("Unknown backend %s" % self.backend)
+
+        # -x and -i compiled to path patterns, see _filter_key
+        self.excluded = [PathPattern(pattern)
+            for pattern in self.excluded_attributes]
+        self.included = [PathPattern(pattern)
+            for pattern in self.included_attributes]
+        self._filtering = bool(self.excluded or self.included)
+        # nesting in subtrees matched by -i
+        self._included_depth = 0
+
+        # digests are bound to the compared roots, see compare_dicts
+        self.old_digests = SubtreeDigests()
+        self.new_digests = SubtreeDigests()
+        self._old_root = None
+        self._new_root = None
+        # identities of elements of old arrays, see _keyed_script
+        self._old_identities = {}
+
+        self.obj1 = None
+        self.obj2 = None
+        if fn1:
+            self.obj1 = self._load(fn1)
+        if fn2:
+            self.obj2 = self._load(fn2)
+
+    @timed("parse")
+    def _load(self, fileobj):
+        """Parse the document, just index it with the lazy option (when
+        the file can be memory-mapped). Snapshots are always read lazily."""
+        if is_snapshot(fileobj):
+            self.lazy = True
+            self.prune_identical = False
+            return SnapshotDocument(fileobj).root
+        if self.lazy and hasattr(fileobj, "fileno"):
+            return LazyDocument(fileobj).root
+        return load_json(fileobj)
+
+    def _filter_key(self, path):
+        """How to treat the value on path according to -x and -i.
+
+        Excluded values are skipped, included values (and values inside
+        of them) are compared. Other values are compared only when they
+        may contain included values, reporting just the changes found
+        in these; otherwise they are skipped as well.
+        """
+        for pattern in self.excluded:
+            if pattern.matches(path):
+                return _SKIP
+        if not self.included or self._included_depth:
+            return _COMPARE
+        for pattern in self.included:
+            if pattern.matches(path):
+                return _INCLUDE
+        for pattern in self.included:
+            if pattern.may_match_below(path):
+                return _DESCEND
+        return _SKIP
+
+    def _record(self, result, key, path, old, new):
+        """Compare values on path and record the change under key
+        of result; old or new is _MISSING for appended or removed
+        values."""
+        mode = _COMPARE
+        if self._filtering:
+            mode = self._filter_key(path)
+            if mode == _SKIP:
+                return
+        if old is _MISSING:
+            if mode != _DESCEND:
+                result[u'_append'][key] = plain(new)
+            return
+        if new is _MISSING:
+            if mode != _DESCEND:
+                result[u'_remove'][key] = plain(old)
+            return
+        if mode == _DESCEND and not (isinstance(old, LazyNode) or
+                isinstance(new, LazyNode) or isinstance(old, dict) and
+                isinstance(new, dict) or isinstance(old, list) and
+                isinstance(new, list)):
+            # as in _walk, only containers of the same type may contain
+            # changes of included values
+            return
+
+        if mode == _INCLUDE:
+            self._included_depth += 1
+        try:
+            res = self._compare_elements(old, new, path)
+        finally:
+            if mode == _INCLUDE:
+                self._included_depth -= 1
+        if res is not _SAME:
+            result[u'_update'][key] = res
+
+    @timed("filter_results")
+    def _filter_results(self, result):
+        """Clear out unused keys in result, and appended values with -a.
+
+        (-i and -x are applied while going through the object's tree,
+        see _filter_key)"""
+        out_result = {}
+        # formatting whole results is expensive even when not logged
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        for change_type in result:
+            if debug:
+                logging.debug("change_type = %s", change_type)
+            if self.ignore_appended and (change_type == "_append"):
+                continue
+            if debug:
+                logging.debug("result[change_type] = %s",
+                    unicode(result[change_type]))
+            if len(result[change_type]) > 0:
+                out_result[change_type] = result[change_type]
+
+        return out_result
+
+    def _compare_elements(self, old, new, path=()):
+        """Unify decision making on the leaf node level.
+
+        path is the tuple of keys and indices leading to the elements.
+        Returns _SAME when there is no difference.
+
+        The differences found by _walk are put together to the nested
+        result, without recursion."""
+        depth = len(path)
+        result = {}
+        for change_type, change_path, old_value, new_value in \
+                self._walk(old, new, path, False):
+            if len(change_path) == depth:
+                # different types or scalars, new value is new
+                if depth == 0:
+                    # the whole document
+                    return {u"_replace": new_value}
+                return new_value
+            node = result
+            for key in change_path[depth:-1]:
+                node = node.setdefault(u"_update", {}).setdefault(key, {})
+            if change_type == u"_remove":
+                new_value = old_value
+            node.setdefault(change_type, {})[change_path[-1]] = new_value
+        if len(result) > 0:
+            return result
+        return _SAME
+
+    def _expand_lazy(self, value, path):
+        """Make a dict or list of a LazyNode (or leave the value)."""
+        if not isinstance(value, LazyNode):
+            return value
+        # arrays not compared by position are loaded whole
+        if value.is_array() and not self._is_positional(path):
+            return value.load()
+        return value.expand()
+
+    def _positional_script(self, old_arr, new_arr):
+        """Edit script pairing the elements with the same index."""
+        inters = min(len(old_arr), len(new_arr))  # this is the smaller length
+        script = [("update", idx, idx) for idx in range(inters)]
+
+        # the rest of the larger array
+        if (inters == len(old_arr)):
+            script.extend([("append", idx)
+                for idx in range(inters, len(new_arr))])
+        else:
+            script.extend([("remove", idx)
+                for idx in range(inters, len(old_arr))])
+        return script
+
+    def _lcs_script(self, old_arr, new_arr):
+        """Edit script keeping the longest common subsequence of elements.
+
+        Between two kept elements the removed and appended elements are
+        paired as updates, so that a changed element is still reported
+        as one (nested) update. Falls back to the positional script when
+        the arrays differ too much (see align_cutoff).
+        """
+        # elements are compared by their digests, mapped to small ints
+        codes = {}
+        old_seq = [codes.setdefault(self.old_digests.digest(elem),
+            len(codes)) for elem in old_arr]
+        new_seq = [codes.setdefault(self.new_digests.digest(elem),
+            len(codes)) for elem in new_arr]
+        matches = lcs_matches(old_seq, new_seq, self.align_cutoff)
+        if matches is None:
+            return self._positional_script(old_arr, new_arr)
+
+        script = []
+        old_idx = new_idx = 0
+        for old_end, new_end in matches + [(len(old_arr), len(new_arr))]:
+            while old_idx < old_end and new_idx < new_end:
+                script.append(("update", old_idx, new_idx))
+                old_idx += 1
+                new_idx += 1
+            script.extend([("remove", idx)
+                for idx in range(old_idx, old_end)])
+            script.extend([("append", idx)
+                for idx in range(new_idx, new_end)])
+            old_idx = old_end + 1
+            new_idx = new_end + 1
+        return script
+
+    def _xdiff_distance(self, old, new):
+        """Cost of editing old to new: number of inserted, deleted and
+        updated nodes, children of arrays being matched as in X-Diff only
+        when they are equal."""
+        cost = 0
+        pairs = [(old, new)]
+        while pairs:
+            old, new = pairs.pop()
+            if type(old) != type(new):
+                cost += tree_size(old) + tree_size(new)
+            elif isinstance(old, dict):
+                if self.old_digests.digest(old) == \
+                        self.new_digests.digest(new):
+                    continue
+                for key in old:
+                    if key in new:
+                        pairs.append((old[key], new[key]))
+                    else:
+                        cost += tree_size(old[key])
+                for key in new:
+                    if key not in old:
+                        cost += tree_size(new[key])
+            elif isinstance(old, list):
+                counts = {}
+                for elem in old:
+                    digest = self.old_digests.digest(elem)
+                    counts.setdefault(digest, []).append(elem)
+                for elem in new:
+                    same = counts.get(self.new_digests.digest(elem))
+                    if same:
+                        same.pop()
+                    else:
+                        cost += tree_size(elem)
+                for same in counts.values():
+                    for elem in same:
+                        cost += tree_size(elem)
+            else:
+                cost += int(old != new)
+        return cost
+
+    def _xdiff_script(self, old_arr, new_arr):
+        """Edit script of arrays compared as unordered collections,
+        following X-Diff (Wang, DeWitt, Cai: X-Diff: An Effective Change
+        Detection Algorithm for XML Documents, 2003):
+
+        - elements with equal digests are matched first, in linear time,
+        - the rest are matched only with elements of the same type, with
+          the minimal total edit cost; a pair is only matched when editing
+          it costs less than building the larger of the two elements.
+
+        Large groups of unmatched elements are matched greedily, or just
+        in order (see XDIFF_OPTIMAL_LIMIT and XDIFF_PAIRS_LIMIT).
+        """
+        index = {}
+        for idx in range(len(old_arr) - 1, -1, -1):
+            index.setdefault(self.old_digests.digest(old_arr[idx]),
+                []).append(idx)
+        new_rest = []
+        for idx, elem in enumerate(new_arr):
+            same = index.get(self.new_digests.digest(elem))
+            if same:
+                same.pop()
+            else:
+                new_rest.append(idx)
+        old_rest = []
+        for same in index.values():
+            old_rest.extend(same)
+        old_rest.sort()
+
+        # the signature of a node is just its type
+        old_groups = {}
+        new_groups = {}
+        for idx in old_rest:
+            old_groups.setdefault(type(old_arr[idx]), []).append(idx)
+        for idx in new_rest:
+            new_groups.setdefault(type(new_arr[idx]), []).append(idx)
+
+        script = []
+        matched_old = set()
+        matched_new = set()
+        for sig in old_groups:
+            if sig not in new_groups:
+                continue
+            for old_idx, new_idx in self._xdiff_match(old_arr, new_arr,
+                    old_groups[sig], new_groups[sig]):
+                script.append(("update", old_idx, new_idx))
+                matched_old.add(old_idx)
+                matched_new.add(new_idx)
+        script.extend([("remove", idx) for idx in old_rest
+            if idx not in matched_old])
+        script.extend([("append", idx) for idx in new_rest
+            if idx not in matched_new])
+        return script
+
+    def _xdiff_match(self, old_arr, new_arr, old_group, new_group):
+        """Pairs of (old, new) indices matched from the two groups."""
+        if len(old_group) * len(new_group) > XDIFF_PAIRS_LIMIT:
+            return zip(old_group, new_group)
+
+        del_cost = [tree_size(old_arr[idx]) for idx in old_group]
+        ins_cost = [tree_size(new_arr[idx]) for idx in new_group]
+        never = sum(del_cost) + sum(ins_cost) + 1
+        dist = []
+        for i, old_idx in enumerate(old_group):
+            row = []
+            for j, new_idx in enumerate(new_group):
+                cost = self._xdiff_distance(old_arr[old_idx],
+                    new_arr[new_idx])
+                if cost >= max(del_cost[i], ins_cost[j]):
+                    cost = never
+                row.append(cost)
+            dist.append(row)
+
+        pairs = []
+        if len(old_group) + len(new_group) <= XDIFF_OPTIMAL_LIMIT:
+            # square matrix: each old element matched to a new one or
+            # to its own "delete" column, each new one to a new element
+            # or to its own "insert" row
+            n_old = len(old_group)
+            n_new = len(new_group)
+            cost = []
+            for i in range(n_old):
+                row = dist[i] + [never] * n_old
+                row[n_new + i] = del_cost[i]
+                cost.append(row)
+            for j in range(n_new):
+                row = [never] * n_new + [0] * n_old
+                row[j] = ins_cost[j]
+                cost.append(row)
+            assignment = min_cost_matching(cost)
+            for i in range(n_old):
+                j = assignment[i]
+                if j < n_new and dist[i][j] < never:
+                    pairs.append((old_group[i], new_group[j]))
+        else:
+            candidates = []
+            for i in range(len(old_group)):
+                for j in range(len(new_group)):
+                    if dist[i][j] < never:
+                        candidates.append((dist[i][j], i, j))
+            candidates.sort()
+            used_old = set()
+            used_new = set()
+            for _, i, j in candidates:
+                if i not in used_old and j not in used_new:
+                    used_old.add(i)
+                    used_new.add(j)
+                    pairs.append((old_group[i], new_group[j]))
+        return pairs
+
+    def _array_fields(self, path):
+        """Identity fields declared for the array on path, or None."""
+        for pattern, fields in self.array_keys:
+            if pattern.matches(path):
+                return fields
+        return None
+
+    def _is_positional(self, path):
+        """Are elements of the array on path paired by their indices?"""
+        return self.array_align == "position" and \
+            self.backend == "default" and self._array_fields(path) is None
+
+    def _identities(self, arr, fields, digests):
+        """Identities of the elements of arr, None when some element
+        is not an object with all the fields."""
+        out = []
+        for elem in arr:
+            if not isinstance(elem, dict):
+                return None
+            try:
+                out.append(tuple([digests.digest(elem[field])
+                    for field in fields]))
+            except KeyError:
+                return None
+        return out
+
+    def _keyed_script(self, old_arr, new_arr, fields):
+        """Edit script pairing the elements with the same identity, given
+        by the values of fields; elements with duplicate identities are
+        paired in order. Kept elements out of their relative order are
+        moved.
+
+        Returns None when the elements cannot be identified.
+        """
+        # the index of the old array is kept for another candidate
+        cached = self._old_identities.get(id(old_arr))
+        if cached is not None and cached[0] is old_arr and \
+                cached[1] == fields:
+            old_ids = cached[2]
+        else:
+            old_ids = self._identities(old_arr, fields, self.old_digests)
+            self._old_identities[id(old_arr)] = (old_arr, fields, old_ids)
+        if old_ids is None:
+            return None
+        new_ids = self._identities(new_arr, fields, self.new_digests)
+        if new_ids is None:
+            return None
+
+        index = {}
+        for idx in range(len(old_ids) - 1, -1, -1):
+            index.setdefault(old_ids[idx], []).append(idx)
+        script = []
+        pairs = []
+        for new_idx, ident in enumerate(new_ids):
+            candidates = index.get(ident)
+            if candidates:
+                pairs.append((candidates.pop(), new_idx))
+            else:
+                script.append(("append", new_idx))
+        for candidates in index.values():
+            script.extend([("remove", idx) for idx in candidates])
+
+        in_order = set(longest_increasing([old_idx
+            for old_idx, _ in pairs]))
+        for pos, (old_idx, new_idx) in enumerate(pairs):
+            script.append(("update", old_idx, new_idx))
+            if pos not in in_order:
+                script.append(("move", old_idx, new_idx))
+        return script
+
+    @timed("compare_arrays")
+    def _array_script(self, old_arr, new_arr, path):
+        """Edit script of the arrays on path."""
+        script = None
+        fields = self._array_fields(path)
+        if fields is not None:
+            script = self._keyed_script(old_arr, new_arr, fields)
+        if script is not None:
+            return script
+        elif self.backend == "xdiff":
+            return self._xdiff_script(old_arr, new_arr)
+        elif self.array_align == "lcs":
+            return self._lcs_script(old_arr, new_arr)
+        return self._positional_script(old_arr, new_arr)
+
+    def _compare_arrays(self, old_arr, new_arr, path=()):
+        """
+        simpler version of compare_dicts; just an internal method, because
+        it could never be called from outside.
+
+        We have it guaranteed that both new_arr and old_arr are of type list.
+        Updated and removed elements are keyed by their index in old_arr,
+        appended ones by their index in new_arr, moved ones map the index
+        in new_arr to the one in old_arr.
+        """
+        res = self._compare_elements(old_arr, new_arr, path)
+        if res is _SAME:
+            return {}
+        return res
+
+    @timed("compare_dicts")
+    def compare_dicts(self, old_obj=None, new_obj=None):
+        """
+        The real workhorse
+
+        Documents of different types, and scalar ones, are different as a
+        whole: the result has just the new document under _replace.
+        """
+        if old_obj is None and hasattr(self, "obj1"):
+            old_obj = self.obj1
+        if new_obj is None and hasattr(self, "obj2"):
+            new_obj = self.obj2
+
+        self._bind_roots(old_obj, new_obj)
+        if self.lazy:
+            if isinstance(old_obj, LazyNode) and \
+                    isinstance(new_obj, LazyNode) and \
+                    old_obj.same_text(new_obj):
+                return {}
+            old_obj = self._expand_lazy(old_obj, ())
+            new_obj = self._expand_lazy(new_obj, ())
+        if self.prune_identical and self.old_digests.digest(old_obj) == \
+                self.new_digests.digest(new_obj):
+            return {}
+
+        if self.jobs > 1 and multiprocessing is not None and \
+                isinstance(old_obj, dict) and isinstance(new_obj, dict):
+            return self._parallel_compare_dicts(old_obj, new_obj)
+        return self._compare_dicts(old_obj, new_obj)
+
+    def iter_changes(self, old_obj=None, new_obj=None):
+        """
+        Generate the differences one by one while walking the documents,
+        as (op, path, old, new) tuples: op is "add", "remove" or
+        "replace", path a JSON pointer (RFC 6901), and old or new is None
+        for added or removed values.
+
+        The changes can be applied in the order given (as with JSON Patch,
+        RFC 6902): changes inside an array come first, then elements
+        removed from it from the end, then elements added to it by their
+        final position. Moved elements are removed and added again.
+        Arrays compared by the xdiff backend keep their old order.
+        """
+        if old_obj is None and hasattr(self, "obj1"):
+            old_obj = self.obj1
+        if new_obj is None and hasattr(self, "obj2"):
+            new_obj = self.obj2
+
+        self._bind_roots(old_obj, new_obj)
+        ops = {u"_append": "add", u"_remove": "remove", u"_update": "replace"}
+        for change_type, path, old, new in self._walk(old_obj, new_obj):
+            yield (ops[change_type], json_pointer(path), old, new)
+
+    def merge(self, base, ours, theirs):
+        """
+        Three-way merge of the changes from base to ours and to theirs,
+        walking the three documents at once. Returns (merged, conflicts).
+
+        Values changed on one side only are taken from that side, subtrees
+        which are the same on both sides are taken as they are, without
+        walking them. Subtrees are compared with same_values (so types of
+        the nested values count), with prune_identical by their digests.
+        Objects changed on both sides are merged member by
+        member, arrays element by element when none of them changed its
+        length. Other values changed differently on both sides (including
+        deletion against change) are conflicts: they are taken from ours
+        and listed in conflicts as dicts with the JSON pointer "path" and
+        the "base", "ours" and "theirs" values (missing ones are left
+        out). The merged document shares unchanged subtrees with ours and
+        theirs.
+        """
+        if self.prune_identical:
+            # one memo serves all three documents
+            digest = SubtreeDigests().digest
+
+            def same(first, second):
+                if first is _MISSING or second is _MISSING:
+                    return first is second
+                return digest(first) == digest(second)
+        else:
+            same = same_values
+        conflicts = []
+        root = [None]
+        # (container and key to put the value to, path, base, ours, theirs)
+        stack = [(root, 0, (), base, ours, theirs)]
+        while stack:
+            parent, key, path, old, mine, other = stack.pop()
+            if same(mine, other):
+                value = mine
+            else:
+                if same(old, mine):
+                    value = other
+                elif same(old, other):
+                    value = mine
+                elif isinstance(mine, dict) and isinstance(other, dict):
+                    if not isinstance(old, dict):
+                        old = {}
+                    value = {}
+                    # in order of the names, so are the conflicts
+                    names = set(mine)
+                    names.update(other)
+                    names.update(old)
+                    for name in sorted(names, reverse=True):
+                        stack.append((value, name, path + (name,),
+                            old.get(name, _MISSING),
+                            mine.get(name, _MISSING),
+                            other.get(name, _MISSING)))
+                elif isinstance(mine, list) and isinstance(other, list) and \
+                        isinstance(old, list) and \
+                        len(old) == len(mine) == len(other):
+                    value = [None] * len(mine)
+                    for idx in xrange(len(mine) - 1, -1, -1):
+                        stack.append((value, idx, path + (idx,), old[idx],
+                            mine[idx], other[idx]))
+                else:
+                    conflict = {"path": json_pointer(path)}
+                    for name, side in (("base", old), ("ours", mine),
+                            ("theirs", other)):
+                        if side is not _MISSING:
+                            conflict[name] = side
+                    conflicts.append(conflict)
+                    value = mine
+            if value is not _MISSING:
+                parent[key] = value
+        return root[0], conflicts
+
+    def _walk(self, old_obj, new_obj, path=(), split_moves=True):
+        """
+        Generate differences of the values on path as (change type, path,
+        old, new) tuples, change type being one of INTERNAL_KEYS. For
+        _move new is the index of the element in the old array, unless
+        moves are split to _remove and _append (split_moves).
+
+        The documents are walked without recursion, with a stack of
+        iterators of pairs of values to compare (see _children).
+        """
+        depth = len(path)
+        stats = self.stats
+        stack = [(iter([(None, path, old_obj, new_obj)]), False)]
+        while stack:
+            children, included = stack[-1]
+            try:
+                change_type, path, old, new = next(children)
+            except StopIteration:
+                stack.pop()
+                if included:
+                    self._included_depth -= 1
+                continue
+            mode = _COMPARE
+            if self._filtering and len(path) > depth:
+                mode = self._filter_key(path)
+                if mode == _SKIP:
+                    continue
+            if change_type is not None:
+                # moves are not reported inside of changed subtrees
+                if mode in (_COMPARE, _INCLUDE):
+                    yield change_type, path, old, new
+                continue
+            if old is _MISSING:
+                if mode != _DESCEND:
+                    yield u"_append", path, None, plain(new)
+                continue
+            if new is _MISSING:
+                if mode != _DESCEND:
+                    yield u"_remove", path, plain(old), None
+                continue
+
+            if self.lazy and (isinstance(old, LazyNode) or
+                    isinstance(new, LazyNode)):
+                if isinstance(old, LazyNode) and \
+                        isinstance(new, LazyNode) and old.same_text(new):
+                    if stats is not None:
+                        stats.pruned += 1
+                    continue
+                old_value = self._expand_lazy(old, path)
+                new_value = self._expand_lazy(new, path)
+                if type(old_value) != type(new_value):
+                    if mode != _DESCEND:
+                        yield u"_update", path, plain(old), plain(new)
+                    continue
+                old, new = old_value, new_value
+
+            if stats is not None:
+                stats.node(old, new, path)
+            old_type = type(old)
+            if old_type is not type(new):
+                # different types, new value is new (but numbers within
+                # the tolerance are the same)
+                if mode == _DESCEND:
+                    continue
+                if not self._tolerant or old_type not in _NUMBERS or \
+                        type(new) not in _NUMBERS or \
+                        self._numbers_differ(old, new):
+                    yield u"_update", path, old, new
+                continue
+            kind = _KINDS.get(old_type)
+            if kind is None:
+                kind = kind_of(old)
+            if kind == _SCALAR:
+                if mode == _DESCEND:
+                    continue
+                if self._tolerant and old_type in _NUMBERS:
+                    if self._numbers_differ(old, new):
+                        yield u"_update", path, old, new
+                elif old != new:
+                    yield u"_update", path, old, new
+                continue
+
+            if self.prune_identical and self.old_digests.digest(old) == \
+                    self.new_digests.digest(new):
+                if stats is not None:
+                    stats.pruned += 1
+                continue
+            children = None
+            if kind == _ARRAY:
+                children = self._scalar_children(old, new, path)
+                if children is not None and len(children) == 0:
+                    continue
+            if children is None:
+                children = self._children(old, new, path, split_moves)
+            else:
+                children = iter(children)
+            if mode == _INCLUDE:
+                self._included_depth += 1
+            stack.append((children, mode == _INCLUDE))
+
+    def _numbers_differ(self, old, new):
+        """Whether the numbers differ by more than the tolerance.
+
+        Infinities and NaNs differ from everything but an equal value."""
+        if (type(old) is float and old - old != 0) or \
+                (type(new) is float and new - new != 0):
+            return not old == new
+        try:
+            diff = abs(old - new)
+            bound = self.rel_tol * max(abs(old), abs(new))
+        except OverflowError:
+            # integers beyond the range of floats, compared exactly
+            old, new = Fraction(old), Fraction(new)
+            diff = abs(old - new)
+            bound = Fraction(self.rel_tol) * max(abs(old), abs(new))
+        return diff > max(self.abs_tol, bound)
+
+    def _changed_numbers(self, old_arr, new_arr, inters):
+        """Indices of the first inters numbers of the arrays differing
+        by more than the tolerance, computed with numpy when available."""
+        if numpy is not None and inters >= NUMPY_MIN_SIZE:
+            try:
+                old_vals = numpy.array(old_arr[:inters], dtype=float)
+                new_vals = numpy.array(new_arr[:inters], dtype=float)
+            except OverflowError:
+                pass
+            else:
+                with numpy.errstate(invalid="ignore", over="ignore"):
+                    magnitude = numpy.maximum(numpy.abs(old_vals),
+                        numpy.abs(new_vals))
+                    # inexact integers, infinities and NaNs (whose
+                    # magnitude fails the test) are left to Python
+                    exact = magnitude < _EXACT_FLOAT
+                    bound = magnitude * self.rel_tol
+                    numpy.maximum(bound, self.abs_tol, bound)
+                    changed = exact & \
+                        (numpy.abs(old_vals - new_vals) > bound)
+                for idx in numpy.flatnonzero(~exact).tolist():
+                    changed[idx] = self._numbers_differ(old_arr[idx],
+                        new_arr[idx])
+                return numpy.flatnonzero(changed).tolist()
+        return [idx for idx in xrange(inters)
+            if self._numbers_differ(old_arr[idx], new_arr[idx])]
+
+    def _scalar_children(self, old_arr, new_arr, path):
+        """
+        Bulk comparison of arrays of scalars of one type (or of numbers
+        with a tolerance), compared as whole sequences first.
+
+        Returns the children (as of _children) with differences, or None
+        when the arrays have to be compared element by element.
+        """
+        if not old_arr or not new_arr or \
+                _KINDS.get(type(old_arr[0])) != _SCALAR:
+            return None
+        old_types = set(imap(type, old_arr))
+        new_types = set(imap(type, new_arr))
+        inters = min(len(old_arr), len(new_arr))
+        if self._tolerant and old_types <= _NUMBERS and \
+                new_types <= _NUMBERS:
+            if old_arr == new_arr:
+                return []
+            if not self._is_positional(path):
+                return None
+            changed = self._changed_numbers(old_arr, new_arr, inters)
+        elif len(old_types) != 1 or new_types != old_types:
+            return None
+        elif old_arr == new_arr:
+            return []
+        elif not self._is_positional(path):
+            return None
+        else:
+            changed = compress(xrange(inters), imap(ne, old_arr, new_arr))
+
+        children = [(None, path + (idx,), old_arr[idx], new_arr[idx])
+            for idx in changed]
+        # removed from the end, as in _children
+        children.extend([(None, path + (idx,), old_arr[idx], _MISSING)
+            for idx in xrange(len(old_arr) - 1, inters - 1, -1)])
+        if not self.ignore_appended:
+            children.extend([(None, path + (idx,), _MISSING, new_arr[idx])
+                for idx in xrange(inters, len(new_arr))])
+        return children
+
+    def _children(self, old_obj, new_obj, path, split_moves):
+        """Generate (change type, path, old, new) of the values inside of
+        two dicts or lists to be compared (change type None) or reported
+        as moved (_move), in the order in which they can be applied."""
+        if isinstance(old_obj, dict):
+            for name in old_obj:
+                yield None, path + (name,), old_obj[name], \
+                    new_obj.get(name, _MISSING)
+            if self.ignore_appended:
+                return
+            for name in new_obj:
+                if name not in old_obj:
+                    yield None, path + (name,), _MISSING, new_obj[name]
+            return
+
+        removed = []
+        added = []
+        for step in self._array_script(old_obj, new_obj, path):
+            if step[0] == "update":
+                yield None, path + (step[1],), old_obj[step[1]], \
+                    new_obj[step[2]]
+            elif step[0] == "remove":
+                removed.append(step[1])
+            elif step[0] == "append":
+                if not self.ignore_appended:
+                    added.append((step[1], None))
+            elif split_moves:
+                removed.append(step[1])
+                added.append((step[2], None))
+            else:
+                added.append((step[2], step[1]))
+        removed.sort(reverse=True)
+        for idx in removed:
+            yield None, path + (idx,), old_obj[idx], _MISSING
+        added.sort()
+        for idx, old_idx in added:
+            if old_idx is None:
+                yield None, path + (idx,), _MISSING, new_obj[idx]
+            else:
+                yield u"_move", path + (idx,), None, old_idx
+
+    def _bind_roots(self, old_obj, new_obj):
+        """Keep digests and indexes of a root compared again (e.g. one
+        baseline against many candidates), forget those of replaced
+        roots."""
+        if old_obj is not self._old_root:
+            self.old_digests = SubtreeDigests()
+            self._old_identities = {}
+            self._old_root = old_obj
+        if new_obj is not self._new_root:
+            self.new_digests = SubtreeDigests()
+            self._new_root = new_obj
+
+    def compare_batch(self, candidates):
+        """
+        Compare the baseline (the first document given to the constructor)
+        with each of the candidate files, generating (name, result) pairs
+        in the order of the candidates.
+
+        The baseline is parsed, hashed and indexed just once. With jobs > 1
+        candidates are diffed by worker processes, each of which gets the
+        baseline (parsed) when started and hashes and indexes it once.
+        """
+        self._bind_roots(self.obj1, None)
+        if self.prune_identical:
+            self.old_digests.digest(self.obj1)
+
+        if self.jobs > 1 and multiprocessing is not None and \
+                len(candidates) > 1:
+            pool = multiprocessing.Pool(self.jobs, _init_parallel_worker,
+                (self.opts, type(self), _flatten(plain(self.obj1))))
+            try:
+                for name, res, stats in pool.imap(_batch_task, candidates):
+                    if stats is not None:
+                        self.stats.add(stats)
+                    yield (name, _unflatten(res))
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for name in candidates:
+                yield (name, self.compare_dicts(self.obj1,
+                    load_json_file(name)))
+
+    def compare_trees(self, old_dir, new_dir, pattern=TREE_PATTERN,
+            trust_mtime=True):
+        """
+        Compare the files matching pattern in two directory trees, paired
+        by their paths relative to the directories.
+
+        The result has the form of comparing objects keyed by the relative
+        paths: results of the changed files are under _update, documents
+        of the added and removed files under _append and _remove. Pairs of
+        files with the same size and modification time (unless not
+        trust_mtime), or with the same content, are not parsed at all.
+        With jobs > 1 the pairs are compared by worker processes
+        (with comparators of the same class and options).
+        """
+        old_files = _tree_files(old_dir, pattern)
+        new_files = _tree_files(new_dir, pattern)
+        tasks = []
+        for path in sorted(set(old_files) | set(new_files)):
+            old_name = old_files.get(path)
+            new_name = new_files.get(path)
+            if new_name is None:
+                tasks.append((path, old_name, None))
+            elif old_name is None:
+                if not self.ignore_appended:
+                    tasks.append((path, None, new_name))
+            elif trust_mtime:
+                old_stat = os.stat(old_name)
+                new_stat = os.stat(new_name)
+                if old_stat.st_size != new_stat.st_size or \
+                        old_stat.st_mtime != new_stat.st_mtime:
+                    tasks.append((path, old_name, new_name))
+            else:
+                tasks.append((path, old_name, new_name))
+
+        result = {
+            u"_append": {},
+            u"_remove": {},
+            u"_update": {},
+        }
+        if self.jobs > 1 and multiprocessing is not None and \
+                len(tasks) > 1:
+            pool = multiprocessing.Pool(self.jobs, _init_parallel_worker,
+                (self.opts, type(self)))
+            try:
+                results = [(change_type, path, _unflatten(value))
+                    for change_type, path, value
+                    in pool.imap(_tree_task, tasks, TREE_CHUNK)]
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            results = [self._compare_files(*task) for task in tasks]
+        for change_type, path, value in results:
+            if change_type is not None:
+                result[change_type][path] = value
+        return dict((change_type, changes)
+            for change_type, changes in result.iteritems() if changes)
+
+    def _compare_files(self, path, old_name, new_name):
+        """(change type, path, value) of the result of compare_trees for
+        the pair of files (one of them may be None); change type is None
+        for the same files."""
+        if old_name is None:
+            return (u"_append", path, load_json_file(new_name))
+        if new_name is None:
+            return (u"_remove", path, load_json_file(old_name))
+        if os.path.getsize(old_name) == os.path.getsize(new_name) and \
+                file_digest(old_name) == file_digest(new_name):
+            return (None, path, None)
+        with open(old_name) as old_file, open(new_name) as new_file:
+            res = self._compare_documents(old_file, new_file)
+        if res == {}:
+            return (None, path, None)
+        return (u"_update", path, res)
+
+    def _compare_documents(self, old_file, new_file):
+        """Result of comparing the documents in the files; the files
+        mapped with the lazy option are unmapped afterwards."""
+        old_obj = self._load(old_file)
+        new_obj = self._load(new_file)
+        try:
+            return self.compare_dicts(old_obj, new_obj)
+        finally:
+            self._bind_roots(None, None)
+            for root in (old_obj, new_obj):
+                if isinstance(root, LazyNode):
+                    root.doc.close()
+
+    def compare_records(self, old_file, new_file, fields,
+            run_size=RECORDS_RUN_SIZE):
+        """
+        Compare JSON Lines files (one JSON object on each line) record by
+        record, pairing the records with the same values of the fields.
+
+        Generates the differences as they are found, as objects with the
+        values of the fields of the record under key, and its result (see
+        compare_dicts) under _update, or the whole record under _append or
+        _remove. Records are sorted by their keys, in runs of run_size
+        bytes written to temporary files when there are more of them, and
+        then merged, so the memory use does not grow with the size of the
+        files; the differences come out in that order. Records are parsed
+        again only when their lines differ.
+        """
+        old_records = _sorted_records(old_file, fields, run_size)
+        new_records = _sorted_records(new_file, fields, run_size)
+        old = next(old_records, None)
+        new = next(new_records, None)
+        while old is not None or new is not None:
+            if new is None or old is not None and old[0] < new[0]:
+                record = _parse_record(old)
+                yield {u"key": _record_key(record, fields),
+                    u"_remove": record}
+                old = next(old_records, None)
+            elif old is None or new[0] < old[0]:
+                if not self.ignore_appended:
+                    record = _parse_record(new)
+                    yield {u"key": _record_key(record, fields),
+                        u"_append": record}
+                new = next(new_records, None)
+            else:
+                if old[2].strip() != new[2].strip():
+                    old_record = _parse_record(old)
+                    new_record = _parse_record(new)
+                    self._bind_roots(old_record, new_record)
+                    res = self._compare_dicts(old_record, new_record)
+                    if res != {}:
+                        yield {u"key": _record_key(new_record, fields),
+                            u"_update": res}
+                old = next(old_records, None)
+                new = next(new_records, None)
+
+    def _parallel_tasks(self, old_obj, new_obj, keys):
+        """Generate tasks for _parallel_task: groups of top-level sections
+        and slices of long top-level arrays, serialized to JSON."""
+        old_chunk = []
+        new_chunk = []
+        size = 0
+        for name in keys:
+            old_value = old_obj[name]
+            new_value = new_obj[name]
+            if isinstance(old_value, list) and \
+                    isinstance(new_value, list) and \
+                    len(old_value) > PARALLEL_ARRAY_CHUNK and \
+                    len(new_value) > PARALLEL_ARRAY_CHUNK and \
+                    self._is_positional((name,)) and \
+                    self._filter_key((name,)) == _COMPARE:
+                if self.stats is not None:
+                    self.stats.node(old_value, new_value, (name,))
+                inters = min(len(old_value), len(new_value))
+                for start in range(0, inters, PARALLEL_ARRAY_CHUNK):
+                    end = min(start + PARALLEL_ARRAY_CHUNK, inters)
+                    yield ("array", name, start,
+                        json_text(old_value[start:end]),
+                        json_text(new_value[start:end]))
+                continue
+            old_chunk.append("%s: %s" % (json.dumps(name),
+                json_text(old_value)))
+            new_chunk.append("%s: %s" % (json.dumps(name),
+                json_text(new_value)))
+            size += len(old_chunk[-1]) + len(new_chunk[-1])
+            if size >= PARALLEL_CHUNK_SIZE:
+                yield ("dict", None, None, "{%s}" % ", ".join(old_chunk),
+                    "{%s}" % ", ".join(new_chunk))
+                old_chunk = []
+                new_chunk = []
+                size = 0
+        if old_chunk:
+            yield ("dict", None, None, "{%s}" % ", ".join(old_chunk),
+                "{%s}" % ", ".join(new_chunk))
+
+    def _parallel_compare_dicts(self, old_obj, new_obj):
+        """compare_dicts with the top-level sections (and long top-level
+        arrays) split between self.jobs worker processes.
+
+        Workers get the sections serialized to JSON, and return partial
+        results (flattened, see _flatten) which are merged in the order of
+        the (sorted) keys, so the result does not depend on the
+        scheduling. Their counts of the compared values are added to the
+        stats.
+        """
+        result = {
+            u"_append": {},
+            u"_remove": {},
+            u"_update": {}
+        }
+        common = []
+        for name in sorted(set(old_obj.keys()) | set(new_obj.keys())):
+            if name not in old_obj:
+                self._record(result, name, (name,), _MISSING, new_obj[name])
+            elif name not in new_obj:
+                self._record(result, name, (name,), old_obj[name], _MISSING)
+            else:
+                common.append(name)
+
+        # serialized here rather than by the thread of the pool feeding
+        # the workers, which would swallow the errors
+        tasks = list(self._parallel_tasks(old_obj, new_obj, common))
+        if self.stats is not None:
+            # the values below are counted by the workers
+            self.stats.node(old_obj, new_obj, ())
+        parts = []
+        array_updates = {}
+        pool = multiprocessing.Pool(self.jobs, _init_parallel_worker,
+            (self.opts,))
+        try:
+            for kind, name, part, stats in pool.imap(_parallel_task,
+                    tasks):
+                if stats is not None:
+                    self.stats.add(stats)
+                part = _unflatten(part)
+                if kind == "dict":
+                    parts.append(part)
+                else:
+                    array_updates.setdefault(name, {}).update(part)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+        # the rest of the arrays split between the tasks
+        for name in array_updates:
+            old_arr = old_obj[name]
+            new_arr = new_obj[name]
+            inters = min(len(old_arr), len(new_arr))
+            arr_result = {
+                u"_append": {},
+                u"_remove": {},
+                u"_update": array_updates[name]
+            }
+            for idx in range(inters, len(new_arr)):
+                self._record(arr_result, idx, (name, idx),
+                    _MISSING, new_arr[idx])
+            for idx in range(inters, len(old_arr)):
+                self._record(arr_result, idx, (name, idx),
+                    old_arr[idx], _MISSING)
+            arr_result = self._filter_results(arr_result)
+            if len(arr_result) > 0:
+                result[u'_update'][name] = arr_result
+
+        # results of the tasks have been filtered already
+        result = self._filter_results(result)
+        for part in parts:
+            for change_type in part:
+                result.setdefault(change_type, {}).update(part[change_type])
+        return result
+
+    def _compare_dicts(self, old_obj, new_obj, path=()):
+        """Compare two dicts (see _compare_elements)."""
+        res = self._compare_elements(old_obj, new_obj, path)
+        if res is _SAME:
+            return {}
+        return res
+
+
+# Comparator of a worker process of Comparator._parallel_compare_dicts,
+# compare_batch and compare_trees
+_worker_comparator = None
+
+
+def _flatten(value):
+    """
+    The containers of value in a flat list, which is pickled (to be
+    passed to or from worker processes) without recursion, however
+    deeply value is nested; see _unflatten.
+
+    The entries are (is a dict, keys of the dict, children), with the
+    children as (index of an entry, None) or (None, scalar). The first
+    entry is a list holding just value.
+    """
+    table = [(False, None, [value])]
+    pos = 0
+    while pos < len(table):
+        is_dict, keys, values = table[pos]
+        children = []
+        for child in values:
+            if isinstance(child, dict):
+                children.append((len(table), None))
+                table.append((True, child.keys(), child.values()))
+            elif isinstance(child, (list, tuple)):
+                children.append((len(table), None))
+                table.append((False, None, child))
+            else:
+                children.append((None, child))
+        table[pos] = (is_dict, keys, children)
+        pos += 1
+    return table
+
+
+def _unflatten(table):
+    """The value flattened by _flatten."""
+    built = [{} if is_dict else [] for is_dict, _, _ in table]
+    for (is_dict, keys, children), container in izip(table, built):
+        values = [scalar if idx is None else built[idx]
+            for idx, scalar in children]
+        if is_dict:
+            container.update(izip(keys, values))
+        else:
+            container.extend(values)
+    return built[0][0]
+
+
+def _init_parallel_worker(opts, comparator_class=Comparator, baseline=None):
+    global _worker_comparator
+    _worker_comparator = comparator_class(opts=opts)
+    _worker_comparator.jobs = 1
+    if baseline is not None:
+        # of compare_batch
+        _worker_comparator.obj1 = _unflatten(baseline)
+
+
+def _task_stats():
+    """ComparatorStats of the task just done by the worker (None without
+    the stats option), replaced by new ones for the next task."""
+    stats = _worker_comparator.stats
+    if stats is not None:
+        _worker_comparator.stats = ComparatorStats()
+    return stats
+
+
+def _batch_task(name):
+    res = _worker_comparator.compare_dicts(_worker_comparator.obj1,
+        load_json_file(name))
+    return (name, _flatten(res), _task_stats())
+
+
+def _tree_task(task):
+    change_type, path, value = _worker_comparator._compare_files(*task)
+    return (change_type, path, _flatten(value))
+
+
+def _parallel_task(task):
+    """Diff one task generated by Comparator._parallel_tasks."""
+    kind, name, start, old_text, new_text = task
+    old = load_json_text(old_text)
+    new = load_json_text(new_text)
+    part = {
+        u"_append": {},
+        u"_remove": {},
+        u"_update": {}
+    }
+    if kind == "dict":
+        # the sections one by one, as parts of the whole documents
+        for key in old:
+            _worker_comparator._record(part, key, (key,), old[key],
+                new[key])
+        part = _worker_comparator._filter_results(part)
+    else:
+        for idx in range(len(old)):
+            _worker_comparator._record(part, start + idx,
+                (name, start + idx), old[idx], new[idx])
+        part = part[u"_update"]
+    return (kind, name, _flatten(part), _task_stats())
+
+
+class StreamComparator(Comparator):
+    """
+    Comparator which never loads the whole documents into memory.
+
+    Both files are walked in lockstep through JSONEventParser, so when
+    the keys of objects come in the same order on both sides the memory
+    use grows with the nesting depth, not with the size of the documents.
+    Keys which come out of order are kept until their counterpart shows
+    up (or the object ends).
+    """
+    def __init__(self, fn1=None, fn2=None, opts=None,
+            chunk_size=CHUNK_SIZE):
+        Comparator.__init__(self, None, None, opts)
+        # hashing would have to keep the buffered values alive
+        self.prune_identical = False
+        self.stream1 = fn1
+        self.stream2 = fn2
+        self.chunk_size = chunk_size
+
+    def _stream_walk(self, old_ev, new_ev, frame):
+        """
+        Run frame (a generator of _stream_dicts or _stream_arrays) with
+        the frames of the nested objects and arrays on an explicit stack,
+        so that the nesting depth is not limited by the recursion limit.
+        Returns the result of frame (_SAME when there is no difference).
+
+        Frames yield (path, old first event, new first event) of the pairs
+        of values to compare, and are sent the results; their last yield
+        is (None, result).
+        """
+        # (frame, whether its values are included by -i)
+        stack = [(frame, False)]
+        sent = None
+        try:
+            while True:
+                frame, included = stack[-1]
+                request = frame.send(sent)
+                sent = None
+                if request[0] is None:
+                    # the frame is done
+                    stack.pop()
+                    if included:
+                        self._included_depth -= 1
+                    if not stack:
+                        return request[1]
+                    sent = request[1]
+                    continue
+                path, old_first, new_first = request
+
+                mode = _COMPARE
+                if self._filtering:
+                    mode = self._filter_key(path)
+                    if mode == _DESCEND and (old_first[0] != new_first[0] or
+                            old_first[0] == "value"):
+                        mode = _SKIP
+                    if mode == _SKIP:
+                        skip_value(old_ev, old_first[0])
+                        skip_value(new_ev, new_first[0])
+                        sent = _SAME
+                        continue
+
+                if old_first[0] == new_first[0] == "start_map":
+                    child = self._stream_dicts(old_ev, new_ev, path)
+                elif old_first[0] == new_first[0] == "start_array" and \
+                        self._is_positional(path):
+                    child = self._stream_arrays(old_ev, new_ev, path)
+                else:
+                    sent = self._stream_values(old_ev, new_ev, old_first,
+                        new_first, path, mode == _INCLUDE)
+                    continue
+                if mode == _INCLUDE:
+                    self._included_depth += 1
+                stack.append((child, mode == _INCLUDE))
+        finally:
+            # frames left by an exception
+            for frame, included in stack:
+                if included:
+                    self._included_depth -= 1
+
+    def _stream_values(self, old_ev, new_ev, old_first, new_first, path,
+            included=False):
+        """Build and compare values which are not walked by frames."""
+        if included:
+            self._included_depth += 1
+        try:
+            res = self._compare_elements(build_value(old_ev, *old_first),
+                build_value(new_ev, *new_first), path)
+        finally:
+            if included:
+                self._included_depth -= 1
+        # do not keep the compared values alive through their digests
+        self.old_digests = SubtreeDigests()
+        self.new_digests = SubtreeDigests()
+        self._old_identities = {}
+        return res
+
+    def _stream_single(self, events, path, report=False, first=None):
+        """Read a value present on one side only, _MISSING when it is
+        skipped by -x or -i (with report also when it would not be
+        reported)."""
+        if first is None:
+            first = next(events)
+        if self._filtering:
+            mode = self._filter_key(path)
+            if mode == _SKIP or (report and mode == _DESCEND):
+                skip_value(events, first[0])
+                return _MISSING
+        return build_value(events, *first)
+
+    def _stream_dicts(self, old_ev, new_ev, path=()):
+        """Frame (see _stream_walk) comparing two objects, both streams
+        are just after start_map."""
+        result = {
+            u"_append": {},
+            u"_remove": {},
+            u"_update": {}
+        }
+        if self.stats is not None:
+            self.stats.count(_OBJECT, path)
+        pending_old = {}
+        pending_new = {}
+        old_open = new_open = True
+        while old_open or new_open:
+            if old_open:
+                event, old_key = next(old_ev)
+                old_open = (event == "map_key")
+            if new_open:
+                event, new_key = next(new_ev)
+                new_open = (event == "map_key")
+
+            if old_open and new_open and old_key == new_key:
+                res = yield (path + (old_key,), next(old_ev), next(new_ev))
+                if res is not _SAME:
+                    result[u'_update'][old_key] = res
+                continue
+
+            if old_open:
+                old_value = self._stream_single(old_ev, path + (old_key,))
+                if old_value is _MISSING:
+                    pass
+                elif old_key in pending_new:
+                    self._record(result, old_key, path + (old_key,),
+                        old_value, pending_new.pop(old_key))
+                else:
+                    pending_old[old_key] = old_value
+            if new_open:
+                new_value = self._stream_single(new_ev, path + (new_key,))
+                if new_value is _MISSING:
+                    pass
+                elif new_key in pending_old:
+                    self._record(result, new_key, path + (new_key,),
+                        pending_old.pop(new_key), new_value)
+                else:
+                    pending_new[new_key] = new_value
+
+        for key in pending_old:
+            self._record(result, key, path + (key,),
+                pending_old[key], _MISSING)
+        for key in pending_new:
+            self._record(result, key, path + (key,),
+                _MISSING, pending_new[key])
+        yield (None, self._filter_results(result) or _SAME)
+
+    def _stream_arrays(self, old_ev, new_ev, path=()):
+        """Frame (see _stream_walk) comparing two arrays, both streams
+        are just after start_array."""
+        result = {
+            u"_append": {},
+            u"_remove": {},
+            u"_update": {}
+        }
+        idx = 0
+        old_open = new_open = True
+        while old_open or new_open:
+            if old_open:
+                old_first = next(old_ev)
+                old_open = (old_first[0] != "end_array")
+            if new_open:
+                new_first = next(new_ev)
+                new_open = (new_first[0] != "end_array")
+
+            if old_open and new_open:
+                res = yield (path + (idx,), old_first, new_first)
+                if res is not _SAME:
+                    result[u'_update'][idx] = res
+            elif old_open:
+                value = self._stream_single(old_ev, path + (idx,), True,
+                    old_first)
+                if value is not _MISSING:
+                    self._record(result, idx, path + (idx,), value, _MISSING)
+            elif new_open:
+                value = self._stream_single(new_ev, path + (idx,), True,
+                    new_first)
+                if value is not _MISSING:
+                    self._record(result, idx, path + (idx,), _MISSING, value)
+            idx += 1
+
+        if self.stats is not None:
+            # idx went past the end events as well
+            self.stats.count(_ARRAY, path, idx - 1)
+        yield (None, self._filter_results(result) or _SAME)
+
+    @timed("compare_dicts")
+    def _compare_documents(self, old_file, new_file):
+        self.stream1 = old_file
+        self.stream2 = new_file
+        return self.compare_dicts()
+
+    @timed("compare_dicts")
+    def compare_dicts(self, old_obj=None, new_obj=None):
+        """
+        Without arguments compare the two streams given to the constructor.
+        """
+        if old_obj is not None or new_obj is not None or \
+                self.stream1 is None or self.stream2 is None:
+            return Comparator.compare_dicts(self, old_obj, new_obj)
+
+        old_ev = file_events(self.stream1, self.chunk_size)
+        new_ev = file_events(self.stream2, self.chunk_size)
+        old_first = next(old_ev)
+        new_first = next(new_ev)
+        if old_first[0] == new_first[0] == "start_map":
+            result = self._stream_walk(old_ev, new_ev,
+                self._stream_dicts(old_ev, new_ev))
+            if result is _SAME:
+                result = {}
+        else:
+            result = Comparator.compare_dicts(self,
+                build_value(old_ev, *old_first),
+                build_value(new_ev, *new_first))
+
+        # check there is nothing after the top-level values
+        for _ in old_ev:
+            pass
+        for _ in new_ev:
+            pass
+        return result
+
+
+class DiffSession(object):
+    """
+    Diff of a reference document and a working copy, kept up to date
+    while the working copy is being edited.
+
+    After each edit of the working copy, changed (or apply_patch) compares
+    again just the edited values, so updating the result costs time
+    proportional to the edit, not to the documents. The digests and
+    indexes of the reference (which must not be changed) are kept by the
+    comparator between the updates.
+    """
+    def __init__(self, reference, working, comparator=None):
+        if comparator is None:
+            comparator = Comparator()
+        self.comparator = comparator
+        self.reference = reference
+        self.working = working
+        self.result = comparator.compare_dicts(reference, working)
+
+    def _path(self, pointer):
+        """Tuple path of the JSON pointer, with array indices as ints."""
+        path = []
+        new = self.working
+        old = self.reference
+        for key in parse_pointer(pointer):
+            if isinstance(new, list) or \
+                    new is _MISSING and isinstance(old, list):
+                try:
+                    key = int(key)
+                except ValueError:
+                    raise PatchError("Invalid array index %s" % key)
+            path.append(key)
+            new = _child(new, key)
+            old = _child(old, key)
+        return tuple(path)
+
+    def changed(self, path):
+        """
+        Update the result after the value on path (a JSON pointer or a
+        tuple of keys and indices) of the working copy changed, was added
+        or was removed. When elements were inserted to or removed from
+        an array (not at its end), the array itself changed.
+        """
+        if isinstance(path, basestring):
+            path = self._path(path)
+        comparator = self.comparator
+        # the working copy changed under the remembered digests
+        comparator.new_digests = SubtreeDigests()
+        comparator._new_root = self.working
+
+        old = self.reference
+        new = self.working
+        depth = 0
+        included = 0
+        try:
+            # find the deepest pair of values on path which can be
+            # compared alone (as a member of the containers above it)
+            while depth < len(path):
+                prefix = path[:depth]
+                if not (isinstance(old, dict) and isinstance(new, dict) or
+                        isinstance(old, list) and isinstance(new, list) and
+                        comparator._is_positional(prefix)):
+                    break
+                if comparator._filtering and depth > 0:
+                    # as _walk does for the containers above the value
+                    mode = comparator._filter_key(prefix)
+                    if mode == _SKIP:
+                        return
+                    if mode == _INCLUDE:
+                        comparator._included_depth += 1
+                        included += 1
+                old = _child(old, path[depth])
+                new = _child(new, path[depth])
+                depth += 1
+                if old is _MISSING or new is _MISSING:
+                    # added or removed value (or none at all)
+                    break
+            if depth == 0:
+                self.result = comparator.compare_dicts(self.reference,
+                    self.working)
+            else:
+                self._update(path[:depth], old, new)
+        finally:
+            comparator._included_depth -= included
+
+    def _update(self, path, old, new):
+        """Compare old and new on path again (one of them may be _MISSING)
+        and replace their entries of the result."""
+        comparator = self.comparator
+        changes = {
+            u"_append": {},
+            u"_remove": {},
+            u"_update": {},
+        }
+        key = path[-1]
+        if old is not _MISSING or new is not _MISSING:
+            comparator._record(changes, key, path, old, new)
+        if comparator.ignore_appended:
+            changes[u"_append"] = {}
+
+        # the result of the container of the value, with its ancestors
+        nodes = [self.result]
+        for name in path[:-1]:
+            nodes.append(nodes[-1].setdefault(u"_update", {}).
+                setdefault(name, {}))
+        node = nodes[-1]
+        for change_type, values in changes.iteritems():
+            if key in values:
+                node.setdefault(change_type, {})[key] = values[key]
+            elif key in node.get(change_type, ()):
+                del node[change_type][key]
+                if not node[change_type]:
+                    del node[change_type]
+        # no empty results of unchanged containers
+        for name in reversed(path[:-1]):
+            node = nodes.pop()
+            if node:
+                break
+            parent = nodes[-1]
+            del parent[u"_update"][name]
+            if not parent[u"_update"]:
+                del parent[u"_update"]
+
+    def apply_patch(self, operations):
+        """Apply JSON Patch operations to the working copy and update the
+        result."""
+        for operation in operations:
+            self.working = apply_patch(self.working, [operation])
+            op = operation[u"op"]
+            if op == u"test":
+                continue
+            # (pointer, whether an array element was inserted there)
+            pointers = [(operation[u"path"], op != u"remove")]
+            if op == u"move":
+                pointers.append((operation[u"from"], False))
+            for pointer, inserted in pointers:
+                parts = parse_pointer(pointer)
+                parent = None
+                if parts and op != u"replace":
+                    parent = _pointer_get(self.working, parts[:-1])
+                if isinstance(parent, list):
+                    end = len(parent) - 1 if inserted else len(parent)
+                    if parts[-1] == u"-":
+                        parts[-1] = unicode(end)
+                    elif parts[-1] != unicode(end):
+                        # indices of the following elements changed
+                        parts = parts[:-1]
+                self.changed(json_pointer(parts))
+        return self.working
+
+
+def _child(value, key):
+    """Member or element key of value, _MISSING when there is none."""
+    if isinstance(value, dict):
+        return value.get(key, _MISSING)
+    elif isinstance(value, list) and isinstance(key, (int, long)) and \
+            0 <= key < len(value):
+        return value[key]
+    return _MISSING
+
+
+def _tree_files(directory, pattern):
+    """Dictionary of the files matching pattern below directory, keyed by
+    their relative paths (with / as the separator)."""
+    directory = os.path.abspath(directory)
+    if not isinstance(directory, unicode):
+        directory = directory.decode(sys.getfilesystemencoding())
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(directory):
+        relative = os.path.relpath(dirpath, directory)
+        for name in filenames:
+            if not fnmatch(name, pattern):
+                continue
+            path = name
+            if relative != os.curdir:
+                path = u"/".join(relative.split(os.sep) + [name])
+            files[path] = os.path.join(dirpath, name)
+    return files
+
+
+def _sorted_records(fileobj, fields, run_size):
+    """Generate (key digests, line number, line) of the JSON Lines
+    records in fileobj, sorted by the digests of the values of the
+    fields."""
+    runs = []
+    try:
+        chunk = []
+        size = 0
+        digests = SubtreeDigests()
+        for line_no, line in enumerate(fileobj, 1):
+            if not line.strip():
+                continue
+            record = _parse_record((None, line_no, line))
+            try:
+                key = tuple([digests.digest(record[field])
+                    for field in fields])
+            except (KeyError, TypeError):
+                raise BadJSONError("Record on line %d has no %s" %
+                    (line_no, ", ".join(fields)))
+            chunk.append((key, line_no, line))
+            size += len(line)
+            if size >= run_size:
+                chunk.sort()
+                run = tempfile.TemporaryFile()
+                for entry in chunk:
+                    marshal.dump(entry, run)
+                run.seek(0)
+                runs.append(run)
+                chunk = []
+                size = 0
+                digests = SubtreeDigests()
+        chunk.sort()
+
+        previous = None
+        for entry in merge(chunk, *[_run_entries(run) for run in runs]):
+            if previous is not None and previous[0] == entry[0]:
+                raise BadJSONError("Records on lines %d and %d have the " \
+                    "same %s" % (previous[1], entry[1], ", ".join(fields)))
+            yield entry
+            previous = entry
+    finally:
+        for run in runs:
+            run.close()
+
+
+def _run_entries(run):
+    """Entries written by _sorted_records to the file run."""
+    while True:
+        try:
+            yield marshal.load(run)
+        except EOFError:
+            return
+
+
+def _parse_record(entry):
+    """Record of an entry of _sorted_records."""
+    try:
+        return load_json_text(entry[2])
+    except BadJSONError, exc:
+        raise BadJSONError("Line %d: %s" % (entry[1], exc))
+
+
+def _record_key(record, fields):
+    """Values of the fields of the record."""
+    return dict((field, record[field]) for field in fields)
+
+
+def file_digest(name):
+    """Hexadecimal SHA-1 of the bytes of the file called name."""
+    digest = sha1()
+    fileobj = open(name, "rb")
+    try:
+        for block in iter(lambda: fileobj.read(CHUNK_SIZE), ""):
+            digest.update(block)
+    finally:
+        fileobj.close()
+    return digest.hexdigest()
+
+
+class ResultCache(object):
+    """
+    On-disk cache of the results of comparing files.
+
+    Results are keyed by the hashes of the bytes of both files and by the
+    options of the Comparator which change the results, so on a hit
+    neither of the files is parsed. When the entries grow over max_size
+    bytes (or max_entries entries) the least recently used ones are
+    removed; their modification times are refreshed on each hit.
+    Several processes may share one directory.
+
+    hits and misses count the lookups of this object.
+    """
+    suffix = ".diff"
+    tmp_suffix = ".tmp"
+
+    def __init__(self, directory, max_size=CACHE_MAX_SIZE,
+            max_entries=None):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def options_key(comparator):
+        """Normalized options of comparator which change its results."""
+        align_cutoff = None
+        if comparator.array_align == "lcs":
+            align_cutoff = comparator.align_cutoff
+        return [
+            sorted(comparator.excluded_attributes),
+            sorted(comparator.included_attributes),
+            bool(comparator.ignore_appended),
+            comparator.backend,
+            comparator.array_align,
+            align_cutoff,
+            list(getattr(comparator.opts, "array_keys", None) or []),
+            comparator.abs_tol,
+            comparator.rel_tol,
+        ]
+
+    def key(self, old_name, new_name, comparator):
+        """Key of the result of comparing the files with comparator."""
+        # results are stored with marshal, bound to the version of Python
+        return sha1("\n".join([__version__, str(marshal.version),
+            file_digest(old_name), file_digest(new_name),
+            json.dumps(self.options_key(comparator))])).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key):
+        """Stored result, None when there is none."""
+        name = self._entry(key)
+        try:
+            fileobj = open(name, "rb")
+        except IOError:
+            self.misses += 1
+            return None
+        try:
+            try:
+                result = marshal.load(fileobj)
+            except (EOFError, ValueError, TypeError):
+                result = None
+        finally:
+            fileobj.close()
+        try:
+            if result is None:
+                logging.warning("Removing broken cache entry %s", name)
+                os.remove(name)
+            else:
+                os.utime(name, None)
+        except OSError:
+            # removed by another process meanwhile
+            pass
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def put(self, key, result):
+        """Store the result and evict the least recently used entries.
+        Returns False when the result cannot be stored."""
+        try:
+            data = marshal.dumps(result)
+        except ValueError, exc:
+            # nested too deeply for marshal
+            logging.warning("Result not cached: %s", exc)
+            return False
+        tmp_name = None
+        try:
+            handle, tmp_name = tempfile.mkstemp(suffix=self.tmp_suffix,
+                dir=self.directory)
+            try:
+                os.write(handle, data)
+            finally:
+                os.close(handle)
+            # readers see either no entry or the whole of it
+            os.rename(tmp_name, self._entry(key))
+        except (IOError, OSError), exc:
+            logging.warning("Result not cached: %s", exc)
+            if tmp_name is not None and os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            return False
+        self.evict()
+        return True
+
+    def evict(self):
+        """Remove the least recently used entries over the limits."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix) and \
+                    not name.endswith(self.tmp_suffix):
+                continue
+            name = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(name)
+            except OSError:
+                continue
+            if name.endswith(self.tmp_suffix):
+                # left over by a writer which crashed (after a while,
+                # it is not being written by another process)
+                if stat.st_mtime < time.time() - CACHE_TMP_AGE:
+                    try:
+                        os.remove(name)
+                    except OSError:
+                        pass
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+        entries.sort(reverse=True)
+        while entries and (total > self.max_size or
+                (self.max_entries is not None and
+                    len(entries) > self.max_entries)):
+            mtime, size, name = entries.pop()
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+            total -= size
+
+    def compare(self, old_name, new_name, opts=None,
+            comparator_class=Comparator):
+        """Result of comparing the files, computed only on a miss."""
+        key = self.key(old_name, new_name, comparator_class(opts=opts))
+        result = self.get(key)
+        if result is None:
+            with open(old_name) as old_file, open(new_name) as new_file:
+                result = comparator_class(opts=opts)._compare_documents(
+                    old_file, new_file)
+            self.put(key, result)
+        return result
+
+
+class BaselineStore(object):
+    """
+    Named baseline documents kept parsed, for DiffServer.
+
+    With each document the digests and indexes of its subtrees which
+    comparators compute are kept as well, so they are computed just once
+    for all the comparisons with the baseline. When the JSON texts of the
+    baselines grow over max_size bytes, the least recently used ones are
+    evicted. Safe for use from several threads.
+    """
+    def __init__(self, max_size=SERVER_MAX_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        # name: (document, SubtreeDigests, identities, size of the text)
+        self._baselines = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, name, text, prune_identical=False):
+        """Parse and keep the baseline text under name."""
+        doc = load_json_text(text)
+        digests = SubtreeDigests()
+        if prune_identical:
+            digests.digest(doc)
+        with self._lock:
+            self._remove(name)
+            self._baselines[name] = (doc, digests, {}, len(text))
+            self.size += len(text)
+            while self.size > self.max_size and len(self._baselines) > 1:
+                self._remove(next(iter(self._baselines)))
+
+    def get(self, name):
+        """The baseline (see comparator) called name, None when there is
+        none."""
+        with self._lock:
+            baseline = self._baselines.pop(name, None)
+            if baseline is not None:
+                # the most recently used one
+                self._baselines[name] = baseline
+            return baseline
+
+    def remove(self, name):
+        """Forget the baseline called name; False when there is none."""
+        with self._lock:
+            return self._remove(name)
+
+    def _remove(self, name):
+        baseline = self._baselines.pop(name, None)
+        if baseline is None:
+            return False
+        self.size -= baseline[3]
+        return True
+
+    def names(self):
+        """Names of the baselines, the least recently used first."""
+        with self._lock:
+            return list(self._baselines)
+
+    @staticmethod
+    def comparator(baseline, opts=None):
+        """Comparator sharing the digests and indexes of the baseline."""
+        doc, digests, identities, size = baseline
+        comparator = Comparator(opts=opts)
+        # worker processes cannot be forked from the threads of a server
+        comparator.jobs = 1
+        comparator._old_root = doc
+        comparator.old_digests = digests
+        comparator._old_identities = identities
+        return comparator
+
+
+class DiffRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    HTTP interface of DiffServer. The path names a baseline:
+
+        PUT /name       keep the document in the body as baseline name
+        POST /name      compare baseline name with the document in the body
+        DELETE /name    forget baseline name
+        GET /           list names of the baselines
+
+    POST takes the output format (format=json, html or patch), compact=1
+    and max_rows=N in the query string; the X-JSON-Diff-Different header
+    of the response is 1 when the documents differ. Bodies larger than
+    max_body of the server are refused.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        self.disable_nagle_algorithm = \
+            self.server.address_family != socket.AF_UNIX
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+    def address_string(self):
+        if self.server.address_family == socket.AF_UNIX:
+            return "unix"
+        return self.client_address[0]
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+    def _respond(self, code, body="", content_type="application/json",
+            headers=()):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, code, message):
+        self._respond(code, json.dumps({"error": message}) + "\n")
+
+    def _request(self):
+        """Name of the baseline, query parameters and the body of the
+        request; None when the request is refused (and answered)."""
+        url = urlsplit(self.path)
+        try:
+            name = unquote(url.path.lstrip("/")).decode("utf-8")
+        except UnicodeDecodeError:
+            return self._refuse(400, "Name of the baseline is not UTF-8.")
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            return self._refuse(400, "Invalid Content-Length.")
+        if length > self.server.max_body:
+            return self._refuse(413, "Request body is larger than %d " \
+                "bytes." % self.server.max_body)
+        params = dict((key, values[-1]) for key, values in
+            parse_qs(url.query).iteritems())
+        body = self.rfile.read(length)
+        return name, params, body
+
+    def _refuse(self, code, message):
+        """Answer a request whose body has not been read."""
+        self.close_connection = 1
+        self._error(code, message)
+        return None
+
+    def do_GET(self):
+        request = self._request()
+        if request is None:
+            return
+        name, params, body = request
+        if name:
+            self._error(405, "Only the list of baselines can be read.")
+            return
+        self._respond(200, json.dumps(self.server.baselines.names()) + "\n")
+
+    def do_PUT(self):
+        request = self._request()
+        if request is None:
+            return
+        name, params, body = request
+        if not name:
+            self._error(400, "Baseline needs a name.")
+            return
+        try:
+            self.server.baselines.put(name, body,
+                getattr(self.server.opts, "prune_identical", False))
+        except BadJSONError, exc:
+            self._error(400, unicode(exc))
+            return
+        self._respond(201)
+
+    def do_DELETE(self):
+        request = self._request()
+        if request is None:
+            return
+        name, params, body = request
+        if self.server.baselines.remove(name):
+            self._respond(204)
+        else:
+            self._error(404, "No baseline %s." % name)
+
+    def do_POST(self):
+        request = self._request()
+        if request is None:
+            return
+        name, params, body = request
+        baseline = self.server.baselines.get(name)
+        if baseline is None:
+            self._error(404, "No baseline %s." % name)
+            return
+        output_format = params.get("format", "json")
+        if output_format not in FORMATS:
+            self._error(400, "Unknown format %s." % output_format)
+            return
+        try:
+            candidate = load_json_text(body)
+            max_rows = params.get("max_rows")
+            if max_rows is not None:
+                max_rows = int(max_rows)
+        except (BadJSONError, ValueError), exc:
+            self._error(400, unicode(exc))
+            return
+        compact = params.get("compact", "0") not in ("", "0")
+
+        diff = BaselineStore.comparator(baseline, self.server.opts)
+        out = StringIO()
+        try:
+            if output_format == "patch":
+                operations = list(patch_operations(diff.iter_changes(
+                    baseline[0], candidate)))
+                different = len(operations) > 0
+                write_patch(operations, out, compact)
+            else:
+                diff_res = diff.compare_dicts(baseline[0], candidate)
+                different = diff_res != {}
+                write_result(diff_res, out, output_format == "html",
+                    max_rows, compact)
+        except Exception, exc:
+            # answered rather than dropping the connection
+            logging.exception("Comparison with baseline %s failed", name)
+            self._error(500, "Comparison failed: %s" % exc)
+            return
+        self._respond(200, out.getvalue(),
+            SERVER_CONTENT_TYPES[output_format],
+            [("X-JSON-Diff-Different", str(int(different)))])
+
+
+class DiffServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Resident HTTP server comparing documents with baselines kept in
+    memory (see DiffRequestHandler), handling each connection in its own
+    thread. Address is a (host, port) pair, or the path of a Unix socket.
+    Comparators are created with opts; max_size limits the baselines
+    (see BaselineStore) and max_body the size of the requests.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, opts=None, max_size=SERVER_MAX_SIZE,
+            max_body=SERVER_MAX_BODY):
+        if isinstance(address, basestring):
+            self.address_family = socket.AF_UNIX
+        self.opts = opts
+        self.max_body = max_body
+        self.baselines = BaselineStore(max_size)
+        BaseHTTPServer.HTTPServer.__init__(self, address, DiffRequestHandler)
+
+    def server_bind(self):
+        if self.address_family != socket.AF_UNIX:
+            BaseHTTPServer.HTTPServer.server_bind(self)
+            return
+        if os.path.exists(self.server_address) and \
+                stat.S_ISSOCK(os.stat(self.server_address).st_mode):
+            # left over by a previous server
+            os.unlink(self.server_address)
+        SocketServer.TCPServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        if self.address_family == socket.AF_UNIX:
+            os.unlink(self.server_address)
+
+
+def main(sys_args):
+    """Main function, to process command line arguments etc."""
+    usage = "usage: %prog [options] old.json new.json\n" + \
+        "       %prog [options] old_dir new_dir\n" + \
+        "       %prog [options] --records FIELD old.jsonl new.jsonl\n" + \
+        "       %prog [options] --baseline old.json new.json...\n" + \
+        "       %prog [options] --merge base.json ours.json theirs.json\n" + \
+        "       %prog [options] --serve ADDRESS [name=baseline.json...]"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-x", "--exclude",
+      action="append", dest="exclude", metavar="ATTR", default=[],
+      help="attributes which should be ignored when comparing " +
+        "(key names, /glob/*/paths or $.json[*].paths)")
+    parser.add_option("-i", "--include",
+      action="append", dest="include", metavar="ATTR", default=[],
+      help="attributes which should be exclusively used when comparing " +
+        "(key names, /glob/*/paths or $.json[*].paths)")
+    parser.add_option("-a", "--ignore-append",
+      action="store_true", dest="ignore_append", metavar="BOOL", default=False,
+      help="ignore appended keys")
+    parser.add_option("-H", "--HTML",
+      action="store_true", dest="HTMLoutput", metavar="BOOL", default=False,
+      help="program should output to HTML report")
+    parser.add_option("-f", "--format",
+      type="choice", choices=FORMATS, dest="format",
+      metavar="FORMAT", default="json",
+      help="output format: json (default), html (same as -H), or patch " +
+        "(JSON Patch, RFC 6902)")
+    parser.add_option("-C", "--compact",
+      action="store_true", dest="compact", metavar="BOOL", default=False,
+      help="write JSON output without indentation")
+    parser.add_option("--max-rows",
+      type="int", dest="max_rows", metavar="N",
+      help="show at most N entries of each object or array in HTML report")
+    parser.add_option("-s", "--stream",
+      action="store_true", dest="stream", metavar="BOOL", default=False,
+      help="compare the files without loading them whole into memory")
+    parser.add_option("--prune-identical",
+      action="store_true", dest="prune_identical", metavar="BOOL",
+      default=False,
+      help="skip identical subtrees using their content hashes")
+    parser.add_option("-A", "--array-align",
+      type="choice", choices=ARRAY_ALIGNMENTS, dest="array_align",
+      metavar="MODE", default="position",
+      help="how to pair elements of arrays: position (default) " +
+        "or lcs (report real insertions and deletions)")
+    parser.add_option("--align-cutoff",
+      type="int", dest="align_cutoff", metavar="N", default=ALIGN_CUTOFF,
+      help="use positional pairing for arrays differing in more " +
+        "than N elements (default %default)")
+    parser.add_option("-b", "--backend",
+      type="choice", choices=BACKENDS, dest="backend",
+      metavar="NAME", default="default",
+      help="diff engine: default, or xdiff comparing arrays as " +
+        "unordered collections")
+    parser.add_option("-j", "--jobs",
+      type="int", dest="jobs", metavar="N", default=1,
+      help="diff top-level sections in N processes")
+    parser.add_option("-l", "--lazy",
+      action="store_true", dest="lazy", metavar="BOOL", default=False,
+      help="map the files into memory and parse only parts which differ")
+    parser.add_option("--abs-tol",
+      type="float", dest="abs_tol", metavar="X", default=0.0,
+      help="numbers differing by at most X are the same")
+    parser.add_option("--rel-tol",
+      type="float", dest="rel_tol", metavar="X", default=0.0,
+      help="numbers differing by at most X times the larger of them " +
+        "are the same")
+    parser.add_option("-k", "--key",
+      action="append", dest="array_keys", metavar="PATH=FIELD", default=[],
+      help="pair elements of arrays on PATH by the value of FIELD " +
+        "(or several comma separated fields)")
+    parser.add_option("-p", "--patch",
+      dest="patch", metavar="DIFF",
+      help="apply DIFF (json_diff result or JSON Patch) to the file " +
+        "given as argument and write the patched document")
+    parser.add_option("--verify",
+      dest="verify", metavar="HASH",
+      help="with --patch, check the content hash of the patched document")
+    parser.add_option("--snapshot",
+      dest="snapshot", metavar="FILE",
+      help="compile the file given as argument to the snapshot FILE, " +
+        "which can be used instead of it")
+    parser.add_option("--digest",
+      action="store_true", dest="digest", metavar="BOOL", default=False,
+      help="print content hashes of the files given as arguments")
+    parser.add_option("--merge",
+      action="store_true", dest="merge", metavar="BOOL", default=False,
+      help="merge changes of the second and third file against the " +
+        "first one, write the merged document and conflicts to " +
+        "standard error")
+    parser.add_option("--baseline",
+      dest="baseline", metavar="FILE",
+      help="compare FILE with each of the files given as arguments")
+    parser.add_option("-o", "--output-dir",
+      dest="output_dir", metavar="DIR",
+      help="with --baseline, write result for each file to DIR")
+    parser.add_option("--pattern",
+      dest="pattern", metavar="GLOB", default=TREE_PATTERN,
+      help="when comparing directories, compare the files matching " +
+        "GLOB (default %default)")
+    parser.add_option("--checksum",
+      action="store_true", dest="checksum", metavar="BOOL", default=False,
+      help="when comparing directories, compare also files with the " +
+        "same size and modification time")
+    parser.add_option("--records",
+      dest="records", metavar="FIELD[,FIELD...]",
+      help="compare JSON Lines files record by record, pairing the " +
+        "records by the values of FIELD; the differences are written " +
+        "as JSON Lines")
+    parser.add_option("--serve",
+      dest="serve", metavar="ADDRESS",
+      help="run a server comparing documents with baselines kept in " +
+        "memory, listening on ADDRESS (host:port or path of a Unix " +
+        "socket); baselines may be given as name=FILE arguments")
+    parser.add_option("--baselines-size",
+      type="int", dest="baselines_size", metavar="MB",
+      default=SERVER_MAX_SIZE // (1024 * 1024),
+      help="with --serve, evict least recently used baselines over MB " +
+        "megabytes of JSON")
+    parser.add_option("--max-request-size",
+      type="int", dest="max_request_size", metavar="MB",
+      default=SERVER_MAX_BODY // (1024 * 1024),
+      help="with --serve, refuse documents over MB megabytes")
+    parser.add_option("--stats",
+      action="store_true", dest="stats", metavar="BOOL", default=False,
+      help="print timings and counts of the comparison as JSON " +
+        "to standard error")
+    parser.add_option("--cache",
+      dest="cache", metavar="DIR",
+      help="keep results in DIR and reuse them for the same files " +
+        "and options")
+    parser.add_option("--cache-size",
+      type="int", dest="cache_size", metavar="MB",
+      default=CACHE_MAX_SIZE // (1024 * 1024),
+      help="evict least recently used results from --cache over MB " +
+        "megabytes")
+    (options, args) = parser.parse_args(sys_args[1:])
+
+    try:
+        parse_array_keys(options.array_keys)
+    except ValueError, exc:
+        parser.error(str(exc))
+    if options.abs_tol < 0 or options.rel_tol < 0:
+        parser.error("Tolerance cannot be negative.")
+    if options.HTMLoutput:
+        options.format = "html"
+    options.HTMLoutput = options.format == "html"
+    if options.format == "patch" and (options.stream or options.baseline):
+        parser.error("Patch format cannot be used with --stream " +
+            "or --baseline.")
+    if options.serve:
+        return server_main(parser, options, args)
+    if options.snapshot:
+        return snapshot_main(parser, options, args)
+    if options.digest:
+        return digest_main(parser, options, args)
+    if options.patch:
+        return patch_main(parser, options, args)
+    if options.merge:
+        return merge_main(parser, options, args)
+    if options.baseline:
+        return batch_main(parser, options, args)
+
+    if len(args) != 2:
+        parser.error("Script requires two positional arguments, " + \
+            "names for old and new JSON file.")
+    if options.records:
+        return records_main(parser, options, args)
+    if os.path.isdir(args[0]) or os.path.isdir(args[1]):
+        return tree_main(parser, options, args)
+    if options.cache:
+        if options.format == "patch":
+            parser.error("Patch format cannot be used with --cache.")
+        if options.stats:
+            parser.error("--stats cannot be used with --cache.")
+        comparator_class = Comparator
+        if options.stream:
+            comparator_class = StreamComparator
+        cache = ResultCache(options.cache, options.cache_size * 1024 * 1024)
+        diff_res = cache.compare(args[0], args[1], options, comparator_class)
+        logging.debug("cache hits %d, misses %d", cache.hits, cache.misses)
+        write_result(diff_res, sys.stdout, options.HTMLoutput,
+            options.max_rows, options.compact)
+        return int(diff_res != {})
+    if options.stream:
+        diff = StreamComparator(open(args[0]), open(args[1]), options)
+    else:
+        diff = Comparator(open(args[0]), open(args[1]), options)
+    if options.format == "patch":
+        # the documents are walked while the patch is written
+        with stats_timer(diff.stats, "format"):
+            operations = patch_operations(diff.iter_changes())
+            first = next(operations, None)
+            if first is not None:
+                operations = chain([first], operations)
+            write_patch(operations, sys.stdout, options.compact)
+        if diff.stats is not None:
+            write_stats(diff.stats, sys.stderr)
+        return int(first is not None)
+    diff_res = diff.compare_dicts()
+    with stats_timer(diff.stats, "format"):
+        write_result(diff_res, sys.stdout, options.HTMLoutput,
+            options.max_rows, options.compact)
+    if diff.stats is not None:
+        write_stats(diff.stats, sys.stderr)
+
+    if diff_res != {}:
+        return 1
+
+    return 0
+
+
+def write_result(diff_res, out, html=False, max_rows=None, compact=False):
+    """Write the diff as JSON or HTML (in UTF-8) to the file object out."""
+    if html:
+        # we want to hardcode UTF-8 here, because that's what's
+        # in <meta> element of the generated HTML
+        HTMLFormatter(diff_res, max_rows).write(out, "utf-8")
+        out.write("\n")
+    else:
+        write_pieces(iter_json(diff_res, compact), out, "utf-8")
+        out.write("\n")
+
+
+def write_stats(stats, out):
+    """Write ComparatorStats as JSON to the file object out."""
+    out.write(json.dumps(stats.as_dict(), indent=4, sort_keys=True))
+    out.write("\n")
+
+
+def write_patch(operations, out, compact=False):
+    """Write JSON Patch operations (in UTF-8) to the file object out as
+    they come."""
+    write_pieces(iter_json_array(operations, compact), out, "utf-8")
+    out.write("\n")
+
+
+def digest_main(parser, options, args):
+    """Print content hashes of the files in args."""
+    if len(args) < 1:
+        parser.error("Script requires names of the JSON files with --digest.")
+    for name in args:
+        digest = EventDigest()
+        fileobj = open(name, "rb")
+        try:
+            if is_snapshot(fileobj):
+                # snapshots keep the digests
+                root = SnapshotDocument(fileobj).root
+                if isinstance(root, SnapshotNode):
+                    digest.hexdigest = root.digest().encode("hex")
+                else:
+                    digest.feed("value", root)
+            else:
+                for event, value in file_events(fileobj):
+                    digest.feed(event, value)
+        finally:
+            fileobj.close()
+        print("%s  %s" % (digest.hexdigest, name))
+    return 0
+
+
+def snapshot_main(parser, options, args):
+    """Compile the file in args to the --snapshot."""
+    if len(args) != 1:
+        parser.error("Script requires the name of the JSON file " +
+            "to compile with --snapshot.")
+    value = load_json_file(args[0])
+    out = open(options.snapshot, "wb")
+    try:
+        write_snapshot(value, out)
+    finally:
+        out.close()
+    return 0
+
+
+def patch_main(parser, options, args):
+    """Apply --patch to the file in args."""
+    if len(args) != 1:
+        parser.error("Script requires the name of the JSON file " +
+            "to patch with --patch.")
+    diff = load_json_file(options.patch)
+    if options.stream and isinstance(diff, list):
+        parser.error("JSON Patch cannot be applied with --stream.")
+
+    try:
+        if options.stream:
+            # the patched document is not kept, so to be verified before
+            # it is written the document is patched twice
+            result_digest = None
+            if options.verify is not None:
+                digest = EventDigest()
+                with open(args[0], "rb") as doc_file:
+                    for event, value in patch_events(file_events(doc_file),
+                            diff):
+                        digest.feed(event, value)
+                result_digest = digest.hexdigest
+            if options.verify is None or options.verify == result_digest:
+                with open(args[0], "rb") as doc_file:
+                    write_pieces(iter_events_json(patch_events(
+                        file_events(doc_file), diff)), sys.stdout, "utf-8")
+                sys.stdout.write("\n")
+        else:
+            doc = load_json_file(args[0])
+            if isinstance(diff, list):
+                doc = apply_patch(doc, diff)
+            else:
+                doc = apply_diff(doc, diff)
+            result_digest = SubtreeDigests().hexdigest(doc)
+            if options.verify is None or options.verify == result_digest:
+                write_result(doc, sys.stdout, compact=options.compact)
+    except PatchError, exc:
+        sys.stderr.write("Cannot apply %s: %s\n" % (options.patch, exc))
+        return 1
+
+    if options.verify is not None and options.verify != result_digest:
+        sys.stderr.write("Verification failed: the patched document has " +
+            "hash %s\n" % result_digest)
+        return 1
+    return 0
+
+
+def merge_main(parser, options, args):
+    """Three-way merge of the files in args."""
+    if len(args) != 3:
+        parser.error("Script requires names of the base, our and their " +
+            "JSON files with --merge.")
+    base, ours, theirs = [load_json_file(name) for name in args]
+    merged, conflicts = Comparator(opts=options).merge(base, ours, theirs)
+    write_result(merged, sys.stdout, compact=options.compact)
+    if conflicts:
+        write_pieces(iter_json(conflicts, compact=True), sys.stderr,
+            "utf-8")
+        sys.stderr.write("\n")
+        return 1
+    return 0
+
+
+def tree_main(parser, options, args):
+    """Compare the directories in args."""
+    if not (os.path.isdir(args[0]) and os.path.isdir(args[1])):
+        parser.error("Both arguments have to be directories, or files.")
+    if options.format == "patch":
+        parser.error("Patch format cannot be used with directories.")
+    if options.cache or options.stats:
+        parser.error("--cache and --stats cannot be used with directories.")
+    if options.stream:
+        diff = StreamComparator(opts=options)
+    else:
+        diff = Comparator(opts=options)
+    diff_res = diff.compare_trees(args[0], args[1], options.pattern,
+        not options.checksum)
+    logging.debug("%d files changed, %d added, %d removed",
+        len(diff_res.get(u"_update", ())), len(diff_res.get(u"_append", ())),
+        len(diff_res.get(u"_remove", ())))
+    write_result(diff_res, sys.stdout, options.HTMLoutput,
+        options.max_rows, options.compact)
+    return int(diff_res != {})
+
+
+def records_main(parser, options, args):
+    """Compare the JSON Lines files in args record by record."""
+    if options.format != "json" or options.stream or options.cache:
+        parser.error("--records can be used only with JSON output, " +
+            "without --stream and --cache.")
+    fields = [field for field in options.records.split(",") if field]
+    if not fields:
+        parser.error("--records names no field.")
+    diff = Comparator(opts=options)
+    different = False
+    for change in diff.compare_records(open(args[0]), open(args[1]), fields):
+        different = True
+        write_pieces(iter_json(change, compact=True), sys.stdout, "utf-8")
+        sys.stdout.write("\n")
+    if diff.stats is not None:
+        write_stats(diff.stats, sys.stderr)
+    return int(different)
+
+
+def server_main(parser, options, args):
+    """Run DiffServer on --serve with the baselines in args."""
+    if options.stream or options.cache or options.stats:
+        parser.error("--serve cannot be used with --stream, --cache " +
+            "and --stats.")
+    address = options.serve
+    if "/" not in address:
+        host, _, port = address.rpartition(":")
+        try:
+            address = (host or "localhost", int(port))
+        except ValueError:
+            parser.error("Server address has to be host:port or a path.")
+    baselines = []
+    for arg in args:
+        if "=" not in arg:
+            parser.error("Baselines have to be given as name=FILE.")
+        baselines.append(arg.split("=", 1))
+
+    server = DiffServer(address, options,
+        options.baselines_size * 1024 * 1024,
+        options.max_request_size * 1024 * 1024)
+    try:
+        for name, file_name in baselines:
+            with open(file_name) as fileobj:
+                server.baselines.put(name.decode("utf-8"), fileobj.read(),
+                    options.prune_identical)
+        logging.info("Listening on %s", options.serve)
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+def batch_main(parser, options, args):
+    """Compare --baseline with all the files in args."""
+    if len(args) < 1:
+        parser.error("Script requires names of the candidate JSON files " +
+            "with --baseline.")
+    if options.stream or options.cache:
+        parser.error("--baseline cannot be used with --stream and --cache.")
+    if options.output_dir:
+        names = [os.path.basename(name) for name in args]
+        if len(set(names)) != len(names):
+            parser.error("Candidate files must have different names " +
+                "with --output-dir.")
+    elif options.HTMLoutput:
+        parser.error("HTML output with --baseline requires --output-dir.")
+
+    diff = Comparator(open(options.baseline), None, options)
+    if not options.output_dir:
+        different = []
+
+        def results():
+            for name, diff_res in diff.compare_batch(args):
+                if diff_res != {}:
+                    different.append(name)
+                yield name, diff_res
+        # written out as they come
+        write_result(results(), sys.stdout, compact=options.compact)
+        if diff.stats is not None:
+            write_stats(diff.stats, sys.stderr)
+        return int(len(different) > 0)
+
+    different = False
+    for name, diff_res in diff.compare_batch(args):
+        different = different or diff_res != {}
+        if options.HTMLoutput:
+            suffix = ".diff.html"
+        else:
+            suffix = ".diff.json"
+        out = open(os.path.join(options.output_dir,
+            os.path.basename(name) + suffix), "w")
+        try:
+            with stats_timer(diff.stats, "format"):
+                write_result(diff_res, out, options.HTMLoutput,
+                    options.max_rows, options.compact)
+        finally:
+            out.close()
+
+    if diff.stats is not None:
+        write_stats(diff.stats, sys.stderr)
+    if different:
+        return 1
     return 0
 
 if __name__ == "__main__":
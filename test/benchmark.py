@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of json_diff on generated documents.
+
+Every measurement runs in its own process, so that the peak memory
+(maximum resident set size) reported is of just that measurement.
+Documents are generated from a seeded random generator, so the same
+command line produces the same documents in every run and with every
+version of json_diff.
+
+    python test/benchmark.py -s 1000,10000 -o before.json
+    python test/benchmark.py -s 1000,10000 -o after.json
+    python test/benchmark.py --compare before.json after.json
+"""
+from __future__ import division
+import json
+import sys
+import os
+import platform
+import random
+import time
+import multiprocessing
+from optparse import OptionParser
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+import json_diff
+
+DEFAULT_SIZES = (1000, 10000)
+# fraction of changed values in the sparse and dense variants
+RATIOS = {"sparse": 0.01, "dense": 0.3}
+# maximal depth of the deep_nesting documents, which keeps some width
+# at every level (deep_chain goes as deep as its size)
+MAX_DEPTH = 200
+TARGETS = ("compare_dicts", "compare_arrays", "filter_results", "html")
+
+
+def random_scalar(rnd):
+    kind = rnd.randint(0, 3)
+    if kind == 0:
+        return rnd.randint(-1000000, 1000000)
+    elif kind == 1:
+        return rnd.random()
+    elif kind == 2:
+        return u"value %d" % rnd.randint(0, 1000000)
+    return rnd.choice([True, False, None])
+
+
+def wide_dict(rnd, size):
+    """One object with size scalar members."""
+    return dict((u"key%d" % i, random_scalar(rnd)) for i in xrange(size))
+
+
+def deep_nesting(rnd, size):
+    """Objects nested into each other, size scalars altogether."""
+    depth = min(MAX_DEPTH, max(1, int(size ** 0.5)))
+    width = max(1, size // depth)
+    root = node = {}
+    for level in xrange(depth):
+        for i in xrange(width):
+            node[u"key%d" % i] = random_scalar(rnd)
+        node[u"child"] = {}
+        node = node[u"child"]
+    return root
+
+
+def deep_chain(rnd, size):
+    """Objects nested size levels deep, with one scalar on each level;
+    deeper than the recursion limit at the default sizes."""
+    root = node = {}
+    for level in xrange(size):
+        node[u"value"] = random_scalar(rnd)
+        node[u"child"] = {}
+        node = node[u"child"]
+    return root
+
+
+def mutate_chain(rnd, value, ratio):
+    """Copy of the deep_chain value with about ratio of the scalars (and
+    always the deepest one) changed, made without recursion."""
+    root = node = {}
+    while value:
+        node[u"value"] = value[u"value"]
+        if rnd.random() < ratio or not value[u"child"]:
+            node[u"value"] = random_scalar(rnd)
+            while node[u"value"] == value[u"value"]:
+                node[u"value"] = random_scalar(rnd)
+        node[u"child"] = {}
+        node = node[u"child"]
+        value = value[u"child"]
+    return root
+
+
+def record(rnd, ident):
+    return {u"id": ident, u"name": u"item %d" % ident,
+            u"value": random_scalar(rnd)}
+
+
+def long_array(rnd, size):
+    """Array of size small objects."""
+    return {u"items": [record(rnd, i) for i in xrange(size)]}
+
+
+def mutate(rnd, value, ratio):
+    """Copy of value with about ratio of the scalars changed and of the
+    array elements removed or inserted."""
+    if isinstance(value, dict):
+        return dict((key, mutate(rnd, item, ratio))
+            for key, item in value.iteritems())
+    elif isinstance(value, list):
+        out = []
+        for item in value:
+            dice = rnd.random()
+            if dice < ratio / 4:
+                continue
+            elif dice < ratio / 2:
+                out.append(record(rnd, rnd.randint(0, 1000000)))
+            out.append(mutate(rnd, item, ratio))
+        return out
+    elif rnd.random() < ratio:
+        return random_scalar(rnd)
+    return value
+
+
+def reorder(rnd, value, ratio):
+    """mutate and move about ratio of the array elements elsewhere."""
+    value = mutate(rnd, value, ratio)
+    items = value[u"items"]
+    for i in xrange(int(len(items) * ratio)):
+        items.insert(rnd.randint(0, len(items) - 1),
+                     items.pop(rnd.randint(0, len(items) - 1)))
+    return value
+
+# name: (generator of the old document, generator of the new one from it)
+CASES = {
+    "wide_dict": (wide_dict, mutate),
+    "deep_nesting": (deep_nesting, mutate),
+    "deep_chain": (deep_chain, mutate_chain),
+    "long_array": (long_array, mutate),
+    "reordered_list": (long_array, reorder),
+}
+
+
+def generate(case, size, ratio, seed):
+    """Old and new documents of the case."""
+    rnd = random.Random("%s-%d-%s" % (case, size, seed))
+    make_old, make_new = CASES[case]
+    old = make_old(rnd, size)
+    return old, make_new(rnd, old, ratio)
+
+
+def peak_memory():
+    """Maximum resident set size of this process in kB."""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        usage //= 1024
+    return usage
+
+
+def measure(case, size, ratio, target, opts, seed):
+    """Run target once on the documents of the case.
+
+    Returns (seconds, kB of memory on top of the documents) or None when
+    the target does not apply to the case."""
+    old, new = generate(case, size, ratio, seed)
+    diffator = json_diff.Comparator(opts=opts)
+    if target == "compare_arrays":
+        if not isinstance(old.get(u"items"), list):
+            return None
+        run = lambda: diffator._compare_arrays(old[u"items"], new[u"items"],
+            (u"items",))
+    elif target == "compare_dicts":
+        run = lambda: diffator.compare_dicts(old, new)
+    else:
+        result = diffator.compare_dicts(old, new)
+        if target == "filter_results":
+            run = lambda: diffator._filter_results(result)
+        else:
+            run = lambda: unicode(json_diff.HTMLFormatter(result))
+    before = peak_memory()
+    start = time.time()
+    run()
+    seconds = time.time() - start
+    if before is None:
+        return seconds, None
+    return seconds, peak_memory() - before
+
+
+def _measure_child(queue, args):
+    try:
+        queue.put(measure(*args))
+    except Exception, exc:
+        queue.put(exc)
+
+
+def measure_isolated(*args):
+    """measure in a fresh process."""
+    queue = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_measure_child,
+        args=(queue, args))
+    child.start()
+    res = queue.get()
+    child.join()
+    if isinstance(res, Exception):
+        raise res
+    return res
+
+
+def run_benchmarks(cases, sizes, targets, opts, repeat=3, seed=0,
+        log=None):
+    """List of results of all the combinations, the best of repeat runs
+    each."""
+    results = []
+    for case in cases:
+        for size in sizes:
+            for density, ratio in sorted(RATIOS.items()):
+                for target in targets:
+                    runs = [measure_isolated(case, size, ratio, target, opts,
+                        seed) for i in range(repeat)]
+                    if runs[0] is None:
+                        continue
+                    res = {
+                        "case": case,
+                        "size": size,
+                        "density": density,
+                        "target": target,
+                        "seconds": min(run[0] for run in runs),
+                        "peak_kb": runs[0][1],
+                    }
+                    if log:
+                        log.write("%(case)s %(size)d %(density)s " \
+                            "%(target)s: %(seconds).4f s\n" % res)
+                    results.append(res)
+    return results
+
+
+def _result_key(res):
+    return (res["case"], res["size"], res["density"], res["target"])
+
+
+def compare_results(old_results, new_results, threshold, out=sys.stdout):
+    """Print time and memory of the new results relative to the old ones.
+
+    Returns number of measurements slower than threshold times the old
+    ones."""
+    old_map = dict((_result_key(res), res) for res in old_results)
+    regressions = 0
+    for res in new_results:
+        old = old_map.get(_result_key(res))
+        if old is None:
+            continue
+        ratio = res["seconds"] / max(old["seconds"], 1e-6)
+        mark = ""
+        if ratio > threshold:
+            mark = " REGRESSION"
+            regressions += 1
+        memory = ""
+        if res["peak_kb"] is not None and old["peak_kb"] is not None:
+            memory = ", %+d kB" % (res["peak_kb"] - old["peak_kb"])
+        out.write("%s %d %s %s: %.4f -> %.4f s (%.2fx%s)%s\n" %
+            (_result_key(res) + (old["seconds"], res["seconds"], ratio,
+                memory, mark)))
+    return regressions
+
+
+def main(sys_args):
+    usage = "usage: %prog [options]\n       %prog --compare old.json new.json"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-c", "--case",
+      action="append", dest="cases", metavar="NAME", default=[],
+      help="run only case NAME (%s)" % ", ".join(sorted(CASES)))
+    parser.add_option("-t", "--target",
+      action="append", dest="targets", metavar="NAME", default=[],
+      help="measure only NAME (%s)" % ", ".join(TARGETS))
+    parser.add_option("-s", "--sizes",
+      dest="sizes", metavar="N,N...",
+      default=",".join(str(size) for size in DEFAULT_SIZES),
+      help="comma separated sizes of the documents")
+    parser.add_option("-r", "--repeat",
+      type="int", dest="repeat", metavar="N", default=3,
+      help="take the best of N runs")
+    parser.add_option("--seed",
+      dest="seed", default="0",
+      help="seed of the generated documents")
+    parser.add_option("-A", "--array-align",
+      type="choice", choices=json_diff.ARRAY_ALIGNMENTS,
+      dest="array_align", default="position",
+      help="how to pair elements of arrays")
+    parser.add_option("-b", "--backend",
+      type="choice", choices=json_diff.BACKENDS,
+      dest="backend", default="default",
+      help="comparison backend")
+    parser.add_option("-j", "--jobs",
+      type="int", dest="jobs", metavar="N", default=1,
+      help="diff top-level sections in N processes")
+    parser.add_option("-o", "--output",
+      dest="output", metavar="FILE",
+      help="write results to FILE instead of standard output")
+    parser.add_option("--compare",
+      action="store_true", dest="compare", default=False,
+      help="compare two result files")
+    parser.add_option("--threshold",
+      type="float", dest="threshold", default=1.2,
+      help="with --compare, slowdown ratio reported as a regression")
+    # the rest of the options of Comparator
+    parser.set_defaults(exclude=None, include=None, ignore_append=False)
+    (options, args) = parser.parse_args(sys_args[1:])
+
+    if options.compare:
+        if len(args) != 2:
+            parser.error("Two result files are needed for --compare!")
+        old, new = [json.load(open(name))["results"] for name in args]
+        return int(compare_results(old, new, options.threshold) > 0)
+
+    for case in options.cases:
+        if case not in CASES:
+            parser.error("Unknown case %s!" % case)
+    for target in options.targets:
+        if target not in TARGETS:
+            parser.error("Unknown target %s!" % target)
+    try:
+        sizes = [int(size) for size in options.sizes.split(",")]
+    except ValueError:
+        parser.error("Sizes have to be integers!")
+
+    results = run_benchmarks(options.cases or sorted(CASES), sizes,
+        options.targets or TARGETS, options, options.repeat,
+        options.seed, sys.stderr)
+    report = {
+        "version": json_diff.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if options.output:
+        out = open(options.output, "w")
+    else:
+        out = sys.stdout
+    json.dump(report, out, indent=4, sort_keys=True)
+    out.write("\n")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -10,8 +10,15 @@ try:
 except ImportError:
     import simplejson as json
 import json_diff
+from test import benchmark
 from StringIO import StringIO
 import codecs
+import copy
+import os
+import shutil
+import tempfile
+import threading
+import httplib
 
 from test_strings import ARRAY_DIFF, ARRAY_NEW, ARRAY_OLD, \
     NESTED_DIFF, NESTED_DIFF_EXCL, NESTED_DIFF_INCL, NESTED_NEW, NESTED_OLD, \
@@ -21,15 +28,18 @@ from test_strings import ARRAY_DIFF, ARRAY_NEW, ARRAY_OLD, \
 
 
 class OptionsClass(object):
-    def __init__(self, inc=None, exc=None, ign=None):
+    def __init__(self, inc=None, exc=None, ign=None, **kwargs):
         self.exclude = exc
         self.include = inc
         self.ignore_append = ign
+        self.__dict__.update(kwargs)
 
 
 class OurTestCase(unittest.TestCase):
+    comparator = json_diff.Comparator
+
     def _run_test(self, oldf, newf, difff, msg="", opts=None):
-        diffator = json_diff.Comparator(oldf, newf, opts)
+        diffator = self.comparator(oldf, newf, opts)
         diff = diffator.compare_dicts()
         expected = json.load(difff)
         self.assertEqual(json.dumps(diff, sort_keys=True),
@@ -106,6 +116,44 @@ class TestBasicJSON(OurTestCase):
         self._run_test_strings(ARRAY_OLD, ARRAY_NEW,
             ARRAY_DIFF, "Array objects diff.")
 
+    def test_root_replaced(self):
+        for new in ([], [1], 5, None):
+            diff = json_diff.Comparator().compare_dicts({"a": 1}, new)
+            self.assertEqual(diff, {"_replace": new})
+            self.assertEqual(json_diff.apply_diff({"a": 1}, diff), new)
+            events = iter(json_diff.JSONEventParser(StringIO('{"a": 1}')))
+            self.assertEqual(json.loads(u"".join(json_diff.iter_events_json(
+                json_diff.patch_events(events, diff)))), new)
+        self.assertEqual(json_diff.Comparator().compare_dicts([1], {}),
+            {"_replace": {}})
+        self.assertEqual(json_diff.Comparator().compare_dicts(5, 5), {})
+        self.assertIn(u"<td class='update_class'> = 5</td>",
+            unicode(json_diff.HTMLFormatter({"_replace": 5})))
+
+    def test_main_root_replaced(self):
+        tmp_dir = tempfile.mkdtemp()
+        save_stdout = StringIO()
+        sys.stdout = save_stdout
+        try:
+            names = []
+            for idx, text in enumerate(('{"a": 1}', '[]', '5')):
+                names.append(os.path.join(tmp_dir, "%d.json" % idx))
+                with open(names[-1], "w") as out:
+                    out.write(text)
+            for new_name, new in ((names[1], []), (names[2], 5)):
+                for stream in ([], ["--stream"]):
+                    save_stdout.truncate(0)
+                    self.assertEqual(json_diff.main(["json_diff", names[0],
+                        new_name] + stream), 1)
+                    self.assertEqual(json.loads(save_stdout.getvalue()),
+                        {"_replace": new})
+            save_stdout.truncate(0)
+            self.assertEqual(json_diff.main(["json_diff", names[2],
+                names[2]]), 0)
+        finally:
+            sys.stdout = sys.__stdout__
+            shutil.rmtree(tmp_dir)
+
 
 class TestHappyPath(OurTestCase):
     def test_realFile(self):
@@ -121,6 +169,61 @@ class TestHappyPath(OurTestCase):
             codecs.open("test/nested_html_output.html", "r", "utf-8"),
             "Simply nested objects (from file) diff formatted as HTML.")
 
+    def test_html_written(self):
+        diff = json_diff.Comparator(open("test/old.json"),
+            open("test/new.json")).compare_dicts()
+        formatter = json_diff.HTMLFormatter(diff)
+        out = StringIO()
+        formatter.write(out)
+        self.assertEqual(out.getvalue().decode("utf-8"), unicode(formatter))
+
+    def test_html_max_rows(self):
+        diff = {"_update": {"a": dict(("k%d" % i, i) for i in range(10))}}
+        html = unicode(json_diff.HTMLFormatter(diff, max_rows=3))
+        self.assertEqual(html.count("<tr>"), 4)
+        self.assertTrue("... = 7 more" in html)
+
+    def test_json_written(self):
+        diff = json_diff.Comparator(open("test/old-testing-data.json"),
+            open("test/new-testing-data.json")).compare_dicts()
+        self.assertEqual(u"".join(json_diff.iter_json(diff)),
+            json.dumps(diff, indent=4, ensure_ascii=False))
+        self.assertEqual(u"".join(json_diff.iter_json(diff, compact=True)),
+            json.dumps(diff, separators=(",", ":"), ensure_ascii=False))
+        out = StringIO()
+        json_diff.write_result(iter([("a", {}), ("b", [1])]), out,
+            compact=True)
+        self.assertEqual(out.getvalue(), '{"a":{},"b":[1]}\n')
+
+    def test_deeply_nested(self):
+        depth = sys.getrecursionlimit() * 2
+        old = '{"a": [1, ' * depth + '1' + ']}' * depth
+        new = '{"a": [1, ' * depth + '2' + ']}' * depth
+        diffator = json_diff.Comparator(StringIO(old), StringIO(new),
+            OptionsClass(prune_identical=True))
+        diff = diffator.compare_dicts()
+        for level in range(depth):
+            diff = diff["_update"]["a"]["_update"][1]
+        self.assertEqual(diff, 2)
+        self.assertEqual(unicode(json_diff.HTMLFormatter(
+            diffator.compare_dicts())).count("<tr>"), 1)
+
+    def test_scalar_arrays(self):
+        diffator = json_diff.Comparator()
+        self.assertEqual(diffator.compare_dicts({"a": [1, 2, 3]},
+            {"a": [1, 2, 3]}), {})
+        self.assertEqual(diffator.compare_dicts({"a": [1, 2, 3, 4]},
+            {"a": [1, 5, 3]}),
+            {"_update": {"a": {"_update": {1: 5}, "_remove": {3: 4}}}})
+        self.assertEqual(diffator.compare_dicts({"a": [1, 2]},
+            {"a": [1, 2, 3]}), {"_update": {"a": {"_append": {2: 3}}}})
+        # equal values of different types are still different
+        self.assertEqual(diffator.compare_dicts({"a": [1, 1]},
+            {"a": [1.0, 1]}), {"_update": {"a": {"_update": {0: 1.0}}}})
+        self.assertEqual(diffator.compare_dicts({"a": [1, 0]},
+            {"a": [True, False]}),
+            {"_update": {"a": {"_update": {0: True, 1: False}}}})
+
     def test_nested_excluded(self):
         self._run_test_strings(NESTED_OLD, NESTED_NEW, NESTED_DIFF_EXCL,
             "Nested objects diff with exclusion.",
@@ -167,6 +270,1320 @@ class TestPiglitData(OurTestCase):
 #            open("test/diff-testing-data.json"), "Large piglit results diff.")
 
 
+class TestStreaming(OurTestCase):
+    comparator = json_diff.StreamComparator
+
+    def test_simple(self):
+        self._run_test_strings(SIMPLE_OLD, SIMPLE_NEW, SIMPLE_DIFF,
+                "All-scalar objects diff (streamed).")
+
+    def test_nested(self):
+        self._run_test_strings(NESTED_OLD, NESTED_NEW, NESTED_DIFF,
+            "Nested objects diff (streamed).")
+
+    def test_arrays(self):
+        self._run_test_strings(ARRAY_OLD, ARRAY_NEW,
+            ARRAY_DIFF, "Array objects diff (streamed).")
+        self._run_test_strings(SIMPLE_ARRAY_OLD, SIMPLE_ARRAY_NEW,
+            SIMPLE_ARRAY_DIFF, "Simple array objects diff (streamed).")
+        self._run_test_strings(SIMPLE_ARRAY_NEW, SIMPLE_ARRAY_OLD,
+            '{"_update": {"a": {"_remove": {"1": 2}}}}',
+            "Shortened array diff (streamed).")
+
+    def test_nested_excluded(self):
+        self._run_test_strings(NESTED_OLD, NESTED_NEW, NESTED_DIFF_EXCL,
+            "Nested objects diff with exclusion (streamed).",
+            OptionsClass(exc=["nome"]))
+
+    def test_out_of_order_keys(self):
+        self._run_test_strings('{"a": {"x": 1}, "b": [1, 2], "c": {}}',
+            '{"c": {"y": 2}, "b": [1, 3], "a": {"x": 1}}',
+            '{"_update": {"b": {"_update": {"1": 3}}, ' +
+            '"c": {"_append": {"y": 2}}}}',
+            "Keys in different order (streamed).")
+
+    def test_deeply_nested(self):
+        depth = sys.getrecursionlimit() * 2
+        old = '{"a": [1, ' * depth + '1' + ']}' * depth
+        new = '{"a": [1, ' * depth + '2' + ']}' * depth
+        for opts in (None, OptionsClass(inc=["a"])):
+            diff = json_diff.StreamComparator(StringIO(old), StringIO(new),
+                opts).compare_dicts()
+            for level in range(depth):
+                diff = diff["_update"]["a"]["_update"][1]
+            self.assertEqual(diff, 2)
+
+    def test_small_chunks(self):
+        diffator = json_diff.StreamComparator(open("test/old.json"),
+            open("test/new.json"), chunk_size=3)
+        self.assertEqual(diffator.compare_dicts(),
+                         json.load(open("test/diff.json")))
+
+    def test_piglit_result_only(self):
+        self._run_test(open("test/old-testing-data.json"),
+            open("test/new-testing-data.json"),
+            open("test/diff-result-only-testing-data.json"),
+            "Large piglit reports diff (streamed).",
+            OptionsClass(inc=["result"]))
+
+    def test_bad_JSON(self):
+        for bad in (NO_JSON_OLD, u'{"a": 0x1}', u'{"a": 1', u'{"a": 1} 2',
+                    u'{"a" 1}', u'[1,]'):
+            diffator = json_diff.StreamComparator(StringIO(bad),
+                StringIO(u'{}'))
+            self.assertRaises(json_diff.BadJSONError, diffator.compare_dicts)
+
+    def test_events(self):
+        events = list(json_diff.JSONEventParser(
+            StringIO(u'{"a": [1, "b", null], "c": {}}')))
+        self.assertEqual(events, [("start_map", None), ("map_key", "a"),
+            ("start_array", None), ("value", 1), ("value", "b"),
+            ("value", None), ("end_array", None), ("map_key", "c"),
+            ("start_map", None), ("end_map", None), ("end_map", None)])
+
+
+class TestDigests(OurTestCase):
+    def test_digests(self):
+        digests = json_diff.SubtreeDigests()
+        self.assertEqual(digests.digest({"a": [1, {"b": None}], "c": "d"}),
+                         digests.digest({"c": "d", "a": [1, {"b": None}]}))
+        self.assertNotEqual(digests.digest([1]), digests.digest([1.0]))
+        self.assertNotEqual(digests.digest([1]), digests.digest([True]))
+        self.assertNotEqual(digests.digest({"a": 1}), digests.digest([1]))
+        self.assertNotEqual(digests.digest({"a": "b"}),
+                            digests.digest({"a:b": ""}))
+        self.assertEqual(len(digests.hexdigest(["x"])), 40)
+
+    def test_pruned_results(self):
+        opts = OptionsClass(prune_identical=True)
+        self._run_test_strings(NESTED_OLD, NESTED_NEW, NESTED_DIFF,
+            "Nested objects diff (pruned).", opts)
+        self._run_test_strings(ARRAY_OLD, ARRAY_NEW, ARRAY_DIFF,
+            "Array objects diff (pruned).", opts)
+        self._run_test(open("test/old-testing-data.json"),
+            open("test/new-testing-data.json"),
+            open("test/diff-result-only-testing-data.json"),
+            "Large piglit reports diff (pruned).",
+            OptionsClass(inc=["result"], prune_identical=True))
+
+    def test_identical_subtree_skipped(self):
+        walked = []
+
+        class CountingComparator(json_diff.Comparator):
+            def _children(self, old_obj, new_obj, path, split_moves):
+                walked.append(old_obj)
+                return json_diff.Comparator._children(self, old_obj,
+                    new_obj, path, split_moves)
+
+        same = {"deep": {"deeper": [1, 2, 3]}}
+        diffator = CountingComparator(opts=OptionsClass(prune_identical=True))
+        self.assertEqual(diffator.compare_dicts({"a": same, "b": 1},
+            {"a": json.loads(json.dumps(same)), "b": 2}),
+            {"_update": {"b": 2}})
+        self.assertEqual(len(walked), 1)
+
+    def test_baseline_hashed_once(self):
+        baseline = {"a": {"b": [1, 2]}, "c": 1}
+        diffator = json_diff.Comparator(
+            opts=OptionsClass(prune_identical=True))
+        diffator.compare_dicts(baseline, {"a": {"b": [1, 2]}, "c": 2})
+        old_digests = diffator.old_digests
+        new_digests = diffator.new_digests
+        self.assertEqual(diffator.compare_dicts(baseline,
+            {"a": {"b": [1]}, "c": 1}),
+            {"_update": {"a": {"_update": {"b": {"_remove": {1: 2}}}}}})
+        self.assertTrue(diffator.old_digests is old_digests)
+        self.assertFalse(diffator.new_digests is new_digests)
+
+
+class TestArrayAlignment(OurTestCase):
+    def _diff(self, old, new, **kwargs):
+        kwargs.setdefault("array_align", "lcs")
+        diffator = json_diff.Comparator(opts=OptionsClass(**kwargs))
+        return diffator.compare_dicts({"a": old}, {"a": new})
+
+    def test_fixtures(self):
+        opts = OptionsClass(array_align="lcs")
+        self._run_test_strings(ARRAY_OLD, ARRAY_NEW, ARRAY_DIFF,
+            "Array objects diff (lcs).", opts)
+        self._run_test_strings(SIMPLE_ARRAY_OLD, SIMPLE_ARRAY_NEW,
+            SIMPLE_ARRAY_DIFF, "Simple array objects diff (lcs).", opts)
+
+    def test_insert_at_head(self):
+        self.assertEqual(self._diff(range(1000), [-1] + range(1000)),
+            {"_update": {"a": {"_append": {0: -1}}}})
+        self.assertEqual(self._diff(range(1000), [-1] + range(1000),
+            array_align="position")["_update"]["a"]["_append"], {1000: 999})
+
+    def test_insert_and_delete(self):
+        self.assertEqual(self._diff([{"x": 1}, 2, 3, 4], [2, 3, 5, 4, 6]),
+            {"_update": {"a": {"_remove": {0: {"x": 1}},
+                               "_append": {2: 5, 4: 6}}}})
+
+    def test_changed_element_updated(self):
+        self.assertEqual(self._diff([1, {"x": 1, "y": 2}, 3],
+                                    [0, 1, {"x": 1, "y": 3}, 3]),
+            {"_update": {"a": {"_append": {0: 0},
+                               "_update": {1: {"_update": {"y": 3}}}}}})
+
+    def test_cutoff(self):
+        self.assertEqual(self._diff([1, 2, 3], [3, 2, 1], align_cutoff=1),
+            {"_update": {"a": {"_update": {0: 3, 2: 1}}}})
+        # only a block inserted between common prefix and suffix
+        self.assertEqual(self._diff([1, 2, 3], [1, 3, 2], align_cutoff=0),
+            {"_update": {"a": {"_update": {1: 3, 2: 2}}}})
+        self.assertEqual(self._diff([1, 3], [1, 2, 3], align_cutoff=0),
+            {"_update": {"a": {"_append": {1: 2}}}})
+        self.assertEqual(self._diff([1, 2, 3], [3, 2, 1]),
+            {"_update": {"a": {"_remove": {0: 1, 1: 2},
+                               "_append": {1: 2, 2: 1}}}})
+
+    def test_streamed(self):
+        diffator = json_diff.StreamComparator(StringIO('{"a": [1, 2]}'),
+            StringIO('{"a": [0, 1, 2]}'), OptionsClass(array_align="lcs"))
+        self.assertEqual(diffator.compare_dicts(),
+            {"_update": {"a": {"_append": {0: 0}}}})
+
+
+class TestKeyedArrays(OurTestCase):
+    def _diff(self, old, new, keys):
+        diffator = json_diff.Comparator(opts=OptionsClass(array_keys=keys))
+        return diffator.compare_dicts(old, new)
+
+    def test_path_pattern(self):
+        pattern = json_diff.PathPattern("/a/*/b")
+        self.assertTrue(pattern.matches(("a", 3, "b")))
+        self.assertFalse(pattern.matches(("a", "b")))
+        self.assertFalse(pattern.matches(("x", "a", 3, "b")))
+        pattern = json_diff.PathPattern("items")
+        self.assertTrue(pattern.matches(("items",)))
+        self.assertTrue(pattern.matches(("x", 0, "items")))
+        self.assertFalse(pattern.matches(("items", 0)))
+        pattern = json_diff.PathPattern("/a/**/c?")
+        self.assertTrue(pattern.matches(("a", "cd")))
+        self.assertTrue(pattern.matches(("a", "b", 1, "c1")))
+        self.assertTrue(json_diff.PathPattern("/a~1b").matches(("a/b",)))
+
+    def test_longest_increasing(self):
+        self.assertEqual(json_diff.longest_increasing([3, 0, 1, 5, 2, 4]),
+            [1, 2, 4, 5])
+        self.assertEqual(json_diff.longest_increasing([]), [])
+
+    def test_reordered(self):
+        old = {"items": [{"id": 1, "v": "a"}, {"id": 2, "v": "b"},
+                         {"id": 3, "v": "c"}]}
+        new = {"items": [{"id": 3, "v": "c"}, {"id": 1, "v": "a"},
+                         {"id": 2, "v": "B"}, {"id": 4, "v": "d"}]}
+        self.assertEqual(self._diff(old, new, ["items=id"]),
+            {"_update": {"items": {
+                "_move": {0: 2},
+                "_append": {3: {"id": 4, "v": "d"}},
+                "_update": {1: {"_update": {"v": "B"}}}}}})
+        self.assertEqual(len(self._diff(old, new, ["/other=id"])
+            ["_update"]["items"]["_update"]), 3)
+
+    def test_removed_and_composite(self):
+        old = {"a": {"b": [{"n": "x", "t": 1}, {"n": "x", "t": 2},
+                           {"n": "y", "t": 1}]}}
+        new = {"a": {"b": [{"n": "y", "t": 1}, {"n": "x", "t": 2}]}}
+        self.assertEqual(self._diff(old, new, ["/a/b=n,t"]),
+            {"_update": {"a": {"_update": {"b": {
+                "_remove": {0: {"n": "x", "t": 1}},
+                "_move": {0: 2}}}}}})
+
+    def test_unidentifiable(self):
+        old = {"a": [{"id": 1}, 2]}
+        new = {"a": [{"id": 1}, 3]}
+        self.assertEqual(self._diff(old, new, ["a=id"]),
+            {"_update": {"a": {"_update": {1: 3}}}})
+
+    def test_streamed(self):
+        diffator = json_diff.StreamComparator(
+            StringIO('{"a": [{"id": 1}, {"id": 2}]}'),
+            StringIO('{"a": [{"id": 2}, {"id": 1}]}'),
+            OptionsClass(array_keys=["a=id"]))
+        self.assertEqual(diffator.compare_dicts(),
+            {"_update": {"a": {"_move": {0: 1}}}})
+
+    def test_bad_key(self):
+        self.assertRaises(ValueError, json_diff.Comparator,
+            opts=OptionsClass(array_keys=["items"]))
+
+
+class TestXDiff(OurTestCase):
+    def _diff(self, old, new):
+        diffator = json_diff.Comparator(opts=OptionsClass(backend="xdiff"))
+        return diffator.compare_dicts({"a": old}, {"a": new})
+
+    def test_min_cost_matching(self):
+        self.assertEqual(json_diff.min_cost_matching([[4, 1, 3],
+                                                      [2, 0, 5],
+                                                      [3, 2, 2]]),
+            [1, 0, 2])
+
+    def test_fixtures(self):
+        opts = OptionsClass(backend="xdiff")
+        self._run_test_strings(NESTED_OLD, NESTED_NEW, NESTED_DIFF,
+            "Nested objects diff (xdiff).", opts)
+        # changed scalars are not worth matching
+        self.assertEqual(self._diff([u"Pepíček", u"Anička", u"Maruška"],
+                                    [u"Pepíček", u"Tonička", u"Maruška"]),
+            {"_update": {"a": {"_remove": {1: u"Anička"},
+                               "_append": {1: u"Tonička"}}}})
+
+    def test_reordered(self):
+        old = [{"id": idx, "v": [idx, "x"]} for idx in range(10000)]
+        new = list(reversed(old))
+        self.assertEqual(self._diff(old, new), {})
+        new[5] = {"id": 9994, "v": [9994, "y"]}
+        self.assertEqual(self._diff(old, new),
+            {"_update": {"a": {"_update": {9994: {"_update": {"v": {
+                "_remove": {1: "x"}, "_append": {1: "y"}}}}}}}})
+
+    def test_best_match(self):
+        old = [{"n": "a", "v": 1}, {"n": "b", "v": 2}, 7, "s"]
+        new = ["s", {"n": "b", "v": 3}, {"n": "a", "v": 4}, [1]]
+        self.assertEqual(self._diff(old, new),
+            {"_update": {"a": {"_update": {0: {"_update": {"v": 4}},
+                                           1: {"_update": {"v": 3}}},
+                               "_remove": {2: 7},
+                               "_append": {3: [1]}}}})
+
+    def test_not_worth_matching(self):
+        self.assertEqual(self._diff([{"a": 1, "b": 2}], [{"c": 3}]),
+            {"_update": {"a": {"_remove": {0: {"a": 1, "b": 2}},
+                               "_append": {0: {"c": 3}}}}})
+
+
+class TestParallel(OurTestCase):
+    def setUp(self):
+        self.saved = (json_diff.PARALLEL_CHUNK_SIZE,
+                      json_diff.PARALLEL_ARRAY_CHUNK)
+        json_diff.PARALLEL_CHUNK_SIZE = 10
+        json_diff.PARALLEL_ARRAY_CHUNK = 3
+
+    def tearDown(self):
+        (json_diff.PARALLEL_CHUNK_SIZE,
+         json_diff.PARALLEL_ARRAY_CHUNK) = self.saved
+
+    def test_fixtures(self):
+        self._run_test_strings(NESTED_OLD, NESTED_NEW, NESTED_DIFF,
+            "Nested objects diff (parallel).", OptionsClass(jobs=2))
+        self._run_test_strings(NESTED_OLD, NESTED_NEW, NESTED_DIFF_INCL,
+            "Nested objects diff (parallel, included).",
+            OptionsClass(inc=["nome"], jobs=2))
+        self._run_test_strings(NESTED_OLD, NESTED_NEW, NESTED_DIFF_IGNORING,
+            "Nested objects diff (parallel, ignoring append).",
+            OptionsClass(ign=True, jobs=2))
+
+    def test_piglit_result_only(self):
+        json_diff.PARALLEL_CHUNK_SIZE = 100000
+        self._run_test(open("test/old-testing-data.json"),
+            open("test/new-testing-data.json"),
+            open("test/diff-result-only-testing-data.json"),
+            "Large piglit reports diff (parallel).",
+            OptionsClass(inc=["result"], jobs=3))
+
+    def test_split_arrays(self):
+        old = {"a": range(10), "b": {"c": [1, 2]}, "d": range(8)}
+        new = {"a": range(9) + [-1, 10, 11], "b": {"c": [1, 3]},
+               "d": range(4) + [0]}
+        expected = json_diff.Comparator().compare_dicts(old, new)
+        self.assertEqual(json_diff.Comparator(
+            opts=OptionsClass(jobs=2)).compare_dicts(old, new), expected)
+
+    def test_deeply_nested(self):
+        old = {"c": 1}
+        new = {"c": 2}
+        for doc in (old, new):
+            doc["a"] = doc["c"]
+            for level in range(3000):
+                doc["a"] = {"b": doc["a"]}
+        res = json_diff.Comparator(opts=OptionsClass(jobs=2)).\
+            compare_dicts(old, new)[u"_update"]
+        self.assertEqual(res[u"c"], 2)
+        res = res[u"a"]
+        for level in range(2999):
+            res = res[u"_update"][u"b"]
+        self.assertEqual(res, {u"_update": {u"b": 2}})
+
+
+class TestBatch(OurTestCase):
+    candidates = ["test/old.json", "test/new.json"]
+
+    def test_compare_batch(self):
+        expected = [("test/old.json", {}),
+                    ("test/new.json", json.load(open("test/diff.json")))]
+        for jobs in (1, 2):
+            diffator = json_diff.Comparator(open("test/old.json"),
+                opts=OptionsClass(jobs=jobs, prune_identical=True))
+            self.assertEqual(list(diffator.compare_batch(self.candidates)),
+                expected)
+
+    def test_bad_candidate(self):
+        diffator = json_diff.Comparator(open("test/old.json"))
+        self.assertRaises(json_diff.BadJSONError, list,
+            diffator.compare_batch(["test/test_strings.py"]))
+
+    def test_main_output_dir(self):
+        out_dir = tempfile.mkdtemp()
+        try:
+            res = json_diff.main(["json_diff", "--baseline", "test/old.json",
+                "-o", out_dir] + self.candidates)
+            self.assertEqual(res, 1)
+            self.assertEqual(sorted(os.listdir(out_dir)),
+                ["new.json.diff.json", "old.json.diff.json"])
+            self.assertEqual(json.load(open(os.path.join(out_dir,
+                "new.json.diff.json"))), json.load(open("test/diff.json")))
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_main_stdout(self):
+        save_stdout = StringIO()
+        sys.stdout = save_stdout
+        try:
+            res = json_diff.main(["json_diff", "--baseline", "test/old.json",
+                "test/old.json"])
+        finally:
+            sys.stdout = sys.__stdout__
+        self.assertEqual(res, 0)
+        self.assertEqual(json.loads(save_stdout.getvalue()),
+            {"test/old.json": {}})
+
+    def test_main_rejected_options(self):
+        save_stderr = StringIO()
+        sys.stderr = save_stderr
+        try:
+            for option in ("--stream", "--cache=/nonexistent"):
+                self.assertRaises(SystemExit, json_diff.main, ["json_diff",
+                    "--baseline", "test/old.json", option, "test/new.json"])
+        finally:
+            sys.stderr = sys.__stderr__
+        self.assertIn("cannot be used with --stream and --cache",
+            save_stderr.getvalue())
+
+
+class TestPathFilters(OurTestCase):
+    old = {"a": {"b": {"c": 1, "d": 2}, "e": [{"c": 1}, {"c": 2}]},
+           "f": {"c": 1}, "g": 1}
+    new = {"a": {"b": {"c": 3, "d": 4}, "e": [{"c": 5}, {"c": 2}]},
+           "f": {"c": 6}, "g": 2, "h": {"c": 7}}
+
+    def _diff(self, inc=None, exc=None):
+        return json_diff.Comparator(opts=OptionsClass(inc=inc, exc=exc)).\
+            compare_dicts(self.old, self.new)
+
+    def test_patterns(self):
+        self.assertTrue(json_diff.PathPattern("$.a.e[*].c").matches(
+            ("a", "e", 0, "c")))
+        self.assertTrue(json_diff.PathPattern("$..c").matches(("f", "c")))
+        self.assertTrue(json_diff.PathPattern("$['a'][\"b\"]").matches(
+            ("a", "b")))
+        self.assertFalse(json_diff.PathPattern("$.a.e[1]").matches(
+            ("a", "e", 0)))
+        pattern = json_diff.PathPattern("/a/*/c")
+        self.assertTrue(pattern.may_match_below(("a",)))
+        self.assertTrue(pattern.may_match_below(("a", "b")))
+        self.assertFalse(pattern.may_match_below(("a", "b", "c")))
+        self.assertFalse(pattern.may_match_below(("f",)))
+        self.assertRaises(ValueError, json_diff.PathPattern, "$a")
+
+    def test_excluded_path(self):
+        self.assertEqual(self._diff(exc=["/a/b", "$.a.e[0]", "h"]),
+            {"_update": {"f": {"_update": {"c": 6}}, "g": 2}})
+
+    def test_excluded_glob(self):
+        self.assertEqual(self._diff(exc=["/[f-h]", "/a/*/d"]),
+            {"_update": {"a": {"_update": {"b": {"_update": {"c": 3}},
+                "e": {"_update": {0: {"_update": {"c": 5}}}}}}}})
+
+    def test_included_subtree(self):
+        self.assertEqual(self._diff(inc=["/a/b", "/h"]),
+            {"_update": {"a": {"_update": {"b": {"_update": {"c": 3,
+                                                            "d": 4}}}}},
+             "_append": {"h": {"c": 7}}})
+        self.assertEqual(self._diff(inc=["$.a.e[*].c"]),
+            {"_update": {"a": {"_update": {
+                "e": {"_update": {0: {"_update": {"c": 5}}}}}}}})
+
+    def test_excluded_not_compared(self):
+        compared = []
+
+        class RecordingComparator(json_diff.Comparator):
+            def _children(self, old_obj, new_obj, path, split_moves):
+                for child in json_diff.Comparator._children(self, old_obj,
+                        new_obj, path, split_moves):
+                    compared.append(child[1])
+                    yield child
+
+        RecordingComparator(opts=OptionsClass(exc=["/a"])).compare_dicts(
+            self.old, self.new)
+        self.assertEqual(sorted(compared), [("a",), ("f",), ("f", "c"),
+            ("g",), ("h",)])
+        compared[:] = []
+        RecordingComparator(opts=OptionsClass(inc=["/f"])).compare_dicts(
+            self.old, self.new)
+        self.assertEqual(sorted(compared), [("a",), ("f",), ("f", "c"),
+            ("g",), ("h",)])
+
+    def test_streamed(self):
+        diffator = json_diff.StreamComparator(
+            StringIO(json.dumps(self.old)), StringIO(json.dumps(self.new)),
+            OptionsClass(inc=["/a/b", "/h"], exc=["d"]))
+        self.assertEqual(diffator.compare_dicts(),
+            {"_update": {"a": {"_update": {"b": {"_update": {"c": 3}}}}},
+             "_append": {"h": {"c": 7}}})
+
+    def test_included_type_change(self):
+        # containers of different types contain no included values
+        opts = OptionsClass(inc=["k"])
+        self.assertEqual(json_diff.Comparator(opts=opts).compare_dicts(
+            {"a": 1, "c": {"k": 1}}, {"c": [1], "a": 1}), {})
+        # keys out of order are compared by _record
+        diffator = json_diff.StreamComparator(
+            StringIO('{"a": 1, "c": {"k": 1}}'),
+            StringIO('{"c": [1], "a": 1}'), opts)
+        self.assertEqual(diffator.compare_dicts(), {})
+
+
+class TestLazy(OurTestCase):
+    def _lazy_file(self, text):
+        fileobj = tempfile.TemporaryFile()
+        fileobj.write(text.encode("utf-8"))
+        fileobj.seek(0)
+        return fileobj
+
+    def _run_test_strings(self, olds, news, diffs, msg="", opts=None):
+        if opts is None:
+            opts = OptionsClass()
+        opts.lazy = True
+        self._run_test(self._lazy_file(olds), self._lazy_file(news),
+            StringIO(diffs), msg, opts)
+
+    def test_lazy_results(self):
+        self._run_test_strings(NESTED_OLD, NESTED_NEW, NESTED_DIFF,
+            "Nested objects diff (lazy).")
+        self._run_test_strings(ARRAY_OLD, ARRAY_NEW, ARRAY_DIFF,
+            "Array objects diff (lazy).")
+        self._run_test_strings(NESTED_OLD, NESTED_NEW, NESTED_DIFF_EXCL,
+            "Nested objects diff with exclusion (lazy).",
+            OptionsClass(exc=["nome"]))
+        self._run_test(open("test/old-testing-data.json"),
+            open("test/new-testing-data.json"),
+            open("test/diff-result-only-testing-data.json"),
+            "Large piglit reports diff (lazy).",
+            OptionsClass(inc=["result"], lazy=True))
+
+    def test_lazy_nodes(self):
+        doc = json_diff.LazyDocument(self._lazy_file(
+            u'{"a": [1, "b]", {"c": null}], "d": {"e": "\\\\"}, "f": 1.5}'))
+        root = doc.root.expand()
+        self.assertEqual(sorted(root.keys()), ["a", "d", "f"])
+        self.assertEqual(root["f"], 1.5)
+        self.assertTrue(isinstance(root["a"], json_diff.LazyNode))
+        self.assertEqual(root["a"].load(), [1, "b]", {"c": None}])
+        self.assertEqual(root["d"].expand(), {"e": "\\"})
+        self.assertEqual(json_diff.LazyDocument(
+            self._lazy_file(u' 12 ')).root, 12)
+
+    def test_identical_subtree_not_parsed(self):
+        expanded = []
+
+        class CountingNode(json_diff.LazyNode):
+            __slots__ = ()
+
+            def expand(self):
+                expanded.append(self)
+                return json_diff.LazyNode.expand(self)
+
+        old = json_diff.LazyDocument(self._lazy_file(
+            u'{"a": {"deep": [1, 2]}, "b": 1}')).root
+        new = json_diff.LazyDocument(self._lazy_file(
+            u'{"b": 2, "a": {"deep": [1, 2]}}')).root
+        old.__class__ = new.__class__ = CountingNode
+        diffator = json_diff.Comparator(opts=OptionsClass(lazy=True))
+        self.assertEqual(diffator.compare_dicts(old, new),
+            {"_update": {"b": 2}})
+        self.assertEqual(len(expanded), 2)
+
+    def test_bad_structure(self):
+        for text in (u'{"a": [1}', u'{"a": 1', u'[1]]'):
+            self.assertRaises(json_diff.BadJSONError, json_diff.LazyDocument,
+                self._lazy_file(text))
+
+
+class TestSnapshot(OurTestCase):
+    def _snapshot(self, value):
+        out = StringIO()
+        json_diff.write_snapshot(value, out)
+        out.seek(0)
+        return out
+
+    def _run_test(self, oldf, newf, difff, msg="", opts=None):
+        OurTestCase._run_test(self, self._snapshot(json.load(oldf)),
+            self._snapshot(json.load(newf)), difff, msg, opts)
+
+    def test_snapshot_results(self):
+        self._run_test_strings(NESTED_OLD, NESTED_NEW, NESTED_DIFF,
+            "Nested objects diff (snapshots).")
+        self._run_test_strings(ARRAY_OLD, ARRAY_NEW, ARRAY_DIFF,
+            "Array objects diff (snapshots).")
+        self._run_test(open("test/old-testing-data.json"),
+            open("test/new-testing-data.json"),
+            open("test/diff-result-only-testing-data.json"),
+            "Large piglit reports diff (snapshots).",
+            OptionsClass(inc=["result"]))
+
+    def test_values(self):
+        for value in (12, u"\u017e", None, [], [1, 2 ** 70, -1],
+                [1.5, 2.0], [1, 2.0, True], {"a": {"b": [u"c", {}]}}):
+            root = json_diff.SnapshotDocument(self._snapshot(value)).root
+            self.assertEqual(json.dumps(json_diff.plain(root)),
+                json.dumps(value))
+            self.assertEqual(json_diff.load_json(self._snapshot(value)),
+                value)
+            if isinstance(root, json_diff.SnapshotNode):
+                self.assertEqual(root.digest().encode("hex"),
+                    json_diff.SubtreeDigests().hexdigest(value))
+        self.assertRaises(json_diff.BadJSONError, json_diff.SnapshotDocument,
+            StringIO("[1, 2]"))
+
+    def test_main_snapshot(self):
+        out_dir = tempfile.mkdtemp()
+        save_stdout = StringIO()
+        sys.stdout = save_stdout
+        try:
+            snapshot = os.path.join(out_dir, "old.snap")
+            self.assertEqual(json_diff.main(["json_diff", "--snapshot",
+                snapshot, "test/old.json"]), 0)
+            for stream in ([], ["--stream"]):
+                save_stdout.truncate(0)
+                self.assertEqual(json_diff.main(["json_diff", snapshot,
+                    "test/new.json"] + stream), 1)
+                self.assertEqual(json.loads(save_stdout.getvalue()),
+                    json.load(open("test/diff.json")))
+        finally:
+            sys.stdout = sys.__stdout__
+            shutil.rmtree(out_dir)
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_generators_seeded(self):
+        for case in benchmark.CASES:
+            self.assertEqual(benchmark.generate(case, 50, 0.3, 1),
+                             benchmark.generate(case, 50, 0.3, 1))
+            old, new = benchmark.generate(case, 50, 0.3, 1)
+            self.assertNotEqual(old, new)
+
+    def test_run_and_compare(self):
+        results = benchmark.run_benchmarks(["long_array"], [20],
+            benchmark.TARGETS, OptionsClass(), repeat=1)
+        self.assertEqual(len(results), 2 * len(benchmark.TARGETS))
+        out = StringIO()
+        self.assertEqual(benchmark.compare_results(results, results, 1.0,
+            out), 0)
+        self.assertEqual(len(out.getvalue().splitlines()), len(results))
+
+    def test_deep_chain(self):
+        old, new = benchmark.generate("deep_chain", 3000, 0.01, 1)
+        results = [json_diff.Comparator(opts=OptionsClass(jobs=jobs)).
+            compare_dicts(old, new) for jobs in (1, 2)]
+        self.assertNotEqual(results[0], {})
+        self.assertTrue(json_diff.same_values(results[0], results[1]))
+
+
+class TestChanges(OurTestCase):
+    def _changes(self, old, new, opts=None):
+        return list(json_diff.Comparator(opts=opts).iter_changes(old, new))
+
+    def test_nested_changes(self):
+        self.assertEqual(sorted(self._changes(json.loads(NESTED_OLD),
+            json.loads(NESTED_NEW))), sorted([
+                ("replace", "/a", 1, 2),
+                ("remove", "/b", 2, None),
+                ("remove", "/ignore", {"else": True}, None),
+                ("add", "/c", None, 3),
+                ("replace", "/child/nome", u"Jano\u0161ek",
+                 u"Maru\u0161ka")]))
+        self.assertEqual(self._changes({"a/b": {"~": 1}}, {"a/b": {"~": 2}}),
+            [("replace", "/a~1b/~0", 1, 2)])
+        self.assertEqual(self._changes({"a": 1}, {"a": 1}), [])
+        self.assertEqual(self._changes({"a": 1}, {"a": None}),
+            [("replace", "/a", 1, None)])
+
+    def test_array_changes_ordered(self):
+        old = {"items": [{"id": 1, "v": "a"}, {"id": 2, "v": "b"},
+                         {"id": 3, "v": "c"}, {"id": 5, "v": "e"}]}
+        new = {"items": [{"id": 3, "v": "c"}, {"id": 1, "v": "a"},
+                         {"id": 2, "v": "B"}, {"id": 4, "v": "d"}]}
+        self.assertEqual(self._changes(old, new,
+            OptionsClass(array_keys=["items=id"])), [
+                ("replace", "/items/1/v", "b", "B"),
+                ("remove", "/items/3", {"id": 5, "v": "e"}, None),
+                ("remove", "/items/2", {"id": 3, "v": "c"}, None),
+                ("add", "/items/0", None, {"id": 3, "v": "c"}),
+                ("add", "/items/3", None, {"id": 4, "v": "d"})])
+
+    def test_patch_operations(self):
+        self.assertEqual(list(json_diff.patch_operations([
+            ("remove", "/a", 1, None), ("add", "/b", None, [2])])),
+            [{"op": "remove", "path": "/a"},
+             {"op": "add", "path": "/b", "value": [2]}])
+
+    def test_main_patch(self):
+        save_stdout = StringIO()
+        sys.stdout = save_stdout
+        try:
+            res = json_diff.main(["json_diff", "--format", "patch",
+                "test/old.json", "test/new.json"])
+        finally:
+            sys.stdout = sys.__stdout__
+        self.assertEqual(res, 1)
+        self.assertEqual(len(json.loads(save_stdout.getvalue())), 5)
+
+
+class TestPatch(OurTestCase):
+    old = {"a": 1, "b": [1, 2, 3, 4], "items": [{"id": 1, "v": "a"},
+        {"id": 2, "v": "b"}, {"id": 3, "v": "c"}], "c": {"d": True}}
+    new = {"a": None, "b": [0, 1, 3, 5, 4], "items": [{"id": 3, "v": "c"},
+        {"id": 1, "v": "A"}, {"id": 4}], "e": {}}
+
+    def _diff(self, **kwargs):
+        diff = json_diff.Comparator(opts=OptionsClass(**kwargs)).\
+            compare_dicts(self.old, self.new)
+        # as read from a file, with array indices as strings
+        return json.loads(json.dumps(diff))
+
+    def test_apply_diff(self):
+        for opts in ({}, {"array_align": "lcs"},
+                {"array_keys": ["items=id"]}):
+            doc = json.loads(json.dumps(self.old))
+            self.assertEqual(json_diff.apply_diff(doc, self._diff(**opts)),
+                self.new)
+            self.assertEqual(doc, self.new)
+        self.assertRaises(json_diff.PatchError, json_diff.apply_diff,
+            {"x": 1}, self._diff())
+
+    def test_apply_patch(self):
+        changes = json_diff.Comparator(opts=OptionsClass(
+            array_keys=["items=id"])).iter_changes(self.old, self.new)
+        doc = json.loads(json.dumps(self.old))
+        self.assertEqual(json_diff.apply_patch(doc,
+            json_diff.patch_operations(changes)), self.new)
+        self.assertEqual(json_diff.apply_patch({"a": [1]}, [
+            {"op": "add", "path": "/a/-", "value": 2},
+            {"op": "copy", "from": "/a", "path": "/b"},
+            {"op": "move", "from": "/a/0", "path": "/c"},
+            {"op": "test", "path": "/b/1", "value": 2}]),
+            {"a": [2], "b": [1, 2], "c": 1})
+        self.assertRaises(json_diff.PatchError, json_diff.apply_patch,
+            {"a": 1}, [{"op": "test", "path": "/a", "value": 2}])
+        self.assertRaises(json_diff.PatchError, json_diff.apply_patch,
+            {"a": 1}, [{"op": "remove", "path": "/b"}])
+
+    def test_apply_patch_deep(self):
+        deep = [1]
+        for level in range(3000):
+            deep = [deep]
+        doc = json_diff.apply_patch({"a": deep}, [
+            {"op": "copy", "from": "/a", "path": "/b"}])
+        self.assertIsNot(doc["b"], deep)
+        for level in range(3001):
+            self.assertIsNot(doc["b"], doc["a"])
+            doc["a"] = doc["a"][0]
+            doc["b"] = doc["b"][0]
+        self.assertEqual(doc["b"], 1)
+
+    def test_patch_events(self):
+        events = iter(json_diff.JSONEventParser(
+            StringIO(json.dumps(self.old)), 16))
+        digest = json_diff.EventDigest()
+        text = u"".join(json_diff.iter_events_json(digest.tee(
+            json_diff.patch_events(events, self._diff()))))
+        self.assertEqual(json.loads(text), self.new)
+        self.assertEqual(digest.hexdigest,
+            json_diff.SubtreeDigests().hexdigest(self.new))
+
+    def test_main_patch_verify(self):
+        out_dir = tempfile.mkdtemp()
+        save_stdout = StringIO()
+        sys.stdout = save_stdout
+        sys.stderr = StringIO()
+        try:
+            diff_name = os.path.join(out_dir, "diff.json")
+            with open(diff_name, "w") as diff_file:
+                json.dump(json_diff.Comparator(open("test/old.json"),
+                    open("test/new.json")).compare_dicts(), diff_file)
+            digest = json_diff.SubtreeDigests().hexdigest(
+                json.load(open("test/new.json")))
+            for stream in ([], ["--stream"]):
+                save_stdout.truncate(0)
+                self.assertEqual(json_diff.main(["json_diff", "--patch",
+                    diff_name, "--verify", digest, "test/old.json"] +
+                    stream), 0)
+                self.assertEqual(json.loads(save_stdout.getvalue()),
+                    json.load(open("test/new.json")))
+                # nothing is written when the verification fails
+                save_stdout.truncate(0)
+                self.assertEqual(json_diff.main(["json_diff", "--patch",
+                    diff_name, "--verify", "0" * 40, "test/old.json"] +
+                    stream), 1)
+                self.assertEqual(save_stdout.getvalue(), "")
+            save_stdout.truncate(0)
+            self.assertEqual(json_diff.main(["json_diff", "--digest",
+                "test/new.json"]), 0)
+            self.assertEqual(save_stdout.getvalue().split(),
+                [digest, "test/new.json"])
+        finally:
+            sys.stdout = sys.__stdout__
+            sys.stderr = sys.__stderr__
+            shutil.rmtree(out_dir)
+
+
+class TestTolerance(OurTestCase):
+    def _diff(self, old, new, **kwargs):
+        return json_diff.Comparator(opts=OptionsClass(**kwargs)).\
+            compare_dicts(old, new)
+
+    def test_scalars(self):
+        old = {"a": 1.0, "b": 100, "c": 1, "d": True}
+        new = {"a": 1.05, "b": 101.0, "c": 2, "d": 1}
+        self.assertEqual(self._diff(old, new, abs_tol=0.1),
+            {"_update": {"b": 101.0, "c": 2, "d": 1}})
+        self.assertEqual(self._diff(old, new, rel_tol=0.05),
+            {"_update": {"c": 2, "d": 1}})
+        self.assertEqual(len(self._diff(old, new)["_update"]), 4)
+        self.assertRaises(ValueError, self._diff, old, new, abs_tol=-1)
+
+    def test_arrays(self):
+        size = json_diff.NUMPY_MIN_SIZE * 2
+        old = {"a": [i / 10.0 for i in range(size)] + [1]}
+        new = {"a": [i / 10.0 + 0.001 for i in range(size)] + [1.0, 2]}
+        new["a"][3] = 1
+        new["a"][size - 1] = 5
+        expected = {"_update": {"a": {"_update": {3: 1, size - 1: 5},
+            "_append": {size + 1: 2}}}}
+        save_numpy = json_diff.numpy
+        try:
+            self.assertEqual(self._diff(old, new, abs_tol=0.01), expected)
+            # without numpy
+            json_diff.numpy = None
+            self.assertEqual(self._diff(old, new, abs_tol=0.01), expected)
+        finally:
+            json_diff.numpy = save_numpy
+        self.assertEqual(len(self._diff(old, new)["_update"]["a"]
+            ["_update"]), size + 1)
+
+    def test_special_numbers(self):
+        inf = float("inf")
+        big = 2 ** 53
+        size = json_diff.NUMPY_MIN_SIZE
+        old = {"a": [inf, 1.0, inf, big, big * 1000, 10 ** 400,
+            float("nan")] + [0] * size, "b": inf, "c": big, "d": 10 ** 400}
+        new = {"a": [5.0, -inf, inf, big + 1, big * 1000 + 1,
+            10 ** 400 + 10 ** 390, 0.0] + [0] * size, "b": 1e308,
+            "c": big + 1, "d": 1.0}
+        expected = {"_update": {"a": {"_update": {0: 5.0, 1: -inf, 3: big + 1,
+            4: big * 1000 + 1, 5: 10 ** 400 + 10 ** 390, 6: 0.0}}, "b": 1e308,
+            "c": big + 1, "d": 1.0}}
+        save_numpy = json_diff.numpy
+        try:
+            self.assertEqual(self._diff(old, new, rel_tol=1e-20), expected)
+            json_diff.numpy = None
+            self.assertEqual(self._diff(old, new, rel_tol=1e-20), expected)
+        finally:
+            json_diff.numpy = save_numpy
+        self.assertEqual(self._diff(old, new, rel_tol=0.5)["_update"]["a"],
+            {"_update": {0: 5.0, 1: -inf, 6: 0.0}})
+
+
+class TestCache(OurTestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_hits(self):
+        cache = json_diff.ResultCache(self.cache_dir)
+        expected = json_diff.Comparator(open("test/old.json"),
+            open("test/new.json")).compare_dicts()
+        self.assertEqual(cache.compare("test/old.json", "test/new.json"),
+            expected)
+        save_load = json_diff.load_json
+        json_diff.load_json = None
+        try:
+            # nothing is parsed on a hit
+            self.assertEqual(cache.compare("test/old.json",
+                "test/new.json"), expected)
+        finally:
+            json_diff.load_json = save_load
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        cache.compare("test/old.json", "test/new.json", OptionsClass(
+            exc=["nome"]))
+        cache.compare("test/old.json", "test/new.json",
+            OptionsClass(ign=False), json_diff.StreamComparator)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+    def test_eviction(self):
+        cache = json_diff.ResultCache(self.cache_dir, max_entries=1)
+        cache.compare("test/old.json", "test/new.json")
+        cache.compare("test/new.json", "test/old.json")
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        cache.compare("test/new.json", "test/old.json")
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        cache = json_diff.ResultCache(self.cache_dir, max_size=0)
+        cache.compare("test/old.json", "test/new.json")
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_uncachable(self):
+        cache = json_diff.ResultCache(self.cache_dir)
+        deep = 1
+        # deeper than marshal can go
+        for level in range(5000):
+            deep = {"a": deep}
+        self.assertFalse(cache.put("deep", deep))
+        self.assertTrue(cache.put("flat", {"a": 1}))
+        self.assertEqual(os.listdir(self.cache_dir), ["flat.diff"])
+        # left over by a crashed writer
+        stale = os.path.join(self.cache_dir, "tmpx.tmp")
+        open(stale, "w").close()
+        os.utime(stale, (1, 1))
+        cache.evict()
+        self.assertEqual(os.listdir(self.cache_dir), ["flat.diff"])
+
+
+class TestStats(OurTestCase):
+    def test_stats(self):
+        old = {"a": [{}, 2, 3], "b": {"c": [1], "d": {"e": 1}}, "f": 1}
+        new = {"a": [{}, 2], "b": {"c": [2], "d": {"e": 1}}, "f": "1"}
+        self.assertEqual(json_diff.Comparator().stats, None)
+        diffator = json_diff.Comparator(opts=OptionsClass(stats=True,
+            prune_identical=True))
+        diffator.compare_dicts(old, new)
+        stats = diffator.stats.as_dict()
+        self.assertEqual(stats["nodes"],
+            {"object": 4, "array": 2, "scalar": 3})
+        self.assertEqual(stats["max_depth"], 3)
+        self.assertEqual(stats["pruned"], 2)
+        self.assertEqual(stats["largest_arrays"], [
+            {"length": 3, "path": "/a"}, {"length": 1, "path": "/b/c"}])
+        self.assertEqual(sorted(stats["timings"]),
+            ["compare_arrays", "compare_dicts"])
+
+    def test_stream_and_jobs(self):
+        old = {"a": [{}, 2, 3], "b": {"c": [1], "d": {"e": 1}}, "f": 1}
+        new = {"a": [{}, 2], "b": {"c": [2], "d": {"e": 1}}, "f": "1"}
+        diffator = json_diff.Comparator(opts=OptionsClass(stats=True))
+        diffator.compare_dicts(old, new)
+        expected = diffator.stats.as_dict()
+        del expected["timings"]
+        save_chunk_size = json_diff.PARALLEL_CHUNK_SIZE
+        json_diff.PARALLEL_CHUNK_SIZE = 10
+        try:
+            diffators = [json_diff.Comparator(opts=OptionsClass(stats=True,
+                jobs=2)), json_diff.StreamComparator(
+                StringIO(json.dumps(old)), StringIO(json.dumps(new)),
+                OptionsClass(stats=True))]
+            diffators[0].compare_dicts(old, new)
+            diffators[1].compare_dicts()
+        finally:
+            json_diff.PARALLEL_CHUNK_SIZE = save_chunk_size
+        for diffator in diffators:
+            stats = diffator.stats.as_dict()
+            self.assertIn("compare_dicts", stats.pop("timings"))
+            self.assertEqual(stats, expected)
+
+    def test_main_stats(self):
+        save_stdout = StringIO()
+        save_stderr = StringIO()
+        sys.stdout = save_stdout
+        sys.stderr = save_stderr
+        try:
+            res = json_diff.main(["json_diff", "--stats",
+                "test/old.json", "test/new.json"])
+        finally:
+            sys.stdout = sys.__stdout__
+            sys.stderr = sys.__stderr__
+        self.assertEqual(res, 1)
+        self.assertEqual(sorted(json.loads(save_stderr.getvalue())
+            ["timings"]), ["compare_dicts", "format", "parse"])
+
+
+class TestMerge(OurTestCase):
+    base = {"a": 1, "b": {"x": 1, "y": [1, 2, 3]}, "c": "keep", "d": 4,
+        "e": [1, 2]}
+    ours = {"a": 2, "b": {"x": 1, "y": [1, 5, 3]}, "c": "keep", "d": 4,
+        "e": [1, 2], "n": 1}
+    theirs = {"a": 1, "b": {"x": 7, "y": [1, 2, 9]}, "c": "keep",
+        "e": [1, 2, 3], "n": 1}
+
+    def test_merge(self):
+        for opts in (None, OptionsClass(prune_identical=True)):
+            diffator = json_diff.Comparator(opts=opts)
+            merged, conflicts = diffator.merge(self.base, self.ours,
+                self.theirs)
+            self.assertEqual(merged, {"a": 2, "b": {"x": 7, "y": [1, 5, 9]},
+                "c": "keep", "e": [1, 2, 3], "n": 1})
+            self.assertEqual(conflicts, [])
+            self.assertEqual(diffator.merge(self.base, self.ours, self.ours),
+                (self.ours, []))
+            self.assertEqual(diffator.merge({"a": 1}, {"a": 1.0},
+                {"a": 1})[0], {"a": 1.0})
+
+    def test_type_changes(self):
+        for opts in (None, OptionsClass(prune_identical=True)):
+            diffator = json_diff.Comparator(opts=opts)
+            merged, conflicts = diffator.merge({"a": {"x": 1}},
+                {"a": {"x": 1}, "b": 1}, {"a": {"x": True}})
+            self.assertTrue(merged["a"]["x"] is True)
+            self.assertEqual(conflicts, [])
+            merged = diffator.merge({"r": 0}, {"r": 0}, {"r": False})[0]
+            self.assertTrue(merged["r"] is False)
+            merged = diffator.merge({"r": 1, "y": [1]}, {"r": 1.0, "y": [1]},
+                {"r": 1, "y": [1.0]})[0]
+            self.assertEqual((type(merged["r"]), type(merged["y"][0])),
+                (float, float))
+
+    def test_deeply_nested(self):
+        text = '{"key": ' * 3000 + '1' + '}' * 3000
+        first = json_diff.load_json_text(text)
+        second = json_diff.load_json_text(text)
+        self.assertTrue(json_diff.same_values(first, second))
+        merged, conflicts = json_diff.Comparator().merge(first, second,
+            {"key": 2})
+        self.assertEqual((merged, conflicts), ({"key": 2}, []))
+
+    def test_conflicts(self):
+        ours = dict(self.ours, d=5, e=[0, 2])
+        theirs = dict(self.theirs, a=3)
+        merged, conflicts = json_diff.Comparator().merge(self.base,
+            ours, theirs)
+        self.assertEqual(conflicts, [
+            {"path": "/a", "base": 1, "ours": 2, "theirs": 3},
+            {"path": "/d", "base": 4, "ours": 5},
+            {"path": "/e", "base": [1, 2], "ours": [0, 2],
+                "theirs": [1, 2, 3]}])
+        self.assertEqual((merged["a"], merged["d"], merged["e"]),
+            (2, 5, [0, 2]))
+
+    def test_main_merge(self):
+        out_dir = tempfile.mkdtemp()
+        save_stdout = StringIO()
+        save_stderr = StringIO()
+        sys.stdout = save_stdout
+        sys.stderr = save_stderr
+        try:
+            names = []
+            for doc in (self.base, self.ours, dict(self.theirs, a=3)):
+                names.append(os.path.join(out_dir, "%d.json" % len(names)))
+                with open(names[-1], "w") as out:
+                    json.dump(doc, out)
+            res = json_diff.main(["json_diff", "--merge"] + names)
+        finally:
+            sys.stdout = sys.__stdout__
+            sys.stderr = sys.__stderr__
+            shutil.rmtree(out_dir)
+        self.assertEqual(res, 1)
+        self.assertEqual(json.loads(save_stdout.getvalue())["b"],
+            {"x": 7, "y": [1, 5, 9]})
+        self.assertEqual(json.loads(save_stderr.getvalue()),
+            [{"path": "/a", "base": 1, "ours": 2, "theirs": 3}])
+
+
+class TestSession(OurTestCase):
+    reference = {"a": 1, "b": {"x": [1, 2, 3], "y": "z"}, "c": [{"k": 1}]}
+
+    def _session(self, opts=None):
+        return json_diff.DiffSession(self.reference,
+            copy.deepcopy(self.reference), json_diff.Comparator(opts=opts))
+
+    def _check(self, session, opts=None):
+        self.assertEqual(session.result, json_diff.Comparator(opts=opts).
+            compare_dicts(self.reference, session.working))
+
+    def test_changed(self):
+        session = self._session()
+        self.assertEqual(session.result, {})
+        session.working["b"]["x"][1] = 5
+        session.changed("/b/x/1")
+        self.assertEqual(session.result,
+            {"_update": {"b": {"_update": {"x": {"_update": {1: 5}}}}}})
+        session.working["b"]["x"][1] = 2
+        session.changed(("b", "x", 1))
+        self.assertEqual(session.result, {})
+        del session.working["a"]
+        session.working["b"]["y"] = {"new": 1}
+        session.changed("/a")
+        session.changed("/b/y")
+        self._check(session)
+
+    def test_patch(self):
+        for opts in (None, OptionsClass(prune_identical=True),
+                OptionsClass(array_align="lcs"), OptionsClass(inc=["x"])):
+            session = self._session(opts)
+            session.apply_patch([
+                {"op": "add", "path": "/b/x/-", "value": 4},
+                {"op": "remove", "path": "/b/x/0"},
+                {"op": "replace", "path": "/c/0/k", "value": 2},
+                {"op": "move", "from": "/b/y", "path": "/d"},
+                {"op": "copy", "from": "/c/0", "path": "/c/-"},
+            ])
+            self._check(session, opts)
+            session.apply_patch([{"op": "replace", "path": "", "value": {}}])
+            self._check(session, opts)
+            self.assertRaises(json_diff.PatchError, session.changed,
+                "/b/x/y")
+
+    def test_filtered_type_change(self):
+        opts = OptionsClass(inc=["k"])
+        self.assertEqual(json_diff.Comparator(opts=opts).compare_dicts(
+            {"c": [{"k": 1}]}, {"c": [[1]]}), {})
+        session = self._session(opts)
+        session.apply_patch([{"op": "replace", "path": "/c/0",
+            "value": [1]}])
+        self.assertEqual(session.result, {})
+
+
+class TestTrees(OurTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.old_dir = os.path.join(self.tmp_dir, "old")
+        self.new_dir = os.path.join(self.tmp_dir, "new")
+        files = {
+            "old/same.json": '{"a": 1}',
+            "new/same.json": '{"a": 1}',
+            "old/sub/changed.json": open("test/old.json").read(),
+            "new/sub/changed.json": open("test/new.json").read(),
+            "old/removed.json": '{"r": 1}',
+            "new/added.json": '[1]',
+            "old/notes.txt": "old",
+            "new/notes.txt": "new",
+            # modified without changing the size and time
+            "old/stale.json": '{"s": 1}',
+            "new/stale.json": '{"s": 2}',
+        }
+        for name, text in files.iteritems():
+            path = os.path.join(self.tmp_dir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "w") as out:
+                out.write(text)
+        for name in ("old/stale.json", "new/stale.json"):
+            os.utime(os.path.join(self.tmp_dir, name), (1, 1))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_compare_trees(self):
+        expected = {
+            "_update": {"sub/changed.json":
+                json.load(open("test/diff.json"))},
+            "_append": {"added.json": [1]},
+            "_remove": {"removed.json": {"r": 1}},
+        }
+        # a document replaced by one of another type
+        with open(os.path.join(self.old_dir, "retyped.json"), "w") as out:
+            out.write('{"t": 1}')
+        with open(os.path.join(self.new_dir, "retyped.json"), "w") as out:
+            out.write('[]')
+        expected["_update"]["retyped.json"] = {"_replace": []}
+        for jobs in (1, 2):
+            diffator = json_diff.Comparator(opts=OptionsClass(jobs=jobs))
+            self.assertEqual(diffator.compare_trees(self.old_dir,
+                self.new_dir), expected)
+        expected["_update"]["stale.json"] = {"_update": {"s": 2}}
+        self.assertEqual(json_diff.Comparator().compare_trees(self.old_dir,
+            self.new_dir, trust_mtime=False), expected)
+        self.assertEqual(json_diff.StreamComparator().compare_trees(
+            self.old_dir, self.new_dir, trust_mtime=False), expected)
+        self.assertRaises(json_diff.BadJSONError,
+            json_diff.Comparator().compare_trees, self.old_dir,
+            self.new_dir, "*.txt")
+        self.assertEqual(sorted(json_diff.Comparator(opts=OptionsClass(
+            ign=True)).compare_trees(self.old_dir, self.new_dir)),
+            ["_remove", "_update"])
+
+    def test_files_closed(self):
+        if not os.path.isdir("/proc/self/fd"):
+            return
+        before = len(os.listdir("/proc/self/fd"))
+        for diffator in (json_diff.Comparator(opts=OptionsClass(lazy=True)),
+                json_diff.StreamComparator()):
+            diffator.compare_trees(self.old_dir, self.new_dir,
+                trust_mtime=False)
+        self.assertEqual(len(os.listdir("/proc/self/fd")), before)
+
+    def test_main_trees(self):
+        outputs = []
+        results = []
+        for args in (["--checksum", self.old_dir, self.new_dir],
+                [self.old_dir, self.old_dir]):
+            save_stdout = StringIO()
+            sys.stdout = save_stdout
+            try:
+                results.append(json_diff.main(["json_diff"] + args))
+            finally:
+                sys.stdout = sys.__stdout__
+            outputs.append(json.loads(save_stdout.getvalue()))
+        self.assertEqual(results, [1, 0])
+        self.assertEqual(sorted(outputs[0]["_update"]),
+            ["stale.json", "sub/changed.json"])
+        self.assertEqual(outputs[1], {})
+
+
+class TestRecords(OurTestCase):
+    old = '{"id": 1, "v": [1, 2]}\n{"id": 2, "v": "x"}\n\n{"id": 3}\n'
+    new = '{"id": 3}\n{"id": 4, "v": true}\n{"id": 1, "v": [1, 5]}\n'
+
+    def _records(self, old, new, fields=("id",), opts=None, **kwargs):
+        return list(json_diff.Comparator(opts=opts).compare_records(
+            StringIO(old), StringIO(new), fields, **kwargs))
+
+    def test_compare_records(self):
+        expected = [
+            {"key": {"id": 1}, "_update": {"_update": {"v":
+                {"_update": {1: 5}}}}},
+            {"key": {"id": 2}, "_remove": {"id": 2, "v": "x"}},
+            {"key": {"id": 4}, "_append": {"id": 4, "v": True}},
+        ]
+        self.assertEqual(self._records(self.old, self.new), expected)
+        # sorted in temporary files
+        self.assertEqual(self._records(self.old, self.new, run_size=1),
+            expected)
+        self.assertEqual(self._records(self.old, self.new,
+            opts=OptionsClass(ign=True)), expected[:2])
+        self.assertEqual(self._records(self.old, self.old), [])
+        old = {"a": 1, "b": 1}
+        new = {"a": 1, "b": 2}
+        self.assertEqual(self._records(json.dumps(old), json.dumps(new),
+            ("a", "b")), [{"key": old, "_remove": old},
+            {"key": new, "_append": new}])
+
+    def test_bad_records(self):
+        self.assertRaises(json_diff.BadJSONError, self._records,
+            self.old, '{"id": 1}\n{"id": 1}\n', run_size=1)
+        self.assertRaises(json_diff.BadJSONError, self._records,
+            self.old, '{"id": 1}\n[1]\n')
+        self.assertRaises(json_diff.BadJSONError, self._records,
+            self.old, '{"id": 1}\n{"id"\n')
+
+    def test_main_records(self):
+        out_dir = tempfile.mkdtemp()
+        save_stdout = StringIO()
+        sys.stdout = save_stdout
+        try:
+            names = []
+            for text in (self.old, self.new):
+                names.append(os.path.join(out_dir, "%d.jsonl" % len(names)))
+                with open(names[-1], "w") as out:
+                    out.write(text)
+            res = json_diff.main(["json_diff", "--records", "id"] + names)
+        finally:
+            sys.stdout = sys.__stdout__
+            shutil.rmtree(out_dir)
+        self.assertEqual(res, 1)
+        self.assertEqual([json.loads(line)["key"] for line in
+            save_stdout.getvalue().splitlines()],
+            [{"id": 1}, {"id": 2}, {"id": 4}])
+
+
+class TestServer(OurTestCase):
+    def setUp(self):
+        self.server = json_diff.DiffServer(("localhost", 0), OptionsClass())
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.conn = httplib.HTTPConnection("localhost",
+            self.server.server_address[1])
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _request(self, method, path, body=None):
+        self.conn.request(method, path, body)
+        response = self.conn.getresponse()
+        return (response.status, response.getheader("X-JSON-Diff-Different"),
+            response.read())
+
+    def test_diff(self):
+        old = open("test/old.json").read()
+        new = open("test/new.json").read()
+        self.assertEqual(self._request("PUT", "/old", old)[0], 201)
+        status, different, body = self._request("POST", "/old", new)
+        self.assertEqual((status, different), (200, "1"))
+        self.assertEqual(json.loads(body), json.load(open("test/diff.json")))
+        status, different, body = self._request("POST",
+            "/old?format=patch&compact=1", new)
+        self.assertEqual(json_diff.apply_patch(json.loads(old),
+            json.loads(body)), json.loads(new))
+        self.assertEqual(self._request("POST", "/old?format=html", new)[:2],
+            (200, "1"))
+        self.assertEqual(self._request("POST", "/old", old),
+            (200, "0", "{}\n"))
+
+    def test_baselines(self):
+        self.assertEqual(self._request("POST", "/none", "{}")[0], 404)
+        self.assertEqual(self._request("PUT", "/a", "{")[0], 400)
+        self.assertEqual(self._request("PUT", "/a", "[1]")[0], 201)
+        self.assertEqual(self._request("POST", "/a?format=xml", "[1]")[0],
+            400)
+        self.assertEqual(json.loads(self._request("GET", "/")[2]), ["a"])
+        self.assertEqual(self._request("DELETE", "/a")[0], 204)
+        self.assertEqual(self._request("DELETE", "/a")[0], 404)
+
+    def test_malformed(self):
+        self.assertEqual(self._request("PUT", "/%ff", "[1]")[0], 400)
+        self.conn.putrequest("PUT", "/a")
+        self.conn.putheader("Content-Length", "x")
+        self.conn.endheaders()
+        response = self.conn.getresponse()
+        response.read()
+        self.assertEqual(response.status, 400)
+        self.server.max_body = 2
+        self.assertEqual(self._request("PUT", "/a", "[1, 2]")[0], 413)
+        self.assertEqual(self._request("PUT", "/a", "[]")[0], 201)
+
+    def test_replaced(self):
+        self.assertEqual(self._request("PUT", "/a", '{"a": 1}')[0], 201)
+        for candidate in ("5", "[]"):
+            status, different, body = self._request("POST", "/a", candidate)
+            self.assertEqual((status, different), (200, "1"))
+            self.assertEqual(json.loads(body),
+                {"_replace": json.loads(candidate)})
+        status, different, body = self._request("POST", "/a?format=patch",
+            "5")
+        self.assertEqual((status, different, json.loads(body)),
+            (200, "1", [{"op": "replace", "path": "", "value": 5}]))
+
+    def test_failed(self):
+        def fail(self, old_obj=None, new_obj=None):
+            raise RuntimeError("broken")
+        self.assertEqual(self._request("PUT", "/a", "[1]")[0], 201)
+        save_compare = json_diff.Comparator.compare_dicts
+        json_diff.Comparator.compare_dicts = fail
+        try:
+            status, different, body = self._request("POST", "/a", "[2]")
+        finally:
+            json_diff.Comparator.compare_dicts = save_compare
+        self.assertEqual((status, json.loads(body)),
+            (500, {"error": "Comparison failed: broken"}))
+        self.assertEqual(self._request("POST", "/a", "[1]")[:2], (200, "0"))
+
+    def test_eviction(self):
+        store = json_diff.BaselineStore(max_size=10)
+        store.put("a", "[1, 2]")
+        store.put("b", "[3, 4]")
+        self.assertEqual(store.names(), ["b"])
+        store.put("c", "[5]")
+        self.assertNotEqual(store.get("b"), None)
+        store.put("d", "[6]")
+        self.assertEqual(store.names(), ["b", "d"])
+        self.assertEqual(store.size, 9)
+
+
 class TestMainArgsMgmt(unittest.TestCase):
     def test_args_help(self):
         save_stdout = StringIO()
@@ -222,6 +1639,27 @@ suite.addTest(add_tests_from_class(TestBasicJSON))
 suite.addTest(add_tests_from_class(TestHappyPath))
 suite.addTest(add_tests_from_class(TestBadPath))
 suite.addTest(add_tests_from_class(TestPiglitData))
+suite.addTest(add_tests_from_class(TestStreaming))
+suite.addTest(add_tests_from_class(TestDigests))
+suite.addTest(add_tests_from_class(TestArrayAlignment))
+suite.addTest(add_tests_from_class(TestKeyedArrays))
+suite.addTest(add_tests_from_class(TestXDiff))
+suite.addTest(add_tests_from_class(TestParallel))
+suite.addTest(add_tests_from_class(TestBatch))
+suite.addTest(add_tests_from_class(TestPathFilters))
+suite.addTest(add_tests_from_class(TestLazy))
+suite.addTest(add_tests_from_class(TestSnapshot))
+suite.addTest(add_tests_from_class(TestBenchmark))
+suite.addTest(add_tests_from_class(TestChanges))
+suite.addTest(add_tests_from_class(TestPatch))
+suite.addTest(add_tests_from_class(TestTolerance))
+suite.addTest(add_tests_from_class(TestCache))
+suite.addTest(add_tests_from_class(TestStats))
+suite.addTest(add_tests_from_class(TestMerge))
+suite.addTest(add_tests_from_class(TestSession))
+suite.addTest(add_tests_from_class(TestTrees))
+suite.addTest(add_tests_from_class(TestRecords))
+suite.addTest(add_tests_from_class(TestServer))
 suite.addTest(add_tests_from_class(TestMainArgsMgmt))
 
 if __name__ == "__main__":
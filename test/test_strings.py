@@ -57,6 +57,9 @@ color: red;
 .update_class {
 color: navy;
 }
+.move_class {
+color: purple;
+}
 </style>
 <body>
 <h1>json_diff result</h1>